@@ -0,0 +1,115 @@
+import concurrent.futures
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+from .additive_model import encode_combinations, decode_combinations
+from .design_scoring import score_designs
+from .genetic_design import genetic_algorithm, best_designs
+
+# Design generation for many targets (e.g. one per tissue) in a process pool. The targets are independent:
+# each task runs the GA for one target (increase_diversity times, without the most used microRNAs of the runs
+# before). The workers attach to the expression matrix in shared memory instead of receiving a pickled dataframe
+# with every task, and each task draws from its own random stream (spawned from the seed in target order),
+# so the designs for a seed are the same for any number of workers.
+
+# expression matrix, microRNA names, cell lines and transfer parameters of the tasks in this process
+_design_data = None
+_shared_block = None
+
+def _attach_shared_expression(block_name, shape, mirna_index, columns, transfer_params):
+    """Initializer of the worker processes."""
+    global _design_data, _shared_block
+    _shared_block = shared_memory.SharedMemory(name=block_name)
+    expression = np.ndarray(shape, dtype=float, buffer=_shared_block.buf)
+    _design_data = (expression, mirna_index, columns, transfer_params)
+
+def mirna_usage(designs):
+    """Returns the microRNAs of designs (tuples of microRNA names), the ones used in the most designs first
+    (ties in the order of their first use). Each microRNA is counted once per design."""
+    counts = {}
+    for design in designs:
+        for mirna in dict.fromkeys(design):
+            counts[mirna] = counts.get(mirna, 0) + 1
+    return sorted(counts, key=counts.get, reverse=True)
+
+def design_target(task):
+    """Runs the GA for one target and returns the best designs as a dataframe
+    (index: microRNAs of the design, columns: predicted stability, quality, target, emphasis, type)."""
+    expression, mirna_index, columns, transfer_params = _design_data
+    rng = np.random.default_rng(task["seed"])
+    mirnas = list(task["mirnas"])
+    designs_per_run = int(task["designs_per_target"] / task["increase_diversity"])
+    def score(population, return_stability=False):
+        return score_designs(population, expression, transfer_params, loss=task["loss"], mse_target=task["target"],
+                             loss_emphasis=task["loss_emphasis"], columns=columns, cell_line=task["cell_line"],
+                             return_stability=return_stability)
+
+    target_designs = []
+    for _ in range(task["increase_diversity"]):
+        candidates = encode_combinations(mirna_index, [mirnas])[0]
+        population = genetic_algorithm(score, candidates, task["n_mirnas"], task["generations"],
+                                       task["population_size"], task["mutation_rate"], rng)
+        fitness, stability = score(population, return_stability=True)
+        best = best_designs(population, fitness, designs_per_run)
+        combinations = decode_combinations(mirna_index, population[best])
+        designs = pd.DataFrame(stability[best], columns=columns,
+                               index=pd.MultiIndex.from_tuples(combinations, names=[
+                                   f'miRNA{i+1}' for i in range(task["n_mirnas"])]))
+        designs["quality"] = fitness[best]
+        designs["target"] = str(task["target"])
+        designs["emphasis"] = str(task["loss_emphasis"])
+        designs["type"] = task["base_name"]
+        # the next run may not use the most used microRNAs of this run
+        excluded = mirna_usage(combinations)[:task["excluded_per_run"]]
+        mirnas = [mirna for mirna in mirnas if mirna not in excluded]
+        target_designs.append(designs)
+    return pd.concat(target_designs)
+
+def generate_target_designs(mirna_expression, targets, designs_per_target, base_name, n_mirnas, loss_emphases=(),
+                            loss="mse", transfer_params=(), cell_lines=None, mirnas=None, increase_diversity=1,
+                            excluded_per_run=2, generations=30, population_size=300, mutation_rate=0.2, seed=None,
+                            n_workers=1):
+    """Generates designs_per_target designs for each target and returns them as one dataframe, in target order.
+
+    mirna_expression: dataframe with microRNA expression (index: microRNA names, columns: cell lines)
+    targets, loss_emphases: lists of dictionaries with the target stability and the loss emphasis per cell line
+                            (no loss_emphases: all cell lines weighted with 1)
+    loss, transfer_params: quality, mse or mse-log and the transfer parameters, see design_scoring.score_designs
+    cell_lines: the cell line of each target for the quality loss
+    mirnas: the microRNAs that the designs may use (default: all microRNAs of mirna_expression)
+    excluded_per_run: number of most used microRNAs that are excluded after each of the increase_diversity runs
+    seed: seed of the random streams of the targets
+    n_workers: number of worker processes (1: run in this process)"""
+    global _design_data
+    if len(loss_emphases) == 0:
+        loss_emphases = [{} for _ in targets]
+    if cell_lines is None:
+        cell_lines = [None for _ in targets]
+    seeds = np.random.SeedSequence(seed).spawn(len(targets))
+    tasks = [{"target": target, "loss_emphasis": loss_emphasis, "cell_line": cell_line, "seed": task_seed, "loss": loss,
+              "mirnas": list(mirna_expression.index) if mirnas is None else list(mirnas), "n_mirnas": n_mirnas,
+              "designs_per_target": designs_per_target, "increase_diversity": increase_diversity,
+              "excluded_per_run": excluded_per_run, "generations": generations, "population_size": population_size,
+              "mutation_rate": mutation_rate, "base_name": base_name}
+             for target, loss_emphasis, cell_line, task_seed in zip(targets, loss_emphases, cell_lines, seeds)]
+    expression = mirna_expression.to_numpy(dtype=float)
+    mirna_index = list(mirna_expression.index)
+    columns = list(mirna_expression.columns)
+
+    if n_workers <= 1:
+        _design_data = (expression, mirna_index, columns, transfer_params)
+        try:
+            return pd.concat([design_target(task) for task in tasks])
+        finally:
+            _design_data = None
+
+    block = shared_memory.SharedMemory(create=True, size=max(expression.nbytes, 1))
+    try:
+        np.ndarray(expression.shape, dtype=float, buffer=block.buf)[:] = expression
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=n_workers, initializer=_attach_shared_expression,
+                initargs=(block.name, expression.shape, mirna_index, columns, transfer_params)) as executor:
+            return pd.concat(list(executor.map(design_target, tasks)))
+    finally:
+        block.close()
+        block.unlink()
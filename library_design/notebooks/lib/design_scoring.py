@@ -0,0 +1,62 @@
+import numpy as np
+from .additive_model import combination_expression
+from .transfer_functions import transfer_function
+
+# Fused scoring of designs for the genetic algorithm: additive model -> transfer function -> loss, chunk by chunk
+# on arrays instead of intermediate dataframes. The losses are those of calculate_fitness in the design notebooks:
+#   quality: stability in the target cell line * TSI of the stability
+#   mse: 1 / mean over the cell lines of loss_emphasis * (stability - target)^2
+#   mse-log: like mse on log10 stability and log10 target
+losses = ("quality", "mse", "mse-log")
+# designs per chunk, bounds the memory of the intermediate arrays
+score_chunk_size = 65536
+
+def loss_vectors(columns, mse_target, loss_emphasis, log=False):
+    """Returns the target and emphasis of each column as arrays. An empty loss_emphasis weights all cell lines with 1."""
+    if not loss_emphasis:
+        loss_emphasis = {column: 1 for column in columns}
+    target = np.array([mse_target[column] for column in columns], dtype=float)
+    emphasis = np.array([loss_emphasis[column] for column in columns], dtype=float)
+    if log:
+        target = np.log10(target)
+    return target, emphasis
+
+def score_stability(stability, loss="mse", mse_target=None, loss_emphasis=None, columns=None, cell_line=None):
+    """Returns the fitness of designs from their stability (n_designs x n_cell_lines array).
+    columns: the cell lines of the stability columns (for mse_target, loss_emphasis and cell_line)"""
+    if loss == "quality":
+        x = stability / stability.max(axis=1, keepdims=True)
+        tsi = np.sum(1 - x, axis=1) / (stability.shape[1] - 1)
+        return stability[:, list(columns).index(cell_line)] * tsi
+    if loss not in losses:
+        raise ValueError(f"loss should be one of {losses}, not {loss!r}")
+    target, emphasis = loss_vectors(columns, mse_target, loss_emphasis, log=loss == "mse-log")
+    if loss == "mse-log":
+        stability = np.log10(stability)
+    mse = ((stability - target) ** 2 * emphasis).mean(axis=1)
+    return 1 / mse
+
+def score_designs(design_ids, expression, transfer_params=(), loss="mse", mse_target=None, loss_emphasis=None,
+                  columns=None, cell_line=None, chunk_size=score_chunk_size, return_stability=False):
+    """Returns the fitness of each design (and its predicted stability if return_stability).
+
+    design_ids: (n_designs x k) integer array with the rows of the microRNAs of each design
+    expression: array with microRNA expression (rows: microRNAs, columns: cell lines)
+    transfer_params: (c1, c2) of transfer_function (empty: its defaults)
+    loss: 'quality' (needs cell_line), 'mse' or 'mse-log' (need mse_target and optionally loss_emphasis,
+          dictionaries with cell lines as keys)
+    columns: the cell lines of the expression columns"""
+    expression = np.asarray(expression, dtype=float)
+    design_ids = np.asarray(design_ids)
+    fitness = np.empty(len(design_ids))
+    stability = np.empty((len(design_ids), expression.shape[1])) if return_stability else None
+    for start in range(0, len(design_ids), chunk_size):
+        end = start + chunk_size
+        chunk_stability = transfer_function(combination_expression(expression, design_ids[start:end]),
+                                            *transfer_params)
+        fitness[start:end] = score_stability(chunk_stability, loss, mse_target, loss_emphasis, columns, cell_line)
+        if return_stability:
+            stability[start:end] = chunk_stability
+    if return_stability:
+        return fitness, stability
+    return fitness
@@ -0,0 +1,59 @@
+import numpy as np
+
+# Genetic algorithm on integer arrays: the population is a (population_size x n_mirnas) array of microRNA ids
+# (rows of the expression matrix, see additive_model.encode_combinations) and each generation is bred with
+# batched tournament selection, single point crossover and mutation from a numpy Generator.
+# Seeding the Generator makes a run reproducible.
+tournament_size = 3
+mutation_rate = 0.2
+
+def tournament_selection(fitness, n_winners, rng, size=tournament_size):
+    """Returns the indices of n_winners winners of tournaments between size distinct random designs."""
+    # designs without a fitness lose (like NaN, which sort_values puts last)
+    fitness = np.where(np.isnan(fitness), -np.inf, fitness)
+    # the size smallest of random keys are a sample without replacement
+    contestants = np.argpartition(rng.random((n_winners, len(fitness))), size - 1, axis=1)[:, :size]
+    return contestants[np.arange(n_winners), np.argmax(fitness[contestants], axis=1)]
+
+def crossover(parents1, parents2, rng):
+    """Single point crossover: each child takes the microRNAs before a random position (0 to n_mirnas - 1)
+    from its first parent and the rest from its second parent."""
+    n_children, n_mirnas = parents1.shape
+    points = rng.integers(0, n_mirnas, n_children)
+    return np.where(np.arange(n_mirnas) < points[:, None], parents1, parents2)
+
+def mutate(children, candidates, rng, rate=mutation_rate):
+    """Replaces one random microRNA of each child by a random candidate with probability rate (in place)."""
+    n_children, n_mirnas = children.shape
+    mutated = np.flatnonzero(rng.random(n_children) < rate)
+    children[mutated, rng.integers(0, n_mirnas, len(mutated))] = rng.choice(candidates, len(mutated))
+    return children
+
+def genetic_algorithm(score, candidates, n_mirnas, generations=30, population_size=300,
+                      mutation_rate=mutation_rate, rng=None):
+    """Returns the population after generations generations as a (population_size x n_mirnas) id array.
+
+    score: function that returns the fitness of an (n_designs x n_mirnas) id array (higher is better)
+    candidates: ids of the microRNAs that the designs may use (each may be used several times in a design)
+    rng: numpy Generator (or seed) for the random choices"""
+    rng = np.random.default_rng(rng)
+    candidates = np.asarray(candidates)
+    population = rng.choice(candidates, (population_size, n_mirnas))
+    for generation in range(generations):
+        fitness = score(population)
+        parents = tournament_selection(fitness, 2 * population_size, rng)
+        children = crossover(population[parents[:population_size]], population[parents[population_size:]], rng)
+        population = mutate(children, candidates, rng, mutation_rate)
+    return population
+
+def unique_designs(design_ids):
+    """Returns the indices of the first occurrence of each design, in order.
+    Designs with the same microRNAs in a different order are duplicates (canonical form: sorted ids)."""
+    _, first = np.unique(np.sort(design_ids, axis=1), axis=0, return_index=True)
+    return np.sort(first)
+
+def best_designs(design_ids, fitness, n_designs):
+    """Returns the indices of the n_designs fittest unique designs, the fittest first."""
+    unique = unique_designs(design_ids)
+    order = np.argsort(-np.where(np.isnan(fitness[unique]), -np.inf, fitness[unique]), kind="stable")
+    return unique[order[:n_designs]]
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 from .mirna_combinations import *
 
@@ -32,6 +33,55 @@ def add_knockdown(knockdown, combinations, design_miRNA_dict):
 
     return add
 
+# Batch engine for the expression of many microRNA combinations (e.g. the population of a genetic algorithm).
+# The microRNA names are encoded once as row numbers of the expression matrix, a population of designs is then an
+# (n_designs x k) integer array and its expression is gathered and reduced in a few array operations.
+# Like the pandas sum and max, NaN expression values are skipped (a sum of only NaN values is 0).
+
+def encode_combinations(mirna_index, combs):
+    """Returns the combinations (tuples of microRNA names) as an (n_combinations x k) array of their positions
+    in mirna_index (the index of the expression dataframe). Raises a KeyError for unknown microRNAs."""
+    names = [mirna for comb in combs for mirna in comb]
+    ids = pd.Index(mirna_index).get_indexer(names)
+    if (ids == -1).any():
+        raise KeyError(f"microRNAs not in the expression data: {sorted(set(np.asarray(names, dtype=object)[ids == -1]))}")
+    return ids.reshape(len(combs), -1)
+
+def decode_combinations(mirna_index, design_ids):
+    """Inverse of encode_combinations: returns the designs of an id array as tuples of microRNA names."""
+    names = np.asarray(mirna_index, dtype=object)[design_ids]
+    return [tuple(row) for row in names.tolist()]
+
+def combination_expression(expression, design_ids, how="sum"):
+    """Returns the summed (how='sum') or maximal (how='max') expression of the microRNAs of each design
+    as a contiguous (n_designs x n_cell_lines) float array.
+    
+    expression: array with microRNA expression (rows: microRNAs, columns: cell lines)
+    design_ids: (n_designs x k) integer array with the rows of the microRNAs of each design"""
+    expression = np.asarray(expression, dtype=float)
+    design_ids = np.asarray(design_ids)
+    if how == "sum":
+        expression = np.nan_to_num(expression, nan=0.0)
+        reduce = np.add
+    elif how == "max":
+        # fmax ignores NaN unless both values are NaN
+        reduce = np.fmax
+    else:
+        raise ValueError(f"how should be 'sum' or 'max', not {how!r}")
+    # gather one microRNA position at a time, so only one (n_designs x n_cell_lines) array is needed
+    result = np.ascontiguousarray(expression[design_ids[:, 0]])
+    for position in range(1, design_ids.shape[1]):
+        reduce(result, expression[design_ids[:, position]], out=result)
+    return result
+
+def combination_dataframe(mirna_expr, combs, how, index):
+    """Computes the summed or maximal expression of combs with the batch engine and returns it as a float
+    dataframe with the columns of mirna_expr and the given index."""
+    design_ids = encode_combinations(mirna_expr.index, combs)
+    values = combination_expression(mirna_expr.to_numpy(dtype=float), design_ids, how)
+    return pd.DataFrame(values, index=index, columns=mirna_expr.columns)
+
+
 def add_mirna_expression(mirna_expr, construct_df):
     """Takes a dataframe with microRNA expressions and a dataframe with construct information.
     Returns a dataframe with the added expression of the microRNAs in the constructs.
@@ -40,12 +90,7 @@ def add_mirna_expression(mirna_expr, construct_df):
     construct_df: dataframe with construct information (index: construct names, columns: microRNA names)"""
 
     combs = get_combinations(construct_df)
-    added_expression = pd.DataFrame(columns=mirna_expr.columns, index=construct_df.index)
-
-    for i, comb in enumerate(combs):
-        added_expression.iloc[i,:] = mirna_expr.loc[comb,:].sum(axis=0)
-
-    return added_expression
+    return combination_dataframe(mirna_expr, combs, "sum", construct_df.index)
 
 def max_mirna_expression(mirna_expr, construct_df):
     """Takes a dataframe with microRNA expressions and a dataframe with construct information.
@@ -55,12 +100,7 @@ def max_mirna_expression(mirna_expr, construct_df):
     construct_df: dataframe with construct information (index: construct names, columns: microRNA names)"""
 
     combs = get_combinations(construct_df)
-    added_expression = pd.DataFrame(columns=mirna_expr.columns, index=construct_df.index)
-
-    for i, comb in enumerate(combs):
-        added_expression.iloc[i,:] = mirna_expr.loc[comb,:].max(axis=0)
-
-    return added_expression
+    return combination_dataframe(mirna_expr, combs, "max", construct_df.index)
 
 def add_mirna_combs(mirna_expr, combs):
     """Takes a dataframe with microRNA expressions and tuples of combinations.
@@ -68,17 +108,8 @@ def add_mirna_combs(mirna_expr, combs):
     
     mirna_expr: dataframe with microRNA expression (index: microRNA names, columns: cell lines)
     construct_df: dataframe with construct information (index: construct names, columns: microRNA names)"""
-    # if isinstance(combs[0], tuple):
     multiindex = pd.MultiIndex.from_tuples(combs, names=[f'miRNA{i+1}' for i in range(len(combs[0]))])
-    added_expression = pd.DataFrame(columns=mirna_expr.columns, index=multiindex)
-    added_expression = added_expression.astype("float")
-    # else:
-    #     added_expression = pd.DataFrame(columns=mirna_expr.columns, index=combs)
-
-    for i, comb in enumerate(combs):
-        added_expression.loc[comb,:] = mirna_expr.loc[comb,:].sum(axis=0).values
-
-    return added_expression
+    return combination_dataframe(mirna_expr, combs, "sum", multiindex)
 
 def max_mirna_combs(mirna_expr, combs):
     """Takes a dataframe with microRNA expressions and tuples of combinations.
@@ -86,14 +117,5 @@ def max_mirna_combs(mirna_expr, combs):
     
     mirna_expr: dataframe with microRNA expression (index: microRNA names, columns: cell lines)
     construct_df: dataframe with construct information (index: construct names, columns: microRNA names)"""
-    # if isinstance(combs[0], tuple):
     multiindex = pd.MultiIndex.from_tuples(combs, names=[f'miRNA{i}' for i in range(len(combs[0]))])
-    added_expression = pd.DataFrame(columns=mirna_expr.columns, index=multiindex)
-    added_expression = added_expression.astype("float")
-    # else:
-    #     added_expression = pd.DataFrame(columns=mirna_expr.columns, index=combs)
-
-    for i, comb in enumerate(combs):
-        added_expression.loc[comb,:] = mirna_expr.loc[comb,:].max(axis=0).values
-
-    return added_expression
\ No newline at end of file
+    return combination_dataframe(mirna_expr, combs, "max", multiindex)
\ No newline at end of file
@@ -1,13 +1,23 @@
-import gzip
-from Bio.SeqIO.QualityIO import FastqGeneralIterator
 import os
+import sys
 import pandas as pd
 import datetime
+import concurrent.futures
+import contextlib
+import functools
+from ngs_utils.fastq_batch import read_record_blocks
+from ngs_utils.fastq_split import split_block, ordered_parallel_map
+from ngs_utils.index_demux import build_index_neighbourhood, neighbourhood_table
+from ngs_utils.metrics import StageMetrics
+from ngs_utils.threaded_io import open_reader, open_writer
 
 fixed_suffix = "CKDL240004006-1A_22GVGLLT3_L2"
 lib_names = [
     'HEK293T_r1',
 ]
+# the libraries can also be given as arguments (run_pipeline.py runs one library per call)
+if len(sys.argv) > 1:
+    lib_names = sys.argv[1:]
 
 input_dir = '1_fastq'
 output_dir = '2_fastq_split_rem_umi'
@@ -20,18 +30,21 @@ if not os.path.exists(output_dir):
 internal_index_start = 26
 internal_index_end = 32
 
-# set the index sequences
-threeUTRindex = "TCTATG"
+# set the index sequences (sample name: index sequence)
+# each sample is written to {cell line}_{sample name}_{replicate}_Read1/2.fq.gz
+internal_indices = {
+    '3UTR': "TCTATG",
+}
+# reads with up to this many mismatches in the index are assigned to a sample
+max_index_mismatches = 1
 
-# set up a dataframe to store the statistics
-stats_df = pd.DataFrame(columns=["Library", "3UTR", "not found"])
+# precompute the neighbourhood of all indices, this reports indices that are too similar
+index_neighbourhood = build_index_neighbourhood(internal_indices, max_index_mismatches)
+index_table = neighbourhood_table(index_neighbourhood, internal_index_end - internal_index_start)
+sample_names = list(internal_indices.keys())
 
-def count_mismatching_characters(str1, str2):
-    count = 0
-    for char1, char2 in zip(str1, str2):
-        if char1 != char2:
-            count += 1
-    return count
+# set up a dataframe to store the statistics
+stats_df = pd.DataFrame(columns=["Library"] + sample_names + ["not found"])
 
 umi_len = 10
 umi_pos_r2 = 0
@@ -39,9 +52,20 @@ umi_pos_r2 = 0
 # set it to -1 if the UMI is at the end of the read
 umi_pos_r1 = None
 
+# number of worker processes for splitting (1: process the batches in the main process)
+n_workers = 1
+# number of read pairs per batch
+batch_size = 100000
+# the inputs are decompressed in background threads (False: in the main thread)
+read_ahead = True
+# the outputs are written as BGZF, compressed by compression_threads threads per file
+# (0: single-threaded gzip, see ngs_utils/threaded_io.py)
+compresslevel = 5
+compression_threads = 2
+
 # Iterate over read files
 for lib_name in lib_names:
-    no_reads_3UTR = 0
+    no_reads_samples = [0] * len(sample_names)
     no_reads_neither = 0
     total_reads = 0
     
@@ -49,69 +73,72 @@ for lib_name in lib_names:
     read1_filename = f'{lib_name}/{lib_name}_{fixed_suffix}_1.fq.gz'
     read2_filename = f'{lib_name}/{lib_name}_{fixed_suffix}_2.fq.gz'
     split_lib_name = lib_name.split('_')
-    output1_filename_3UTR = f"{split_lib_name[0]}_3UTR_{split_lib_name[1]}_Read1.fq.gz"
-    output2_filename_3UTR = f"{split_lib_name[0]}_3UTR_{split_lib_name[1]}_Read2.fq.gz"
-    output1_filename_5UTR = f"{split_lib_name[0]}_5UTR_{split_lib_name[1]}_Read1.fq.gz"
-    output2_filename_5UTR = f"{split_lib_name[0]}_5UTR_{split_lib_name[1]}_Read2.fq.gz"
+    output1_filenames = [f"{split_lib_name[0]}_{sample}_{split_lib_name[1]}_Read1.fq.gz" for sample in sample_names]
+    output2_filenames = [f"{split_lib_name[0]}_{sample}_{split_lib_name[1]}_Read2.fq.gz" for sample in sample_names]
     
     print(f"Starting library {lib_name} at: {datetime.datetime.now()}")
+    metrics = StageMetrics('1_split', lib_name)
     
-    with gzip.open(os.path.join(input_dir, read1_filename), 'rt') as input_read1_handle, \
-        gzip.open(os.path.join(input_dir, read2_filename), 'rt') as input_read2_handle:
-
-        with gzip.open(os.path.join(output_dir, output1_filename_3UTR), 'wt', compresslevel=5) as output1_3UTR_handle, \
-            gzip.open(os.path.join(output_dir, output2_filename_3UTR), 'wt', compresslevel=5) as output2_3UTR_handle, \
-            gzip.open(os.path.join(output_dir, output1_filename_5UTR), 'wt', compresslevel=5) as output1_5UTR_handle, \
-            gzip.open(os.path.join(output_dir, output2_filename_5UTR), 'wt', compresslevel=5) as output2_5UTR_handle:
-            for (title1, seq1, qual1), (title2, seq2, qual2) in zip(FastqGeneralIterator(input_read1_handle),\
-                FastqGeneralIterator(input_read2_handle)):
-                # Sanity check: titles must match
-                assert(title1.split()[0] == title2.split()[0])
-                # get the index on read2
-                index = seq2[internal_index_start:internal_index_end]
-                
-                # ------------ umi processing ----------------------
-                # get the UMI
-                umi = seq2[umi_pos_r2:umi_pos_r2+umi_len]
-                
-                # add the UMI to the first portion of the title
-                title1 = f"{title1.split()[0]}_{umi} {title1.split()[1]}"
-                title2 = f"{title2.split()[0]}_{umi} {title2.split()[1]}"
-                
-                # remove the umi from the sequence
-                seq2 = seq2[:umi_pos_r2] + seq2[umi_pos_r2+umi_len:]
-                qual2 = qual2[:umi_pos_r2] + qual2[umi_pos_r2+umi_len:]
-                
-                # check if the read1 umi is not None
-                if umi_pos_r1 is not None:
-                    if umi_pos_r1 == -1:
-                        seqlen = len(seq1)
-                        seq1 = seq1[:seqlen-umi_len]
-                        qual1 = qual1[:seqlen-umi_len]
-                    else:
-                        seq1 = seq1[:umi_pos_r1] + seq1[umi_pos_r1+umi_len:]
-                        qual1 = qual1[:umi_pos_r1] + qual1[umi_pos_r1+umi_len:]
-                
-                # ------------ index processing ----------------------
-                
-                # check if it is a 3UTR index
-                if count_mismatching_characters(threeUTRindex, index) < 2:
-                    output1_3UTR_handle.write(f"@{title1}\n{seq1}\n+\n{qual1}\n")
-                    output2_3UTR_handle.write(f"@{title2}\n{seq2}\n+\n{qual2}\n")
-                    no_reads_3UTR += 1
-                else:
-                    no_reads_neither += 1
-                total_reads += 1
-                
-                if total_reads % 1000000 == 0:
-                    print(f"Processed {total_reads} reads")
-                    
-    print(f"Number of 3UTR reads: {no_reads_3UTR}")
+    with open_reader(os.path.join(input_dir, read1_filename), read_ahead) as input_read1_handle, \
+        open_reader(os.path.join(input_dir, read2_filename), read_ahead) as input_read2_handle, \
+        contextlib.ExitStack() as output_stack:
+
+        output1_handles = [output_stack.enter_context(open_writer(os.path.join(output_dir, filename), compresslevel,
+                                                                  compression_threads))
+                           for filename in output1_filenames]
+        output2_handles = [output_stack.enter_context(open_writer(os.path.join(output_dir, filename), compresslevel,
+                                                                  compression_threads))
+                           for filename in output2_filenames]
+
+        split_func = functools.partial(split_block, internal_index_start=internal_index_start,
+                                       internal_index_end=internal_index_end, index_neighbourhood=index_neighbourhood,
+                                       index_table=index_table, n_samples=len(sample_names),
+                                       umi_len=umi_len, umi_pos_r2=umi_pos_r2, umi_pos_r1=umi_pos_r1)
+        # reading includes the decompression of the input
+        batches = metrics.timed_iter(read_record_blocks(input_read1_handle, input_read2_handle, batch_size), 'read')
+
+        if n_workers > 1:
+            executor = output_stack.enter_context(concurrent.futures.ProcessPoolExecutor(max_workers=n_workers))
+            # the wait for the results of the workers includes reading the next batches
+            results = metrics.timed_iter(ordered_parallel_map(executor, split_func, batches,
+                                                              max_pending=2 * n_workers), 'wait_split')
+        else:
+            # no pool: the batches are split in this process without pickling them
+            results = map(metrics.timed(split_func, 'split'), batches)
+
+        # write the batches in input order
+        for outputs1, outputs2, batch_samples, batch_neither in results:
+            # writing includes the compression of the output
+            with metrics.phase('write'):
+                for sample_id in range(len(sample_names)):
+                    output1_handles[sample_id].write(outputs1[sample_id])
+                    output2_handles[sample_id].write(outputs2[sample_id])
+                    no_reads_samples[sample_id] += batch_samples[sample_id]
+            no_reads_neither += batch_neither
+
+            previous_total = total_reads
+            total_reads += sum(batch_samples) + batch_neither
+            if total_reads // 1000000 > previous_total // 1000000:
+                print(f"Processed {total_reads // 1000000 * 1000000} reads")
+
+    for sample, no_reads_sample in zip(sample_names, no_reads_samples):
+        print(f"Number of {sample} reads: {no_reads_sample}")
     print(f"Number of reads w/o index: {no_reads_neither}")
     print(f"Total number of reads: {total_reads}")
     print(f"Finished library {lib_name} at: {datetime.datetime.now()}")
     
-    new_row_df = pd.DataFrame({"Library": lib_name, "3UTR": no_reads_3UTR, "not found": no_reads_neither}, index=[0])
+    metrics.count('reads_in', total_reads)
+    metrics.count('reads_out', sum(no_reads_samples))
+    metrics.write()
+
+    new_row_df = pd.DataFrame({"Library": lib_name, **dict(zip(sample_names, no_reads_samples)),
+                               "not found": no_reads_neither}, index=[0])
     stats_df = pd.concat([stats_df, new_row_df], ignore_index=True)
     
-stats_df.to_csv(f"{output_dir}/stats.csv", index=False)
\ No newline at end of file
+# keep the rows of the other libraries if the libraries are split one at a time
+stats_filepath = f"{output_dir}/stats.csv"
+if os.path.exists(stats_filepath):
+    previous_stats_df = pd.read_csv(stats_filepath)
+    previous_stats_df = previous_stats_df[~previous_stats_df["Library"].isin(stats_df["Library"])]
+    stats_df = pd.concat([previous_stats_df, stats_df], ignore_index=True)
+stats_df.to_csv(stats_filepath, index=False)
\ No newline at end of file
@@ -0,0 +1,50 @@
+import datetime
+import os
+import sys
+import pysam
+from ngs_utils.mate_merge import merge_fastq_files
+from ngs_utils.metrics import StageMetrics
+
+# Optional stage between splitting and aligning: merges the overlapping mates of each read pair into a single read
+# (see ngs_utils/mate_merge.py). The pairs that can not be merged are written to {lib_name}_Unmerged_Read1/2.fq.gz.
+# Set merged_reads in 3_align_to_references.py to align these files instead of the split reads,
+# stages 4 to 7 then work on single-end alignments (and on the alignments of the unmerged pairs).
+
+lib_names = [
+    'HEK293T_3UTR_r1',
+]
+# the libraries can also be given as arguments (run_pipeline.py runs one library per call)
+if len(sys.argv) > 1:
+    lib_names = sys.argv[1:]
+
+data_dir = '2_fastq_split_rem_umi'
+# the template lengths of the mates are the lengths of the references
+ref_filename = '2_references/references/references.fasta'
+# number of read pairs per batch
+batch_size = 100000
+# the outputs are written as BGZF, compressed by compression_threads threads per file
+# (0: single-threaded gzip, see ngs_utils/threaded_io.py)
+compresslevel = 5
+compression_threads = 2
+
+with pysam.FastaFile(ref_filename) as fasta:
+    reference_lengths = list(fasta.lengths)
+
+for lib_name in lib_names:
+    print(f"Starting library {lib_name} at: {datetime.datetime.now()}")
+    metrics = StageMetrics('2_merge', lib_name)
+    n_pairs, n_merged = merge_fastq_files(os.path.join(data_dir, f'{lib_name}_Read1.fq.gz'),
+                                          os.path.join(data_dir, f'{lib_name}_Read2.fq.gz'),
+                                          os.path.join(data_dir, f'{lib_name}_Merged.fq.gz'),
+                                          os.path.join(data_dir, f'{lib_name}_Unmerged_Read1.fq.gz'),
+                                          os.path.join(data_dir, f'{lib_name}_Unmerged_Read2.fq.gz'),
+                                          reference_lengths, batch_size, metrics, compresslevel,
+                                          compression_threads)
+    merged_fraction = n_merged / n_pairs if n_pairs else 0
+    print(f"Total read pairs: {n_pairs}")
+    print(f"Merged read pairs: {n_merged} ({merged_fraction:.2%})")
+    with open(os.path.join(data_dir, f'{lib_name}_merge_stats.txt'), 'w') as stats_file:
+        stats_file.write(f"Total read pairs: {n_pairs}\n")
+        stats_file.write(f"Merged read pairs: {n_merged}\n")
+    metrics.write()
+    print(f"Finished library {lib_name} at: {datetime.datetime.now()}")
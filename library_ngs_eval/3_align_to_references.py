@@ -1,32 +1,141 @@
+import contextlib
 import datetime
+import functools
 import os
-import pandas
+import sys
 import multiprocessing
 import shlex
 import subprocess
-
-import Bio
-import Bio.SeqIO
-import Bio.SeqRecord
-import gzip
+import threading
+import time
+import pysam
+from ngs_utils.metrics import StageMetrics
+from ngs_utils.alignment_filter import read_1_length, read_2_length, QueryGroupIndex
+from ngs_utils.reference_store import build_reference_store
+from ngs_utils.exact_match import split_exact_matches, split_exact_matches_single_end
+from ngs_utils.threaded_io import open_reader, fifo_writer
 
 align_output_dir = '3_alignments'
 ref_filepath = '2_references/references/'
 data_dir = './2_fastq_split_rem_umi/'
 temp_dir = './temp/'
 
+# True: bwa reads the gzipped reads directly and its SAM output is converted to BAM on the fly
+# False: unpack the reads to temp_dir, write a SAM file and convert it with samtools
+streaming_alignment = True
+# True: read pairs that match the windows of a reference exactly are assigned without bwa (see ngs_utils/exact_match.py),
+# only the other pairs are aligned. Both are written to the same BAM file. Only used with streaming_alignment.
+# The other pairs are streamed to bwa through FIFOs in temp_dir while the exact matches are assigned. The exact matches
+# follow the alignments of bwa in the BAM file, so they are written to a BAM file in temp_dir first, which takes
+# about as much disk space as their part of the output BAM file.
+exact_match_fast_path = True
+ref_fasta_filepath = '2_references/references/references.fasta'
+reference_store_dir = '2_references/reference_store'
+# True: align the merged reads of 2_merge_mates.py single-end, and the pairs it could not merge as pairs
+# (only used with streaming_alignment, NGS_MERGED_READS=1 also sets it, e.g. from run_pipeline.py)
+merged_reads = os.environ.get('NGS_MERGED_READS', '0') == '1'
+# number of bwa threads, run_pipeline.py sets PIPELINE_CPUS to the CPU budget of the stage
+n_threads = int(os.environ.get('PIPELINE_CPUS', multiprocessing.cpu_count()))
+
 lib_names = [
     'HEK293T_3UTR_r1',
 ]
+# the libraries can also be given as arguments (run_pipeline.py runs one library per call)
+if len(sys.argv) > 1:
+    lib_names = sys.argv[1:]
+
+# libraries that could not be aligned, the script exits with an error status if there are any
+failed_libs = []
 
 if not os.path.exists(align_output_dir):
     os.mkdir(align_output_dir)
-if not os.path.exists(temp_dir):
+if not os.path.exists(temp_dir) and (exact_match_fast_path or not streaming_alignment):
     os.mkdir(temp_dir)
-    
+if exact_match_fast_path and streaming_alignment:
+    # the same store as in 4_filter_alignments.py
+    build_reference_store(ref_fasta_filepath, reference_store_dir, read_1_length, read_2_length)
+
+def log_stderr(proc, lib_name, log_lines):
+    # print and collect the bwa log while the alignments are read from stdout
+    for myline in proc.stderr:
+        myline = myline.decode("utf-8")
+        log_lines.append(myline)
+        print(f"[{datetime.datetime.now().isoformat(sep=' ')}][{lib_name}] {myline.strip()}")
+
+def assign_exact_matches(fastq_filepaths, exact_filepath, miss_filepaths, metrics):
+    # runs in a thread while bwa reads the other reads from the FIFOs miss_filepaths (see align_streaming)
+    # the exact_match phase overlaps the align phase, its CPU time is counted in the align phase
+    start = time.perf_counter()
+    if len(fastq_filepaths) == 2:
+        counts = split_exact_matches(*fastq_filepaths, reference_store_dir, exact_filepath, *miss_filepaths,
+                                     compresslevel=None)
+    else:
+        counts = split_exact_matches_single_end(fastq_filepaths[0], reference_store_dir, exact_filepath,
+                                                miss_filepaths[0], compresslevel=None)
+    metrics.add_time('exact_match', time.perf_counter() - start)
+    return counts
+
+def align_streaming(fastq_groups, bam_filepath, lib_name, metrics, append_filepaths=(), group_writers=()):
+    # bwa reads the gzipped files (or the FIFOs of group_writers) itself, the SAM records on stdout are written to
+    # BAM directly
+    # each group of files (read 1 and read 2, or single-end reads) is aligned by a bwa run into the same BAM file
+    # group_writers: a function per group that writes its files (FIFOs) in a thread while bwa reads them,
+    # their results are returned with the log (for the groups that bwa aligned)
+    # the records of append_filepaths (the exact matches) are written after those of bwa
+    # the offsets of the query groups are written next to the BAM file, stage 4 splits it into chunks at these
+    log_lines = []
+    writer_results = []
+    n_records = 0
+    n_reads = 0
+    bam_out = None
+    for i, fastq_filepaths in enumerate(fastq_groups):
+        # -a: output all alignments for SE or unpaired PE
+        # -M: mark shorter split hits as secondary
+        # -t: number of threads
+        command = f'bwa mem -a -M -t {n_threads} {ref_filepath} ' + ' '.join(fastq_filepaths)
+        with contextlib.ExitStack() as fifos:
+            writer = fifos.enter_context(fifo_writer(fastq_filepaths, group_writers[i])) if group_writers else None
+            with subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE) as proc:
+                log_thread = threading.Thread(target=log_stderr, args=(proc, lib_name, log_lines))
+                log_thread.start()
+                with pysam.AlignmentFile(proc.stdout, "r") as sam_in:
+                    if bam_out is None:
+                        bam_out = pysam.AlignmentFile(bam_filepath, "wb", template=sam_in)
+                        group_index = QueryGroupIndex(bam_out)
+                    for read in sam_in:
+                        group_index.write(read)
+                        n_records += 1
+                        # read pairs or merged reads: primary records that are not read 2
+                        # (not secondary or supplementary)
+                        n_reads += read.flag & 0x980 == 0
+                log_thread.join()
+            if writer is not None and proc.returncode == 0:
+                writer_results.append(writer.result())
+
+        if proc.returncode != 0:
+            print(f"bwa failed for {lib_name} with exit code {proc.returncode}")
+            failed_libs.append(lib_name)
+            break
+
+    if bam_out is not None:
+        # the exact matches of a group that bwa did not align to the end may be incomplete
+        for append_filepath in append_filepaths if lib_name not in failed_libs else ():
+            with pysam.AlignmentFile(append_filepath, "rb", check_sq=False) as exact_in:
+                for read in exact_in:
+                    group_index.write(read)
+                    n_records += 1
+                    n_reads += not read.is_read2
+        bam_out.close()
+        group_index.save(bam_filepath)
+    metrics.count('reads_in', n_reads)
+    metrics.count('reads_out', n_records)
+
+    return "".join(log_lines), writer_results
+
 # align
 for lib_name in lib_names:
     print(f"Starting library {lib_name} at: {datetime.datetime.now()}")
+    metrics = StageMetrics('3_align', lib_name)
     
     align_output_filename = lib_name + '.sam'
     align_output_filepath = os.path.join(align_output_dir, align_output_filename)
@@ -36,39 +145,86 @@ for lib_name in lib_names:
     file_path_R1 = [os.path.join(data_dir, lib_name + '_Read1.fq.gz')]
     file_path_R2 = [os.path.join(data_dir, lib_name + '_Read2.fq.gz')]
     
+    if streaming_alignment:
+        # the groups of files that bwa aligns
+        if merged_reads:
+            fastq_groups = [[os.path.join(data_dir, lib_name + '_Merged.fq.gz')],
+                            [os.path.join(data_dir, lib_name + f'_Unmerged_Read{read}.fq.gz') for read in (1, 2)]]
+        else:
+            fastq_groups = [file_path_R1 + file_path_R2]
+
+        exact_filepaths = []
+        group_writers = []
+        if exact_match_fast_path:
+            for i, fastq_filepaths in enumerate(fastq_groups):
+                exact_filepath = os.path.join(temp_dir, f'{lib_name}_exact_{i}.bam')
+                # FIFOs for the reads that bwa aligns (uncompressed)
+                miss_filepaths = [os.path.join(temp_dir, os.path.basename(filepath).replace('.fq.gz', '.fq'))
+                                  for filepath in fastq_filepaths]
+                print(f"Assigning exact matches of {' and '.join(fastq_filepaths)} while the other reads are aligned")
+                group_writers.append(functools.partial(assign_exact_matches, fastq_filepaths, exact_filepath,
+                                                       miss_filepaths, metrics))
+                exact_filepaths.append(exact_filepath)
+                fastq_groups[i] = miss_filepaths
+
+        print(f"Aligning {' and '.join(sum(fastq_groups, []))} to {ref_filepath}")
+        # the CPU time of the align phase includes bwa
+        with metrics.phase('align'):
+            log_str, exact_match_counts = align_streaming(fastq_groups, align_output_filepath.replace(".sam", ".bam"),
+                                                          lib_name, metrics, exact_filepaths, group_writers)
+        if exact_match_fast_path:
+            n_reads = sum(group_reads for group_reads, _ in exact_match_counts)
+            n_exact_matches = sum(group_exact_matches for _, group_exact_matches in exact_match_counts)
+            exact_fraction = n_exact_matches / n_reads if n_reads else 0
+            # reads: read pairs and merged reads
+            print(f"Exact matches: {n_exact_matches} of {n_reads} reads ({exact_fraction:.2%}), "
+                  f"{n_reads - n_exact_matches} reads were aligned with bwa")
+            metrics.count('exact_matches', n_exact_matches)
+        with open(align_output_logpath, 'w') as f:
+            f.write(log_str)
+            if exact_match_fast_path:
+                f.write(f"Exact matches: {n_exact_matches} of {n_reads} reads ({exact_fraction:.2%})\n")
+        for exact_filepath in exact_filepaths:
+            if os.path.exists(exact_filepath):
+                os.remove(exact_filepath)
+        metrics.write()
+        print(f"Finished library {lib_name} at: {datetime.datetime.now()}")
+        continue
+
     # create temporary unpacked files
     temp_R1 = os.path.join(temp_dir, lib_name + '_Read1.fastq')
     temp_R2 = os.path.join(temp_dir, lib_name + '_Read2.fastq')
     
     print(f"Unpacking {file_path_R1[0]} and {file_path_R2[0]}")
-    # unpack using the gzip library
+    # unpack with read-ahead decompression in a background thread
     # chunk it to avoid memory issues
     chunk_size = 1024 * 1024 * 68
-    with gzip.open(file_path_R1[0], 'rt') as f_in, open(temp_R1, 'w') as f_out:
-        while True:
-            chunk = f_in.read(chunk_size)
-            if not chunk:
-                break
-            f_out.write(chunk)
-    with gzip.open(file_path_R2[0], 'rt') as f_in, open(temp_R2, 'w') as f_out:
-        while True:
-            chunk = f_in.read(chunk_size)
-            if not chunk:
-                break
-            f_out.write(chunk)
+    with metrics.phase('unpack'):
+        with open_reader(file_path_R1[0]) as f_in, open(temp_R1, 'wb') as f_out:
+            while True:
+                chunk = f_in.read(chunk_size)
+                if not chunk:
+                    break
+                f_out.write(chunk)
+        with open_reader(file_path_R2[0]) as f_in, open(temp_R2, 'wb') as f_out:
+            while True:
+                chunk = f_in.read(chunk_size)
+                if not chunk:
+                    break
+                f_out.write(chunk)
     
     print(f"Aligning {temp_R1} and {temp_R2} to {ref_filepath}")
     # -a: output all alignments for SE or unpaired PE
     # -M: mark shorter split hits as secondary
     # -t: number of threads
     # -o: output file
-    command = f'bwa mem -a -M -t {multiprocessing.cpu_count()} -o {align_output_filepath} ' + \
+    command = f'bwa mem -a -M -t {n_threads} -o {align_output_filepath} ' + \
             f'{ref_filepath} {temp_R1} {temp_R2}'
             
     command_split = shlex.split(command)
     log_str = ''
     
-    with subprocess.Popen(command_split, stderr=subprocess.PIPE) as proc:
+    with metrics.phase('align'), subprocess.Popen(command_split, stderr=subprocess.PIPE) as proc:
         myline = proc.stderr.readline().decode("utf-8")
         while myline:
             log_str += myline
@@ -81,7 +237,10 @@ for lib_name in lib_names:
         
     print("Converting to bam...")
     command = f'samtools view -b {align_output_filepath} > {align_output_filepath.replace(".sam", ".bam")}'
-    proc = subprocess.run(command, shell=True, stderr=subprocess.PIPE)
+    with metrics.phase('convert'):
+        proc = subprocess.run(command, shell=True, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        failed_libs.append(lib_name)
         
     # remove temporary files
     os.remove(temp_R1)
@@ -90,6 +249,9 @@ for lib_name in lib_names:
     # remove the sam file
     os.remove(align_output_filepath)
     
+    metrics.write()
     print(f"Finished library {lib_name} at: {datetime.datetime.now()}")
 
+if failed_libs:
+    sys.exit(f"Alignment failed for: {', '.join(failed_libs)}")
 print('Done')
\ No newline at end of file
@@ -0,0 +1,116 @@
+import datetime
+import os
+import sys
+import pysam
+import concurrent.futures
+import traceback
+from ngs_utils.alignment_filter import process_bam_file, add_filter_metrics, read_1_length, read_2_length
+from ngs_utils.metrics import StageMetrics
+from ngs_utils.reference_store import build_reference_store
+from ngs_utils.counting import save_counts, merge_count_files
+from ngs_utils.umi_dedup import umi_from_query_name
+
+# Single pass replacement for stages 4 to 7:
+# filter the read pairs, keep read 1, deduplicate (reference, UMI) in memory and count per reference.
+
+align_input_dir = '3_alignments'
+align_output_dir = '4_filtered_alignments'
+dedup_output_dir = '5_deduplicated'
+counts_output_dir = '6_counts'
+create_alignment_df = False
+create_alignment_overview_df = True
+# also write the _filter.bam and _deduplicated.bam files of the separate stages (for debugging)
+write_intermediate_bams = False
+# number of worker processes per library (1: filter the library in a single process)
+# the library is split into chunks of chunk_size read pairs
+n_chunk_workers = 1
+chunk_size = 200000
+# number of libraries filtered at the same time, the edit distance cache memory
+# (edit_distance_cache_memory of ngs_utils/alignment_filter.py) is shared by all their processes
+n_library_workers = 8
+
+lib_names = [
+    'HEK293T_3UTR_r1',
+]
+# the libraries can also be given as arguments (run_pipeline.py runs one library per call)
+if len(sys.argv) > 1:
+    lib_names = sys.argv[1:]
+
+ref_filename = '2_references/references/references.fasta'
+reference_store_dir = '2_references/reference_store'
+
+# Build the reference store once, the workers memory-map it
+build_reference_store(ref_filename, reference_store_dir, read_1_length, read_2_length)
+
+for output_dir in [align_output_dir, dedup_output_dir, counts_output_dir]:
+    if not os.path.exists(output_dir):
+        os.mkdir(output_dir)
+
+def filter_deduplicate_count(lib_name):
+    metrics = StageMetrics('4_7_filter_count', lib_name)
+    input_filepath = os.path.join(align_input_dir, f'{lib_name}.bam')
+    filter_filepath = os.path.join(align_output_dir, f'{lib_name}_filter.bam') if write_intermediate_bams else None
+
+    with pysam.AlignmentFile(input_filepath, "rb") as bam_in:
+        references = bam_in.references
+        dedup_bam = pysam.AlignmentFile(os.path.join(dedup_output_dir, f'{lib_name}_deduplicated.bam'), "wb",
+                                        template=bam_in) if write_intermediate_bams else None
+
+    # Initialize a dictionary to store counts with all templates from the header
+    counts = {ref: 0 for ref in references}
+    seen_umis = set()
+    n_duplicates = 0
+
+    def count_read_1(valid_alignments):
+        nonlocal n_duplicates
+        for alignment in valid_alignments:
+            # read 2 is not counted (samtools view -F 128 in stage 5), merged reads are single-end
+            if alignment.is_read2:
+                continue
+            key = (alignment.reference_id, umi_from_query_name(alignment.query_name))
+            if key in seen_umis:
+                n_duplicates += 1
+                continue
+            seen_umis.add(key)
+            counts[alignment.reference_name] += 1
+            if dedup_bam is not None:
+                dedup_bam.write(alignment)
+
+    stats = process_bam_file(input_filepath, filter_filepath, lib_name, reference_store_dir, align_output_dir,
+                             create_alignment_df, create_alignment_overview_df, aligned_callback=count_read_1,
+                             n_workers=n_chunk_workers, chunk_size=chunk_size,
+                             n_library_processes=min(n_library_workers, len(lib_names)))
+    if dedup_bam is not None:
+        dedup_bam.close()
+
+    print(f"Deduplicated library {lib_name} at: {datetime.datetime.now()}")
+    print(f"Unique reads: {len(seen_umis)}")
+    print(f"Duplicate reads: {n_duplicates}")
+    save_counts(counts, os.path.join(counts_output_dir, lib_name + ".csv"))
+    # deduplicating and counting is part of the write phase
+    add_filter_metrics(metrics, stats)
+    metrics.count('reads_out', len(seen_umis))
+    metrics.write()
+
+def task_wrapper(func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    except Exception as e:
+        # Capturing the traceback
+        error_msg = f"An error occurred: {e}\n"
+        error_msg += "".join(traceback.format_exception(None, e, e.__traceback__))
+        return error_msg
+
+# set if a library fails, the script then exits with an error status (used by run_pipeline.py)
+failed = False
+with concurrent.futures.ProcessPoolExecutor(max_workers=n_library_workers) as executor:
+    futures = [executor.submit(task_wrapper, filter_deduplicate_count, lib_name) for lib_name in lib_names]
+    for future in concurrent.futures.as_completed(futures):
+        result = future.result()
+        if isinstance(result, str) and result.startswith("An error occurred:"):
+            print(result)
+            failed = True
+
+merge_count_files(counts_output_dir, lib_names)
+if failed:
+    sys.exit(1)
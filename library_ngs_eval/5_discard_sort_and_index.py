@@ -1,16 +1,21 @@
 import concurrent.futures
 import os
+import sys
 import subprocess
 
 lib_names = [
     'HEK293T_3UTR_r1',
 ]
+# the libraries can also be given as arguments (run_pipeline.py runs one library per call)
+if len(sys.argv) > 1:
+    lib_names = sys.argv[1:]
 
 align_output_dir = '4_filtered_alignments'
 
 def discard_sort_and_index(bam_file):
     print(f"Discard the second read of {bam_file}...")
-    command = f'samtools view -b -f 64 {bam_file} > {bam_file.replace(".bam", "_discard.bam")}'
+    # -F 128 keeps read 1 and the single-end alignments of merged reads (2_merge_mates.py)
+    command = f'samtools view -b -F 128 {bam_file} > {bam_file.replace(".bam", "_discard.bam")}'
     proc = subprocess.run(command, shell=True, stderr=subprocess.PIPE)
     print(proc.stderr.decode())
 
@@ -1,34 +1,64 @@
 import concurrent.futures
 import os
+import sys
 import subprocess
 import datetime
+from ngs_utils.umi_dedup import deduplicate_bam
+from ngs_utils.counting import save_counts
+from ngs_utils.metrics import StageMetrics
 
 lib_names = [
     'HEK293T_3UTR_r1',
 ]
+# the libraries can also be given as arguments (run_pipeline.py runs one library per call)
+if len(sys.argv) > 1:
+    lib_names = sys.argv[1:]
 
 input_dir = '4_filtered_alignments'
 output_dir = '5_deduplicated'
+umi_length = 10
+# 'unique': every (reference, UMI) is a molecule, 'directional': UMIs with sequencing errors are merged
+# into the UMI they originate from (the directional method of umi_tools)
+dedup_method = 'unique'
+# number of worker processes that cluster the references of a library (directional method)
+n_dedup_workers = 1
+# deduplicate with umi_tools on the sorted and indexed BAM file of stage 5 instead of the built-in engine
+use_umi_tools = False
 
 # create output directory if it does not exist
 if not os.path.exists(output_dir):
     os.mkdir(output_dir)
 
-# Function to deduplicate a library
-def deduplicate_lib(lib_name):
+# Function to deduplicate a library with umi_tools
+def deduplicate_lib_umi_tools(lib_name):
     print(f"Starting library {lib_name} at: {datetime.datetime.now()}")
-    command = f'umi_tools dedup --method unique -I {input_dir}/{lib_name}_filter_sorted.bam ' + \
+    command = f'umi_tools dedup --method {dedup_method} -I {input_dir}/{lib_name}_filter_sorted.bam ' + \
               f'--output-stats={output_dir}/{lib_name}_deduplicated -S {output_dir}/{lib_name}_deduplicated.bam > {output_dir}/{lib_name}_umi_tools.log'
     proc = subprocess.run(command, shell=True, stderr=subprocess.PIPE)
     if proc.stderr:
         print("Error:", proc.stderr.decode())
     print(f"Finished library {lib_name} at: {datetime.datetime.now()}")
 
+# Function to deduplicate a library
+def deduplicate_lib(lib_name):
+    print(f"Starting library {lib_name} at: {datetime.datetime.now()}")
+    metrics = StageMetrics('6_deduplicate', lib_name)
+    # the filtered BAM file of stage 4 does not need to be sorted, stage 5 replaces it with the sorted file
+    input_filepath = os.path.join(input_dir, f'{lib_name}_filter.bam')
+    if not os.path.exists(input_filepath):
+        input_filepath = os.path.join(input_dir, f'{lib_name}_filter_sorted.bam')
+    counts = deduplicate_bam(input_filepath, os.path.join(output_dir, f'{lib_name}_deduplicated.bam'),
+                             os.path.join(output_dir, f'{lib_name}_deduplicated'), umi_length, dedup_method,
+                             n_dedup_workers, metrics)
+    save_counts(counts, os.path.join(output_dir, f'{lib_name}_deduplicated_counts.csv'))
+    metrics.write()
+    print(f"Finished library {lib_name} at: {datetime.datetime.now()}")
+
 # Use ProcessPoolExecutor to run deduplications in parallel
 with concurrent.futures.ProcessPoolExecutor() as executor:
     # Map the deduplicate_lib function to each lib_name
-    results = executor.map(deduplicate_lib, lib_names)
+    results = executor.map(deduplicate_lib_umi_tools if use_umi_tools else deduplicate_lib, lib_names)
 
     # Process results if needed (here we just pass)
     for result in results:
-        pass  
\ No newline at end of file
+        pass
@@ -1,31 +1,22 @@
-import pysam
-import sys
-import pandas as pd
 import os
-
-def count_alignments(bam_file):
-    # Open the BAM file
-    with pysam.AlignmentFile(bam_file, "rb") as bam:
-        # Initialize a dictionary to store counts with all templates from the header
-        counts = {ref: 0 for ref in bam.references}
-
-        # Iterate over each alignment
-        for read in bam:
-            # Get reference name (template)
-            # Ensure the read is aligned
-            if read.reference_id != -1:  
-                ref_name = bam.get_reference_name(read.reference_id)
-
-                # Increment count for this reference name
-                counts[ref_name] += 1
-
-        return counts
+import sys
+from ngs_utils.counting import count_alignments, save_counts, merge_count_files
+from ngs_utils.metrics import StageMetrics
 
 def main():
     lib_names = [
         'HEK293T_3UTR_r1',
     ]
+    # the libraries can also be given as arguments (run_pipeline.py runs one library per call)
+    if len(sys.argv) > 1:
+        lib_names = sys.argv[1:]
     output_path = '6_counts'
+    # only count alignments with all require_flags and none of exclude_flags (like samtools view -f/-F),
+    # without flags the counts of the BAM index are used if the file is indexed
+    require_flags = 0
+    exclude_flags = 0
+    # number of worker processes that count the references of an indexed BAM file
+    n_count_workers = 1
 
     # create folder if it doesn't exist
     if not os.path.exists('6_counts'):
@@ -33,24 +24,15 @@ def main():
 
     for lib_name in lib_names:
         print(f"Processing {lib_name}...")
+        metrics = StageMetrics('7_count', lib_name)
         filename = f'5_deduplicated/{lib_name}_deduplicated.bam'
-        counts = count_alignments(filename)
-
-        # Convert the counts dictionary to a DataFrame
-        df = pd.DataFrame(list(counts.items()), columns=['Reference', 'Count'])
-
-        # Save the DataFrame to the specified path
-        df.to_csv(os.path.join(output_path, lib_name+".csv"), index=False)
+        with metrics.phase('count'):
+            counts = count_alignments(filename, require_flags, exclude_flags, n_count_workers)
+        save_counts(counts, os.path.join(output_path, lib_name+".csv"))
+        metrics.count('reads_out', sum(counts.values()))
+        metrics.write()
 
-    # get all filenames in the output folder
-    filenames = os.listdir(output_path)
-    all_counts = []
-    for filename in filenames:
-        df = pd.read_csv(os.path.join(output_path, filename), index_col=0)
-        df.rename(columns={'Count': filename.split('.')[0]}, inplace=True)
-        all_counts.append(df)
-    all_counts = pd.concat(all_counts, axis=1)
-    all_counts.to_csv(os.path.join(output_path, 'all_counts.csv'))
+    merge_count_files(output_path, lib_names)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,218 @@
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import numpy as np
+import pandas as pd
+import pysam
+from ngs_utils.simulation import random_references, add_variant_references, read_fasta, write_fasta, \
+    simulate_reads, expected_counts, write_truth_alignments
+from ngs_utils.alignment_filter import read_1_length, read_2_length, QueryGroupIndex
+from ngs_utils.reference_store import build_reference_store
+from ngs_utils.exact_match import split_exact_matches
+
+# Benchmark of stages 1, 4, 6 and 7 on synthetic read pairs with known origin (see ngs_utils/simulation.py).
+# Each size runs in benchmark_dir/{n_pairs}; the reads are generated once (delete the directory to regenerate them).
+# The timings and the agreement of the counts with the ground truth are saved with the commit in results_dir,
+# and compared to the last run of another commit.
+
+benchmark_sizes = [1000000, 10000000, 100000000]
+
+# None: random references that carry the internal index, otherwise a FASTA file of a design
+reference_fasta = None
+n_random_references = 2000
+random_reference_length = 300
+# fraction of the references that get a copy with one substitution (reads align to both copies)
+variant_fraction = 0.05
+simulation_parameters = dict(
+    molecules_per_reference=200,
+    index_error_rate=0.005,
+    substitution_rate=0.002,
+    insertion_rate=0.0002,
+    deletion_rate=0.0002,
+    low_quality_tail_fraction=0.1,
+    max_tail_length=30,
+)
+seed = 0
+
+# as in 1_split_UTR_rem_umis.py
+fixed_suffix = "CKDL240004006-1A_22GVGLLT3_L2"
+internal_index = "TCTATG"
+raw_lib_name = 'SIM_r1'
+lib_name = 'SIM_3UTR_r1'
+
+benchmark_dir = 'benchmark'
+results_dir = 'benchmark_results'
+# stage 3 runs bwa if it is installed, otherwise the alignments are written from the ground truth
+# (after the exact match fast path of stage 3, as in 3_align_to_references.py)
+use_bwa = shutil.which('bwa') is not None
+exact_match_fast_path = True
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+stages = [
+    # (stage, script, library argument)
+    ('1_split', '1_split_UTR_rem_umis.py', raw_lib_name),
+    ('3_align', '3_align_to_references.py', lib_name),
+    ('4_filter', '4_filter_alignments.py', lib_name),
+    ('6_deduplicate', '6_deduplicate_umis.py', lib_name),
+    ('7_count', '7_count_alignments.py', lib_name),
+]
+
+def prepare_inputs(work_dir, n_pairs):
+    """Writes the references, reads and ground truth of a benchmark size (unless they exist)."""
+    reference_filepath = os.path.join(work_dir, '2_references', 'references', 'references.fasta')
+    truth_filepath = os.path.join(work_dir, 'truth.parquet')
+    if os.path.exists(truth_filepath):
+        return read_fasta(reference_filepath), truth_filepath
+    os.makedirs(os.path.dirname(reference_filepath), exist_ok=True)
+    os.makedirs(os.path.join(work_dir, '1_fastq', raw_lib_name), exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+    if reference_fasta is None:
+        references = random_references(n_random_references, random_reference_length, rng, internal_index)
+    else:
+        references = read_fasta(reference_fasta)
+    references = add_variant_references(references, variant_fraction, 150, rng)
+    write_fasta(references, reference_filepath)
+    if use_bwa:
+        subprocess.run(['bwa', 'index', '-p', '2_references/references/', '2_references/references/references.fasta'],
+                       cwd=work_dir, check=True, capture_output=True)
+
+    print(f"Simulating {n_pairs} read pairs at: {datetime.datetime.now()}")
+    fastq_filepaths = [os.path.join(work_dir, '1_fastq', raw_lib_name, f'{raw_lib_name}_{fixed_suffix}_{read}.fq.gz')
+                       for read in (1, 2)]
+    # the truth file is written last, it marks complete inputs
+    simulate_reads(references, *fastq_filepaths, truth_filepath + '.tmp', n_pairs, seed, **simulation_parameters)
+    os.replace(truth_filepath + '.tmp', truth_filepath)
+    return references, truth_filepath
+
+def run_stage(work_dir, stage, script, lib_arg):
+    """Runs a stage script in work_dir. Returns the wall time and the metrics the stage wrote (if any)."""
+    os.makedirs(os.path.join(work_dir, 'log'), exist_ok=True)
+    env = dict(os.environ, PYTHONPATH=script_dir)
+    start = time.perf_counter()
+    with open(os.path.join(work_dir, 'log', f'{stage}.txt'), 'w') as log:
+        subprocess.run([sys.executable, '-u', os.path.join(script_dir, script), lib_arg], cwd=work_dir, env=env,
+                       stdout=log, stderr=subprocess.STDOUT, check=True)
+    wall = time.perf_counter() - start
+    metrics_filepath = os.path.join(work_dir, 'metrics', f'{lib_arg}_{stage}.json')
+    metrics = {}
+    if os.path.exists(metrics_filepath):
+        with open(metrics_filepath) as f:
+            metrics = json.load(f)
+    return wall, metrics
+
+def align_from_ground_truth(work_dir, references, truth_filepath):
+    """Stand-in for stage 3 without bwa. Returns the fraction of exact matches."""
+    split_filepaths = [os.path.join(work_dir, '2_fastq_split_rem_umi', f'{lib_name}_Read{read}.fq.gz')
+                       for read in (1, 2)]
+    bam_filepath = os.path.join(work_dir, '3_alignments', f'{lib_name}.bam')
+    os.makedirs(os.path.dirname(bam_filepath), exist_ok=True)
+    if not exact_match_fast_path:
+        write_truth_alignments(*split_filepaths, truth_filepath, references, bam_filepath)
+        return 0.0
+    reference_store_dir = os.path.join(work_dir, '2_references', 'reference_store')
+    build_reference_store(os.path.join(work_dir, '2_references', 'references', 'references.fasta'),
+                          reference_store_dir, read_1_length, read_2_length)
+    temp_dir = os.path.join(work_dir, 'temp')
+    os.makedirs(temp_dir, exist_ok=True)
+    exact_filepath, truth_bam_filepath = os.path.join(temp_dir, 'exact.bam'), os.path.join(temp_dir, 'truth.bam')
+    miss_filepaths = [os.path.join(temp_dir, f'miss_Read{read}.fq.gz') for read in (1, 2)]
+    n_pairs, n_exact_matches = split_exact_matches(*split_filepaths, reference_store_dir, exact_filepath,
+                                                   *miss_filepaths)
+    write_truth_alignments(*miss_filepaths, truth_filepath, references, truth_bam_filepath)
+    # the alignments of bwa first, then the exact matches, with the query group index (as align_streaming of stage 3)
+    with pysam.AlignmentFile(truth_bam_filepath, 'rb') as truth_in, \
+            pysam.AlignmentFile(bam_filepath, 'wb', template=truth_in) as bam_out:
+        group_index = QueryGroupIndex(bam_out)
+        for filepath in (truth_bam_filepath, exact_filepath):
+            with pysam.AlignmentFile(filepath, 'rb', check_sq=False) as bam_in:
+                for read in bam_in:
+                    group_index.write(read)
+    group_index.save(bam_filepath)
+    for filepath in [exact_filepath, truth_bam_filepath] + miss_filepaths:
+        os.remove(filepath)
+    return n_exact_matches / n_pairs if n_pairs else 0.0
+
+def check_counts(work_dir, references, truth_filepath):
+    """Compares the counts of stage 7 to the molecules that are expected to pass the pipeline."""
+    names = list(references)
+    expected = expected_counts(truth_filepath, len(names))
+    counted = pd.read_csv(os.path.join(work_dir, '6_counts', f'{lib_name}.csv'), index_col=0)['Count'] \
+        .reindex(names, fill_value=0).to_numpy()
+    return {
+        'expected_molecules': int(expected.sum()),
+        'counted_molecules': int(counted.sum()),
+        'exact_reference_fraction': float((expected == counted).mean()),
+        'mean_absolute_error': float(np.abs(expected - counted).mean()),
+        'correlation': float(np.corrcoef(expected, counted)[0, 1]) if expected.std() and counted.std() else 0.0,
+    }
+
+def git_commit():
+    """The commit of the scripts, with '-dirty' if they have uncommitted changes."""
+    commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=script_dir, capture_output=True, text=True)
+    if commit.returncode != 0:
+        return 'unknown'
+    status = subprocess.run(['git', 'status', '--porcelain', '--', '.'], cwd=script_dir, capture_output=True,
+                            text=True)
+    return commit.stdout.strip() + ('-dirty' if status.stdout.strip() else '')
+
+def benchmark_size(n_pairs, commit, timestamp):
+    work_dir = os.path.join(benchmark_dir, str(n_pairs))
+    references, truth_filepath = prepare_inputs(work_dir, n_pairs)
+    rows = []
+    for stage, script, lib_arg in stages:
+        if stage == '3_align' and not use_bwa:
+            # not timed, the alignments come from the ground truth
+            exact_fraction = align_from_ground_truth(work_dir, references, truth_filepath)
+            print(f"Exact matches: {exact_fraction:.2%} of the read pairs")
+            continue
+        print(f"Running {stage} on {n_pairs} read pairs at: {datetime.datetime.now()}")
+        wall, metrics = run_stage(work_dir, stage, script, lib_arg)
+        counters = metrics.get('counters', {})
+        rows.append({'commit': commit, 'timestamp': timestamp, 'n_pairs': n_pairs, 'stage': stage,
+                     'wall_s': wall, 'reads_in': counters.get('reads_in', 0),
+                     'reads_out': counters.get('reads_out', 0), 'pairs_per_s': n_pairs / wall,
+                     'peak_rss_mb': metrics.get('peak_rss_mb'), 'phases': metrics.get('phases', {})})
+    return rows, check_counts(work_dir, references, truth_filepath)
+
+def compare_to_previous(results_df, rows, commit):
+    """Prints the change of the wall times to the last run of another commit."""
+    previous = results_df[results_df['commit'] != commit]
+    for row in rows:
+        matches = previous[(previous['n_pairs'] == row['n_pairs']) & (previous['stage'] == row['stage'])]
+        if len(matches):
+            last = matches.iloc[-1]
+            change = row['wall_s'] / last['wall_s'] - 1
+            print(f"{row['stage']} ({row['n_pairs']} pairs): {row['wall_s']:.1f} s, {change:+.1%} "
+                  f"compared to {last['commit'][:10]}")
+        else:
+            print(f"{row['stage']} ({row['n_pairs']} pairs): {row['wall_s']:.1f} s")
+
+if __name__ == "__main__":
+    sizes = [int(size) for size in sys.argv[1:]] or benchmark_sizes
+    commit = git_commit()
+    timestamp = datetime.datetime.now().isoformat(sep=' ', timespec='seconds')
+    os.makedirs(results_dir, exist_ok=True)
+    results_filepath = os.path.join(results_dir, 'results.csv')
+    results_df = pd.read_csv(results_filepath) if os.path.exists(results_filepath) else pd.DataFrame()
+
+    all_rows, accuracy = [], {}
+    for n_pairs in sizes:
+        rows, accuracy[n_pairs] = benchmark_size(n_pairs, commit, timestamp)
+        print(f"Counts compared to the ground truth ({n_pairs} pairs): {accuracy[n_pairs]}")
+        if len(results_df):
+            compare_to_previous(results_df, rows, commit)
+        all_rows += rows
+
+    with open(os.path.join(results_dir, f"{timestamp.replace(' ', '_').replace(':', '')}_{commit[:10]}.json"),
+              'w') as f:
+        json.dump({'commit': commit, 'timestamp': timestamp, 'use_bwa': use_bwa,
+                   'simulation_parameters': simulation_parameters, 'stages': all_rows,
+                   'accuracy': {str(n_pairs): values for n_pairs, values in accuracy.items()}}, f, indent=1)
+    new_results_df = pd.DataFrame([{key: value for key, value in row.items() if key != 'phases'}
+                                   for row in all_rows])
+    pd.concat([results_df, new_results_df], ignore_index=True).to_csv(results_filepath, index=False)
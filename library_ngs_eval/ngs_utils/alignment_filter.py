@@ -0,0 +1,855 @@
+import datetime
+import os
+import concurrent.futures
+import functools
+import json
+import numpy as np
+import pandas
+import re
+import time
+import pysam
+import parasail
+from .reference_store import open_reference_store, check_reference_store, forward_window, reverse_window, \
+    reference_sequence, difference_positions
+from .exact_match import exact_match_tag
+para_gap_open_penalty = 5
+para_gap_extension_penalty = 1
+
+# This assumes the bwa aligner. If you use a different aligner, you may need to change this.
+dist_threshold = 5
+insertion_threshold = 2
+deletion_threshold = 2
+read_1_length = 150
+read_2_length = 140
+
+# Most read pairs are exact or near-exact duplicates, so edit distances are cached (LRU) per process.
+# An entry holds the read, its quality mask and the reference window, roughly 1 kB for 150 nt reads.
+# The memory is shared by all processes of a stage that filter at the same time (see set_edit_distance_cache_size).
+edit_distance_cache_memory = 512 * 1024**2
+edit_distance_cache_entry_size = 1024
+
+# Unit costs for the lower bound of the edit distance: mismatches and gaps cost 1, N matches everything.
+# (the striped parasail kernels are not exact if the gap open and extension penalties are equal)
+unit_cost_matrix = parasail.matrix_create("ACGTN", 0, -1)
+for base in range(4):
+    unit_cost_matrix[base, 4] = 0
+    unit_cost_matrix[4, base] = 0
+min_bound_segment_length = 8
+
+# True: read pairs with equal scores for near-identical references (see the difference index of reference_store)
+# are assigned to the reference that the reads match best at the positions where these references differ.
+# Mismatches cost their base quality, the lowest cost has to be unique. Low quality bases are ignored
+# (as in the quality mask of compute_edit_distance).
+resolve_near_identical = True
+
+# columns of the per reference overview, rows of the per-read table are written in batches of this size
+# (resolved_near_identical pairs are also counted as aligned or discard_edit_distance)
+overview_columns = ['aligned', 'discard_edit_distance', 'discarded_not_both', 'discarded_multiple_as',
+                    'resolved_near_identical']
+read_table_batch_size = 100000
+
+# Stage 3 writes the virtual file offset of every query_group_interval-th query group next to the BAM file
+# (see QueryGroupIndex), the chunks of process_bam_file_parallel start at these offsets instead of a scan of the file.
+query_group_interval = 10000
+
+def MD_to_edit_distance(MD_tag):
+    # Extracting edit distance from MD tag
+    # Example: MD:Z:7C3C6C7T105
+    # Find all numbers in the MD:Z string, which represent lengths of matches
+    match_lengths = re.findall(r'\d+', MD_tag)
+    
+    # Convert the found strings to integers and sum them up to get the total number of matches
+    total_matches = sum(int(length) for length in match_lengths)
+    
+    return total_matches
+
+def compute_edit_distance(query, quality, reference, inverse=False, max_distance=None):
+    # the edit distance only depends on the quality through the quality mask
+    quality_mask = bytes(q > 20 for q in quality)
+    return masked_edit_distance(query, quality_mask, reference, inverse, max_distance)
+
+def get_stop_point(quality_mask):
+    # is there a point where there are three consecutive parts with poor read quality (false in quality mask)?
+    # if so, we will stop the alignment there
+    stop_point = None
+    for i in range(len(quality_mask) - 2):
+        if not quality_mask[i] and not quality_mask[i + 1] and not quality_mask[i + 2]:
+            stop_point = i
+            break
+    if stop_point is None:
+        stop_point = len(quality_mask)
+    return stop_point
+
+def edit_distance_lower_bound(query, quality_mask, reference, stop_point, max_distance):
+    """Lower bound of the edit distance counted by masked_edit_distance that gives up once max_distance is exceeded.
+
+    Low quality bases, Ns and gaps in the query in front of low quality bases are not counted, so the query
+    before the stop point is split into runs of counted bases. Each run is aligned to the reference with
+    unit costs for mismatches and indels, the first run from the start of the reference and the others anywhere.
+    The sum can not be larger than the count on any alignment of the whole read."""
+    lower_bound = 0
+    for run in re.finditer(b"\x01+", quality_mask[:stop_point]):
+        start = run.start()
+        for segment in query[start:run.end()].split("N"):
+            # very short runs hardly ever add to the bound
+            if len(segment) >= min_bound_segment_length:
+                align = parasail.sg_de_scan_16 if start == 0 else parasail.sg_dx_scan_16
+                lower_bound -= align(segment, reference, 1, 1, unit_cost_matrix).score
+                if lower_bound > max_distance:
+                    return lower_bound
+            start += len(segment) + 1
+    return lower_bound
+
+@functools.lru_cache(maxsize=edit_distance_cache_memory // edit_distance_cache_entry_size)
+def masked_edit_distance(query, quality_mask, reference, inverse=False, max_distance=None):
+    """Counts the high quality mismatches and indels of a global alignment of query and reference.
+    If max_distance is given, reads that can not reach max_distance or less are short-circuited:
+    the return value is then only guaranteed to be larger than max_distance."""
+    if inverse:
+        query = query[::-1]
+        reference = reference[::-1]
+        quality_mask = quality_mask[::-1]
+    
+    stop_point = get_stop_point(quality_mask)
+
+    # perfect reads do not need to be aligned
+    if query == reference:
+        return 0
+    # reads that are far off are discarded without the traceback
+    if max_distance is not None:
+        lower_bound = edit_distance_lower_bound(query, quality_mask, reference, stop_point, max_distance)
+        if lower_bound > max_distance:
+            return lower_bound
+
+    # Perform a global alignment
+    result = parasail.nw_trace_striped_32(query, reference, para_gap_open_penalty, para_gap_extension_penalty, parasail.dnafull)
+    aligned_query, aligned_reference = result.traceback.query, result.traceback.ref
+    
+    # Initialize edit distance
+    edit_distance = 0
+    # Track the current position in the original query sequence
+    query_pos = 0
+    
+    for q, r in zip(aligned_query, aligned_reference):
+        if query_pos == stop_point or query_pos == len(query):
+            break
+        # Check for alignment gaps
+        if q == "-":
+            # Increase edit distance for indels if they occur in high-quality regions
+            if quality_mask[query_pos]:
+                edit_distance += 1
+        else:
+            # For mismatches (or gaps in the reference), consider the quality score
+            if quality_mask[query_pos] and q != r and q != "N" and r != "N":
+                edit_distance += 1
+            # Increment query_pos only if there's no gap in the query
+            query_pos += 1
+    
+    return edit_distance
+
+def set_edit_distance_cache_size(n_processes):
+    """Sizes the edit distance cache of this process for n_processes processes that filter at the same time,
+    each gets an equal share of edit_distance_cache_memory. The cache is emptied."""
+    global masked_edit_distance
+    max_entries = max(edit_distance_cache_memory // edit_distance_cache_entry_size // n_processes, 1)
+    masked_edit_distance = functools.lru_cache(maxsize=max_entries)(masked_edit_distance.__wrapped__)
+
+def edit_distance_cache_counts():
+    """Returns the hits and misses of the edit distance cache of this process."""
+    cache_info = masked_edit_distance.cache_info()
+    return cache_info.hits, cache_info.misses
+
+def get_insertions_and_deletions(CIGAR_tag):
+    # Extracting insertions and deletions from CIGAR tag
+    # Example: CIGAR: 150M1I140M
+    # Find all numbers in the CIGAR string, which represent lengths of matches, insertions, and deletions
+    match_lengths = re.findall(r'\d+', CIGAR_tag)
+    
+    # Find all letters in the CIGAR string, which represent operations
+    operations = re.findall(r'[A-Z]', CIGAR_tag)
+    
+    # Get the indices of insertions and deletions
+    insertion_indices = [i for i, operation in enumerate(operations) if operation == 'I']
+    deletion_indices = [i for i, operation in enumerate(operations) if operation == 'D']
+    
+    # Get the lengths of insertions and deletions
+    insertion_lengths = [int(match_lengths[i]) for i in insertion_indices]
+    deletion_lengths = [int(match_lengths[i]) for i in deletion_indices]
+    
+    total_insertions = sum(insertion_lengths)
+    total_deletions = sum(deletion_lengths)
+    
+    return total_insertions, total_deletions
+
+def print_alignment_details(alignments, label):
+    print(f"Details of {label}:")
+    if alignments:
+        for i, alignment in enumerate(alignments):
+            print(f"Alignment {i+1}:")
+            print(f"  Query Name: {alignment.query_name}")
+            print(f"  Reference Name: {alignment.reference_name}")
+            print(f"  Query Sequence: {alignment.query_sequence}")
+            print(f"  Query Qualities: {alignment.query_qualities}")
+            print(f"  Alignment Flag: {alignment.flag}")
+            print(f"  Mapping Quality: {alignment.mapping_quality}")
+            print(f"  Position: {alignment.reference_start}")
+            print(f"  CIGAR String: {alignment.cigarstring}")
+    else:
+        print("No alignments found.")
+
+def interpret_sam_flag(flag_value):
+    flags = {
+        0x1: "The read is part of a pair",
+        0x2: "Both reads of the pair are properly aligned",
+        0x4: "The read is unmapped",
+        0x8: "The mate is unmapped",
+        0x10: "The read is mapped to the reverse strand",
+        0x20: "The mate is mapped to the reverse strand",
+        0x40: "This is the first read in the pair",
+        0x80: "This is the second read in the pair",
+        0x100: "The read is not primary (secondary alignment)",
+        0x200: "The read fails platform/vendor quality checks",
+        0x400: "The read is PCR or optical duplicate"
+    }
+
+    print(f"FLAG: {flag_value} (binary: {bin(flag_value)})")
+    for bitmask, description in flags.items():
+        if flag_value & bitmask:
+            print(f"- {description}")
+
+# Note: Structure of a SAM alignment line:
+# 0: QNAME ; Query template NAME: The name of the read or the read pair that was aligned. Read pairs have the same QNAME.
+# 1: FLAG ; Bitwise FLAG: Flags indicating the alignment state of the read pair. See section 1.4 and section 2.1.
+# 2: RNAME ; Reference sequence NAME: Name of the sequence in the reference genome.
+# 3: POS ; 1-based leftmost mapping POSition: The leftmost coordinate of the clipped sequence.
+# 4: MAPQ ; MAPping Quality: MAPQ = −10 log10 Pr{mapping position is wrong}, rounded to the nearest integer. I can ignore this for this type of analysis.
+# 5: CIGAR ; CIGAR string: Compact Idiosyncratic Gapped Alignment Report. Describes the alignment in detail. Look at this later to see if I need it.
+# 6: RNEXT ; Ref. name of the mate/next read: Refers to the name of the reference sequence in the next read in the template.
+# This field is set as ‘=’ when the other read in the template has the same RNAME value (see also RNEXT and PNEXT).
+# This field is set as ‘*’ when the information is unavailable, or when the next read does not map to the same reference.
+# 7: PNEXT ; Position of the mate/next read: The position of the primary alignment of the next read in the template. Should be 1 for my library.
+# 8: TLEN ; observed Template LENgth: The observed template length.
+# The sign of this field is determined by the relative strand orientations. (Should be 204 and -204 for my library.)
+# 9: SEQ ; segment SEQuence: The primary read sequence. This field can be a ‘*’ when the sequence is not stored.
+# 10: QUAL ; ASCII of Phred-scaled base QUALity+33: The base quality scores. This field can be a ‘*’ when the quality is not stored.
+# 11+: OPT ; variable OPTional fields in the format TAG:VTYPE:VALUE: Optional fields in the format TAG:VTYPE:VALUE.
+# 11: NM ; Edit distance to the reference: The edit distance (NM tag) equals the minimum number of edits needed to transform the read sequence into the reference sequence.
+# 12: MD ; String for mismatching positions: This field describes the mismatching positions.
+# 13: MC ; CIGAR string for mate/next read: CIGAR string for the mate/next read (MC tag). This field is set as ‘*’ when the information is unavailable.
+# 14: AS ; Alignment Score: AS is the alignment score generated by the aligner. This can be very similar for clearly different alignments given I look at one nt mutations.
+# 15: XS ; Suboptimal Alignment Score: XS is the suboptimal alignment score generated by the aligner.
+
+def get_alignment_score(alignment):
+    # Extracting AS tag from alignment
+    return alignment.get_tag('AS')
+
+def first_read_sequence(alignments):
+    # secondary alignments may lack the sequence, take the first alignment with qualities
+    for alignment in alignments:
+        if alignment.query_qualities:
+            return alignment.query_sequence, alignment.query_qualities
+    return None, None
+
+def resolve_by_difference_positions(alignment_lists, reference_store):
+    """Returns the reference id that a read pair (the alignments of each mate, or of a merged read) matches best
+    at the positions where the near-identical references it is aligned to (with all mates) differ,
+    or -1 if these are not near-identical or tie."""
+    candidates = sorted(set.intersection(*({alignment.reference_id for alignment in alignments
+                                             if not alignment.is_unmapped} for alignments in alignment_lists)))
+    if len(candidates) < 2:
+        return -1
+    groups = reference_store['difference_groups']
+    group = groups[candidates[0]]
+    if group == -1 or any(groups[reference_id] != group for reference_id in candidates):
+        return -1
+    read_sequences = [first_read_sequence(alignments) for alignments in alignment_lists]
+    if any(read_seq is None for read_seq, _ in read_sequences):
+        return -1
+
+    # the bases of each mate at the difference positions, as aligned to each candidate (indels shift them)
+    positions = set(difference_positions(reference_store, group).tolist())
+    costs = []
+    for reference_id in candidates:
+        sequence = reference_store['sequences'][reference_id]
+        cost = 0
+        for alignments, (read_seq, read_qual) in zip(alignment_lists, read_sequences):
+            alignment = next(alignment for alignment in alignments if alignment.reference_id == reference_id)
+            for query_position, position in alignment.get_aligned_pairs(matches_only=True):
+                if position in positions and read_qual[query_position] > 20 \
+                        and read_seq[query_position] != chr(sequence[position]):
+                    cost += read_qual[query_position]
+        costs.append(cost)
+    best_cost = min(costs)
+    if costs.count(best_cost) > 1:
+        return -1
+    return candidates[costs.index(best_cost)]
+
+def process_single_end_alignments(alignments, lib_name, reference_store):
+    # merged reads (2_merge_mates.py) cover the whole reference in reference orientation
+    aligned, discard_edit_distance, discarded_not_both, discarded_multiple_as = False, False, False, False
+    resolved_near_identical = False
+    valid_alignments = []
+    edit_distance = 500
+
+    # a merged read that is not aligned on the forward strand counts as not aligned (discarded_not_both)
+    alignments_top = [alignment for alignment in alignments if not alignment.is_reverse and not alignment.is_unmapped]
+    alignment_scores = [get_alignment_score(alignment) for alignment in alignments_top]
+    max_score = max(alignment_scores, default=0)
+    max_indices = [i for i, score in enumerate(alignment_scores) if score == max_score]
+
+    max_index = -1
+    if len(max_indices) == 0:
+        discarded_not_both = True
+    elif len(max_indices) == 1:
+        max_index = max_indices[0]
+    else:
+        reference_id = resolve_by_difference_positions([alignments_top], reference_store) \
+            if resolve_near_identical else -1
+        if reference_id != -1:
+            max_index = [alignment.reference_id for alignment in alignments_top].index(reference_id)
+            resolved_near_identical = True
+        else:
+            discarded_multiple_as = True
+
+    if max_index != -1:
+        read_seq, read_qual = first_read_sequence(alignments)
+        if read_seq is None:
+            # no alignment carries qualities, the edit distance can not be computed
+            discard_edit_distance = True
+        else:
+            reference_id = alignments_top[max_index].reference_id
+            edit_distance = compute_edit_distance(read_seq, list(read_qual),
+                                                  reference_sequence(reference_store, reference_id), inverse=False,
+                                                  max_distance=dist_threshold - 1)
+            insertions, deletions = get_insertions_and_deletions(alignments_top[max_index].cigarstring)
+            if edit_distance < dist_threshold and insertions < insertion_threshold \
+                    and deletions < deletion_threshold:
+                aligned = True
+                valid_alignments.append(alignments_top[max_index])
+            else:
+                discard_edit_distance = True
+
+    return aligned, valid_alignments, edit_distance, discard_edit_distance, discarded_not_both, discarded_multiple_as, \
+        resolved_near_identical
+
+def process_alignments(alignments, lib_name, reference_store):
+    # read pairs of the exact match fast path of stage 3 match their reference, they are not compared again
+    if alignments[0].has_tag(exact_match_tag):
+        return True, list(alignments), 0, False, False, False, False
+    if not alignments[0].is_paired:
+        return process_single_end_alignments(alignments, lib_name, reference_store)
+
+    # Process alignments
+    aligned, discard_edit_distance, discarded_not_both, discarded_multiple_as = False, False, False, False
+    valid_alignments = []
+    edit_distance = 500
+    
+    # Get top and bottom strand alignments
+    alignments_top = [alignment for alignment in alignments if not alignment.is_reverse]
+    alignments_bottom = [alignment for alignment in alignments if alignment.is_reverse]
+    
+    # Get top and bottom strand alignment scores
+    alignment_scores_top = [get_alignment_score(alignment) for alignment in alignments_top]
+    alignment_scores_bottom = [get_alignment_score(alignment) for alignment in alignments_bottom]
+
+    # Find max alignment scores and their indices
+    max_score_top = max(alignment_scores_top, default=0)
+    max_score_bottom = max(alignment_scores_bottom, default=0)
+    
+    # find the index of the alignments with the highest score (there may be multiple)
+    max_indices_top = [i for i, score in enumerate(alignment_scores_top) if score == max_score_top]
+    max_indices_bottom = [i for i, score in enumerate(alignment_scores_bottom) if score == max_score_bottom]
+    
+    # check if there are multiple alignments with the same score for both the top and bottom strand
+    if (len(max_indices_top) > 1) and (len(max_indices_bottom) > 1):
+        discarded_multiple_as = True
+        max_index_top = -1
+        max_index_bottom = -1
+    elif (len(max_indices_top) > 1) and (len(max_indices_bottom) == 1):
+        max_index_bottom = max_indices_bottom[0]
+        # get the rname of the bottom strand alignment
+        rname_bottom = alignments_bottom[max_index_bottom].reference_name
+        rnames_top = [alignments_top[i].reference_name for i in max_indices_top]
+        try:
+            max_index_top = rnames_top.index(rname_bottom)
+        except ValueError:
+            max_index_top = -1
+            discarded_not_both = True
+    elif (len(max_indices_top) == 1) and (len(max_indices_bottom) > 1):
+        max_index_top = max_indices_top[0]
+        # get the rname of the top strand alignment
+        rname_top = alignments_top[max_index_top].reference_name
+        rnames_bottom = [alignments_bottom[i].reference_name for i in max_indices_bottom]
+        try:
+            max_index_bottom = rnames_bottom.index(rname_top)
+        except ValueError:
+            max_index_bottom = -1
+            discarded_not_both = True
+    elif (len(max_indices_top) < 1) or (len(max_indices_bottom) < 1):
+        max_index_bottom = -1
+        max_index_top = -1
+        discarded_not_both = True
+    else:
+        max_index_top = max_indices_top[0]
+        max_index_bottom = max_indices_bottom[0]
+        
+        # do these align to the same reference?
+        if alignments_top[max_index_top].reference_name != alignments_bottom[max_index_bottom].reference_name:
+            discarded_not_both = True
+            max_index_top = -1
+            max_index_bottom = -1
+
+    # near-identical references get equal scores, the positions where they differ decide between them
+    resolved_near_identical = False
+    if resolve_near_identical and (discarded_multiple_as or discarded_not_both) and alignments_top \
+            and alignments_bottom:
+        reference_id = resolve_by_difference_positions([alignments_top, alignments_bottom], reference_store)
+        if reference_id != -1:
+            max_index_top = [alignment.reference_id for alignment in alignments_top].index(reference_id)
+            max_index_bottom = [alignment.reference_id for alignment in alignments_bottom].index(reference_id)
+            discarded_multiple_as, discarded_not_both = False, False
+            resolved_near_identical = True
+        
+    if (max_index_top != -1) and (max_index_bottom != -1):        
+        # get the read sequences and quality scores
+        try:
+            for alignment_top in alignments_top:
+                read1_seq = str(alignment_top.query_sequence)
+                read1_qual = alignment_top.query_qualities
+                if read1_qual:
+                    read1_qual = [q for q in read1_qual]
+                    break
+            for alignment_bottom in alignments_bottom:
+                read2_seq = str(alignment_bottom.query_sequence)
+                read2_qual = alignment_bottom.query_qualities
+                if read2_qual:
+                    read2_qual = [q for q in read2_qual]
+                    break
+        except TypeError:
+            print_alignment_details(alignments_top, "alignments_top")
+            print_alignment_details(alignments_bottom, "alignments_bottom")
+        
+        reference_id = alignments_top[max_index_top].reference_id
+
+        # only edit distances below dist_threshold are needed exactly, the rest is short-circuited
+        edit_distance_top = compute_edit_distance(read1_seq, read1_qual, forward_window(reference_store, reference_id),
+                                                  inverse=False, max_distance=dist_threshold - 1)
+        if edit_distance_top < dist_threshold:
+            # read 2 is compared from its end, the reverse window of the store is already reversed
+            edit_distance_bottom = compute_edit_distance(read2_seq[::-1], read2_qual[::-1],
+                                                         reverse_window(reference_store, reference_id), inverse=False,
+                                                         max_distance=dist_threshold - 1 - edit_distance_top)
+        else:
+            edit_distance_bottom = 0
+        
+        # get the sum of the edit distance for the top and bottom strand alignments
+        edit_distance = edit_distance_top + edit_distance_bottom
+        
+        # ---------------------------------------------------------
+        # get the CIGAR tag for the top and bottom strand alignments
+        CIGAR_top = alignments_top[max_index_top].cigarstring
+        CIGAR_bottom = alignments_bottom[max_index_bottom].cigarstring
+        
+        insertions_top, deletions_top = get_insertions_and_deletions(CIGAR_top)
+        insertions_bottom, deletions_bottom = get_insertions_and_deletions(CIGAR_bottom)
+        
+        # get the sum of the insertions and deletions for the top and bottom strand alignments
+        insertions = insertions_top + insertions_bottom
+        deletions = deletions_top + deletions_bottom
+        
+        # if it is below edit_dist_threshold, then it is a valid alignment
+        if edit_distance < dist_threshold and insertions < insertion_threshold and deletions < deletion_threshold:
+            aligned = True
+            # append the top strand alignment
+            valid_alignments.append(alignments_top[max_index_top])
+            # append the bottom strand alignments
+            valid_alignments.append(alignments_bottom[max_index_bottom])
+        else:
+            discard_edit_distance = True
+            
+    return aligned, valid_alignments, edit_distance, discard_edit_distance, discarded_not_both, discarded_multiple_as, \
+        resolved_near_identical
+
+def iterate_query_groups(bam_in, end_offset=None):
+    """Yields the alignments of a name-grouped BAM file (bwa output) as lists with the same query name.
+    If end_offset is given, stops at the first query group that starts at or after this virtual file offset."""
+    current_qname = None
+    alignments = []
+    while end_offset is None or bam_in.tell() < end_offset:
+        try:
+            read = next(bam_in)
+        except StopIteration:
+            break
+        # Check if this is a new query name
+        if read.query_name != current_qname and alignments:
+            yield alignments
+            # Reset for the next set of alignments
+            alignments = []
+
+        # Add the read to the current alignments and update current_qname
+        alignments.append(read)
+        current_qname = read.query_name
+    if alignments:
+        yield alignments
+
+def find_chunk_offsets(input_filepath, chunk_size):
+    """Scans a name-grouped BAM file and returns the virtual file offsets at which chunks of chunk_size
+    query groups start. Chunks never split a query group."""
+    offsets = []
+    n_groups = 0
+    current_qname = None
+    with pysam.AlignmentFile(input_filepath, "rb") as bam_in:
+        offset = bam_in.tell()
+        for read in bam_in:
+            if read.query_name != current_qname:
+                if n_groups % chunk_size == 0:
+                    offsets.append(offset)
+                n_groups += 1
+                current_qname = read.query_name
+            offset = bam_in.tell()
+    return offsets
+
+def query_group_index_filepath(bam_filepath):
+    return bam_filepath + '.groups.json'
+
+class QueryGroupIndex:
+    """Writes the records of a name-grouped BAM file and collects the virtual file offset of every
+    interval-th query group. save writes them to query_group_index_filepath with the size and modification time
+    of the closed BAM file, which load_chunk_offsets checks."""
+    def __init__(self, bam_out, interval=query_group_interval):
+        self.bam_out = bam_out
+        self.interval = interval
+        self.offsets = []
+        self.n_groups = 0
+        self.current_qname = None
+
+    def write(self, read):
+        if read.query_name != self.current_qname:
+            if self.n_groups % self.interval == 0:
+                self.offsets.append(self.bam_out.tell())
+            self.n_groups += 1
+            self.current_qname = read.query_name
+        self.bam_out.write(read)
+
+    def save(self, bam_filepath):
+        bam_stat = os.stat(bam_filepath)
+        with open(query_group_index_filepath(bam_filepath), 'w') as f:
+            json.dump({'bam_size': bam_stat.st_size, 'bam_mtime_ns': bam_stat.st_mtime_ns, 'interval': self.interval,
+                       'n_groups': self.n_groups, 'offsets': self.offsets}, f)
+
+def load_chunk_offsets(input_filepath, chunk_size):
+    """Returns the virtual file offsets of chunks of about chunk_size query groups (a multiple of the interval
+    of the index, at least one interval) from the query group index of a BAM file, or None if there is no index
+    or the BAM file changed after it was written."""
+    index_filepath = query_group_index_filepath(input_filepath)
+    if not os.path.exists(index_filepath):
+        return None
+    with open(index_filepath) as f:
+        index = json.load(f)
+    bam_stat = os.stat(input_filepath)
+    if (index['bam_size'], index['bam_mtime_ns']) != (bam_stat.st_size, bam_stat.st_mtime_ns):
+        return None
+    return index['offsets'][::max(round(chunk_size / index['interval']), 1)]
+
+def new_filter_stats(n_references):
+    """Returns the statistics counters of filter_query_groups for a BAM file with n_references references.
+    The overview counters are an array with one row per reference id (the last row holds unmapped reads)
+    and one column per entry of overview_columns. The time_ entries are the seconds spent reading the query groups,
+    computing the edit distances (process_alignments) and writing the results, time_chunk_offsets_s the seconds
+    spent finding the chunks of process_bam_file_parallel.
+    n_exact_matches counts the read pairs of the exact match fast path of stage 3 (included in n_aligned)."""
+    return {
+        'n_seqs': 0,
+        'n_aligned': 0,
+        'n_exact_matches': 0,
+        'n_discarded_multiple_as': 0,
+        'n_discarded_not_both': 0,
+        'n_discarded_edit_distance': 0,
+        'n_resolved_near_identical': 0,
+        'n_edit_distance_cache_hits': 0,
+        'n_edit_distance_cache_misses': 0,
+        'time_read_s': 0.0,
+        'time_filter_s': 0.0,
+        'time_write_s': 0.0,
+        'time_chunk_offsets_s': 0.0,
+        'overview_counts': np.zeros((n_references + 1, len(overview_columns)), dtype=np.int64),
+    }
+
+def open_read_table(filepath):
+    """Opens a parquet file for the per-read results of filter_query_groups."""
+    # pyarrow is only needed for the per-read table
+    import pyarrow
+    import pyarrow.parquet
+    schema = pyarrow.schema([
+        ('query_name', pyarrow.string()),
+        ('reference_name', pyarrow.string()),
+        ('aligned', pyarrow.bool_()),
+        ('edit_distance', pyarrow.int32()),
+        ('discarded_not_both', pyarrow.bool_()),
+        ('discard_edit_distance', pyarrow.bool_()),
+        ('discarded_multiple_as', pyarrow.bool_()),
+        ('resolved_near_identical', pyarrow.bool_()),
+    ])
+    return pyarrow.parquet.ParquetWriter(filepath, schema)
+
+def write_read_table_rows(read_table, rows):
+    """Writes the collected rows (a dictionary of column lists) to the read table as one row group and clears them."""
+    import pyarrow
+    read_table.write_table(pyarrow.table(rows, schema=read_table.schema))
+    for column in rows.values():
+        column.clear()
+
+def concatenate_read_tables(part_filepaths, filepath):
+    """Copies the row groups of several parquet files in order to a single file."""
+    import pyarrow.parquet
+    with open_read_table(filepath) as read_table:
+        for part_filepath in part_filepaths:
+            part = pyarrow.parquet.ParquetFile(part_filepath)
+            for i in range(part.num_row_groups):
+                read_table.write_table(part.read_row_group(i))
+
+def filter_query_groups(query_groups, lib_name, reference_store_dir, n_references, bam_out=None, aligned_callback=None,
+                        read_table_filepath=None):
+    """Filters query groups with process_alignments. Valid read pairs are written to bam_out
+    and passed to aligned_callback if given.
+    The result for each read is streamed to a parquet file if read_table_filepath is given.
+    Returns the statistics counters (see new_filter_stats)."""
+    reference_store = open_reference_store(reference_store_dir)
+    stats = new_filter_stats(n_references)
+    overview_counts = stats['overview_counts']
+    cache_hits_start, cache_misses_start = edit_distance_cache_counts()
+
+    read_table = open_read_table(read_table_filepath) if read_table_filepath else None
+    rows = {name: [] for name in read_table.schema.names} if read_table is not None else None
+
+    # the phases of each query group are timed, this costs well below a microsecond per read pair
+    phase_end = time.perf_counter()
+    for alignments in query_groups:
+        read_end = time.perf_counter()
+        stats['time_read_s'] += read_end - phase_end
+        stats['n_seqs'] += 1
+        
+        if stats['n_seqs'] % 1000000 == 0:
+            print(f"Processed {stats['n_seqs']} reads of {lib_name}...")
+        
+        # Process the collected alignments
+        aligned, valid_alignments, edit_distance, discard_edit_distance, discarded_not_both, discarded_multiple_as, \
+            resolved_near_identical = process_alignments(alignments, lib_name, reference_store)
+        filter_end = time.perf_counter()
+        stats['time_filter_s'] += filter_end - read_end
+            
+        if aligned:
+            # Write valid alignments to output BAM file
+            if bam_out is not None:
+                for valid_alignment in valid_alignments:
+                    bam_out.write(valid_alignment)
+            if aligned_callback is not None:
+                aligned_callback(valid_alignments)
+            stats['n_aligned'] += 1
+            if alignments[0].has_tag(exact_match_tag):
+                stats['n_exact_matches'] += 1
+            
+        if discarded_multiple_as:
+            stats['n_discarded_multiple_as'] += 1
+        if discard_edit_distance:
+            stats['n_discarded_edit_distance'] += 1
+        if discarded_not_both:
+            stats['n_discarded_not_both'] += 1
+        if resolved_near_identical:
+            stats['n_resolved_near_identical'] += 1
+
+        # per reference counters (reference id -1 of unmapped reads is the last row)
+        reference_counts = overview_counts[alignments[0].reference_id]
+        reference_counts[0] += aligned
+        reference_counts[1] += discard_edit_distance
+        reference_counts[2] += discarded_not_both
+        reference_counts[3] += discarded_multiple_as
+        reference_counts[4] += resolved_near_identical
+
+        if read_table is not None:
+            rows['query_name'].append(alignments[0].query_name)
+            rows['reference_name'].append(alignments[0].reference_name)
+            rows['aligned'].append(aligned)
+            rows['edit_distance'].append(edit_distance)
+            rows['discarded_not_both'].append(discarded_not_both)
+            rows['discard_edit_distance'].append(discard_edit_distance)
+            rows['discarded_multiple_as'].append(discarded_multiple_as)
+            rows['resolved_near_identical'].append(resolved_near_identical)
+            if len(rows['query_name']) == read_table_batch_size:
+                write_read_table_rows(read_table, rows)
+        phase_end = time.perf_counter()
+        stats['time_write_s'] += phase_end - filter_end
+
+    if read_table is not None:
+        if rows['query_name']:
+            write_read_table_rows(read_table, rows)
+        read_table.close()
+
+    cache_hits, cache_misses = edit_distance_cache_counts()
+    stats['n_edit_distance_cache_hits'] = cache_hits - cache_hits_start
+    stats['n_edit_distance_cache_misses'] = cache_misses - cache_misses_start
+
+    return stats
+
+def process_bam_chunk(input_filepath, start_offset, end_offset, output_filepath, lib_name, reference_store_dir,
+                      read_table_filepath=None):
+    """Filters the query groups of a BAM file between two virtual file offsets (see find_chunk_offsets)
+    and writes the valid read pairs to output_filepath."""
+    with pysam.AlignmentFile(input_filepath, "rb") as bam_in, \
+            pysam.AlignmentFile(output_filepath, "wb", template=bam_in) as bam_out:
+        bam_in.seek(start_offset)
+        stats = filter_query_groups(iterate_query_groups(bam_in, end_offset), lib_name, reference_store_dir,
+                                    bam_in.nreferences, bam_out, read_table_filepath=read_table_filepath)
+    print(f"Processed a chunk of {stats['n_seqs']} reads of {lib_name}...")
+    return stats
+
+def process_bam_file_parallel(input_filepath, output_filepath, lib_name, reference_store_dir, align_output_dir,
+                              n_workers, chunk_size, aligned_callback=None, read_table_filepath=None,
+                              n_library_processes=1):
+    """Splits a name-grouped BAM file into chunks of chunk_size query groups and filters them in a process pool.
+    The chunk outputs and statistics are merged in file order, so the result does not depend on n_workers.
+    The edit distance cache memory is shared by the workers of n_library_processes libraries.
+    The chunks start at the offsets of the query group index of stage 3 (see QueryGroupIndex), files without an
+    index are scanned in this process first (find_chunk_offsets)."""
+    offsets_start = time.perf_counter()
+    offsets = load_chunk_offsets(input_filepath, chunk_size)
+    if offsets is None:
+        print(f"No query group index for {input_filepath}, scanning it for the chunk offsets")
+        offsets = find_chunk_offsets(input_filepath, chunk_size)
+    time_chunk_offsets = time.perf_counter() - offsets_start
+    part_filepaths = [os.path.join(align_output_dir, f"{lib_name}_filter_part{i}.bam") for i in range(len(offsets))]
+    table_part_filepaths = [os.path.join(align_output_dir, f"{lib_name}_alignment_stats_part{i}.parquet")
+                            if read_table_filepath else None for i in range(len(offsets))]
+    end_offsets = offsets[1:] + [None]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers, initializer=set_edit_distance_cache_size,
+                                                initargs=(n_library_processes * n_workers,)) as executor:
+        futures = [executor.submit(process_bam_chunk, input_filepath, start_offset, end_offset,
+                                   part_filepath, lib_name, reference_store_dir, table_part_filepath)
+                   for start_offset, end_offset, part_filepath, table_part_filepath
+                   in zip(offsets, end_offsets, part_filepaths, table_part_filepaths)]
+        results = [future.result() for future in futures]
+
+    # merge the statistics in chunk order
+    with pysam.AlignmentFile(input_filepath, "rb") as bam_in:
+        stats = new_filter_stats(bam_in.nreferences)
+    for result in results:
+        for key in stats:
+            stats[key] += result[key]
+    stats['time_chunk_offsets_s'] = time_chunk_offsets
+
+    # the valid read pairs of each chunk are passed on in file order
+    if aligned_callback is not None:
+        for part_filepath in part_filepaths:
+            with pysam.AlignmentFile(part_filepath, "rb") as part_in:
+                for valid_alignments in iterate_query_groups(part_in):
+                    aligned_callback(valid_alignments)
+
+    if output_filepath:
+        if part_filepaths:
+            pysam.cat("-o", output_filepath, *part_filepaths)
+        else:
+            with pysam.AlignmentFile(input_filepath, "rb") as bam_in:
+                pysam.AlignmentFile(output_filepath, "wb", template=bam_in).close()
+    if read_table_filepath:
+        concatenate_read_tables(table_part_filepaths, read_table_filepath)
+    for part_filepath in part_filepaths + [path for path in table_part_filepaths if path]:
+        os.remove(part_filepath)
+
+    return stats
+
+def add_filter_metrics(metrics, stats):
+    """Adds the read counters, phase times and cache hits of filter statistics to a StageMetrics object.
+    The phase times are summed over the worker processes (chunk_offsets: the time before they start)."""
+    metrics.count('reads_in', stats['n_seqs'])
+    metrics.count('aligned', stats['n_aligned'])
+    metrics.count('exact_matches', stats['n_exact_matches'])
+    metrics.count('resolved_near_identical', stats['n_resolved_near_identical'])
+    for phase in ['read', 'filter', 'write']:
+        metrics.add_time(phase, stats[f'time_{phase}_s'], calls=stats['n_seqs'])
+    if stats['time_chunk_offsets_s']:
+        metrics.add_time('chunk_offsets', stats['time_chunk_offsets_s'])
+    n_cache_hits = stats['n_edit_distance_cache_hits']
+    metrics.cache('edit_distance', n_cache_hits, n_cache_hits + stats['n_edit_distance_cache_misses'])
+
+def write_alignment_overview(overview_counts, reference_names, filepath):
+    """Writes the per reference counters of new_filter_stats for the references with reads
+    (unmapped reads are listed as '*')."""
+    alignment_df_overview = pandas.DataFrame(overview_counts, index=list(reference_names) + ['*'],
+                                             columns=overview_columns)
+    alignment_df_overview = alignment_df_overview[alignment_df_overview.sum(axis=1) > 0]
+    alignment_df_overview['total'] = alignment_df_overview['aligned'] + alignment_df_overview['discard_edit_distance'] + alignment_df_overview['discarded_not_both'] + alignment_df_overview['discarded_multiple_as']
+    alignment_df_overview['per_dis_edit'] = alignment_df_overview['discard_edit_distance'] / ( alignment_df_overview['total'] + 1 )
+    alignment_df_overview['per_dis_not_both'] = alignment_df_overview['discarded_not_both'] / ( alignment_df_overview['total'] + 1 )
+    alignment_df_overview['per_dis_multiple_as'] = alignment_df_overview['discarded_multiple_as'] / ( alignment_df_overview['total'] + 1 )
+    alignment_df_overview['per_resolved_near_identical'] = alignment_df_overview['resolved_near_identical'] / ( alignment_df_overview['total'] + 1 )
+    alignment_df_overview.to_csv(filepath)
+
+def process_bam_file(input_filepath, output_filepath, lib_name, reference_store_dir, align_output_dir,
+                     create_alignment_df=False, create_alignment_overview_df=True, aligned_callback=None,
+                     n_workers=1, chunk_size=200000, n_library_processes=1):
+    """Filters the alignments of a name-grouped BAM file and writes the statistics to align_output_dir.
+    The reads are compared to the references of the reference store in reference_store_dir (see reference_store).
+    Valid read pairs are written to output_filepath (None: no output BAM) and passed to aligned_callback if given.
+    With create_alignment_df, the result for each read is written to {lib_name}_alignment_stats.parquet.
+    With n_workers > 1, the file is filtered in chunks of chunk_size query groups by a process pool.
+    n_library_processes: number of libraries that are filtered at the same time (e.g. by a pool of libraries),
+    their filtering processes share edit_distance_cache_memory.
+    Returns the statistics counters (see new_filter_stats)."""
+    print(f"Starting library {lib_name} at: {datetime.datetime.now()}")
+    read_table_filepath = os.path.join(align_output_dir, f"{lib_name}_alignment_stats.parquet") \
+        if create_alignment_df else None
+    with pysam.AlignmentFile(input_filepath, "rb") as bam_in:
+        reference_names = bam_in.references
+    check_reference_store(open_reference_store(reference_store_dir), reference_names)
+    if n_workers > 1:
+        stats = process_bam_file_parallel(input_filepath, output_filepath, lib_name, reference_store_dir,
+                                          align_output_dir, n_workers, chunk_size, aligned_callback,
+                                          read_table_filepath, n_library_processes)
+    else:
+        set_edit_distance_cache_size(n_library_processes)
+        # Open the input BAM file for reading
+        with pysam.AlignmentFile(input_filepath, "rb") as bam_in:
+            bam_out = pysam.AlignmentFile(output_filepath, "wb", template=bam_in) if output_filepath else None
+            stats = filter_query_groups(iterate_query_groups(bam_in), lib_name, reference_store_dir, bam_in.nreferences,
+                                        bam_out, aligned_callback, read_table_filepath)
+            if bam_out is not None:
+                bam_out.close()
+
+    n_seqs = stats['n_seqs']
+    n_aligned = stats['n_aligned']
+    n_exact_matches = stats['n_exact_matches']
+    n_discarded_multiple_as = stats['n_discarded_multiple_as']
+    n_discarded_not_both = stats['n_discarded_not_both']
+    n_discarded_edit_distance = stats['n_discarded_edit_distance']
+    n_resolved_near_identical = stats['n_resolved_near_identical']
+    n_cache_hits = stats['n_edit_distance_cache_hits']
+    n_cache_lookups = n_cache_hits + stats['n_edit_distance_cache_misses']
+    cache_hit_rate = n_cache_hits / n_cache_lookups if n_cache_lookups else 0
+
+    if create_alignment_overview_df:
+        write_alignment_overview(stats['overview_counts'], reference_names,
+                                 os.path.join(align_output_dir, f"{lib_name}_alignment_stats_overview.csv"))
+    
+    print(f"Finished library {lib_name} at: {datetime.datetime.now()}")
+    print(f"Total reads: {n_seqs}")
+    print(f"Properly aligned reads: {n_aligned}")
+    print(f"Exact matches (fast path of stage 3): {n_exact_matches}")
+    print(f"Discarded (not both aligned): {n_discarded_not_both}")
+    print(f"Discarded (multiple alignment scores): {n_discarded_multiple_as}")
+    print(f"Discarded (edit distance): {n_discarded_edit_distance}")
+    print(f"Resolved (near-identical references): {n_resolved_near_identical}")
+    print(f"Edit distance cache hit rate: {cache_hit_rate:.2%} ({n_cache_hits} of {n_cache_lookups} lookups)")
+    
+    # Output statistics
+    with open(os.path.join(align_output_dir, f"{lib_name}_alignment_stats.txt"), "w") as stats_file:
+        stats_file.write(f"Total reads: {n_seqs}\n")
+        stats_file.write(f"Properly aligned reads: {n_aligned}\n")
+        stats_file.write(f"Exact matches (fast path of stage 3): {n_exact_matches}\n")
+        stats_file.write(f"Discarded (not both aligned): {n_discarded_not_both}\n")
+        stats_file.write(f"Discarded (multiple alignments): {n_discarded_multiple_as}\n")
+        stats_file.write(f"Discarded (edit distance): {n_discarded_edit_distance}\n")
+        stats_file.write(f"Resolved (near-identical references): {n_resolved_near_identical}\n")
+        stats_file.write(f"Edit distance cache hit rate: {cache_hit_rate:.2%} ({n_cache_hits} of {n_cache_lookups} lookups)\n")
+
+    return stats
@@ -0,0 +1,88 @@
+import array
+import concurrent.futures
+import numpy as np
+import pysam
+import pandas as pd
+import os
+
+all_counts_filename = 'all_counts.csv'
+
+def count_reference_ids(bam_file, reference_ids=None, require_flags=0, exclude_flags=0, batch_size=1000000):
+    """Counts the alignments per reference id that have all require_flags and none of exclude_flags
+    (like samtools view -f/-F). Only the given references are read (this needs the BAM index), or the whole file.
+    Returns an array with the counts of all references of the header."""
+    with pysam.AlignmentFile(bam_file, "rb") as bam:
+        counts = np.zeros(bam.nreferences, dtype=np.int64)
+        if reference_ids is None:
+            reads = bam
+        else:
+            reads = (read for reference_id in reference_ids for read in bam.fetch(bam.get_reference_name(reference_id)))
+        # the reference ids are collected in batches and counted with bincount
+        batch = array.array('l')
+        for read in reads:
+            flag = read.flag
+            if flag & require_flags == require_flags and not flag & exclude_flags and read.reference_id != -1:
+                batch.append(read.reference_id)
+                if len(batch) == batch_size:
+                    counts += np.bincount(np.frombuffer(batch, dtype='l'), minlength=len(counts))
+                    batch = array.array('l')
+        counts += np.bincount(np.frombuffer(batch, dtype='l'), minlength=len(counts))
+    return counts
+
+def count_alignments(bam_file, require_flags=0, exclude_flags=0, n_workers=1):
+    """Counts the alignments per reference of a BAM file.
+    Without flag filters, the mapped read counts are taken from the index if the file is indexed.
+    Otherwise the records are counted by reference id, split by references over n_workers processes
+    if the file is indexed."""
+    with pysam.AlignmentFile(bam_file, "rb") as bam:
+        references = bam.references
+        indexed = bam.has_index()
+        if indexed and not require_flags and not exclude_flags:
+            # Initialize a dictionary to store counts with all templates from the header
+            counts = {ref: 0 for ref in references}
+            for index_statistics in bam.get_index_statistics():
+                counts[index_statistics.contig] = index_statistics.mapped
+            return counts
+
+    if indexed and n_workers > 1:
+        reference_id_lists = [ids.tolist() for ids in np.array_split(np.arange(len(references)), n_workers)]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(count_reference_ids, bam_file, reference_ids, require_flags, exclude_flags)
+                       for reference_ids in reference_id_lists]
+            counts = sum(future.result() for future in futures)
+    else:
+        counts = count_reference_ids(bam_file, None, require_flags, exclude_flags)
+    return dict(zip(references, counts.tolist()))
+
+def save_counts(counts, filepath):
+    # Convert the counts dictionary to a DataFrame
+    df = pd.DataFrame(list(counts.items()), columns=['Reference', 'Count'])
+
+    # Save the DataFrame to the specified path
+    df.to_csv(filepath, index=False)
+
+def merge_count_files(output_path, lib_names=None):
+    """Merges the count files of the libraries in output_path into all_counts.csv (one column per library).
+    With lib_names, only the columns of these libraries are added to or replaced in an existing all_counts.csv."""
+    all_counts_filepath = os.path.join(output_path, all_counts_filename)
+    if lib_names is None or not os.path.exists(all_counts_filepath):
+        # get all count files in the output folder
+        filenames = sorted(filename for filename in os.listdir(output_path)
+                           if filename.endswith('.csv') and filename != all_counts_filename)
+        lib_names = [filename[:-len('.csv')] for filename in filenames]
+        all_counts = None
+    else:
+        all_counts = pd.read_csv(all_counts_filepath, index_col=0)
+
+    lib_counts = []
+    for lib_name in lib_names:
+        df = pd.read_csv(os.path.join(output_path, lib_name + '.csv'), index_col=0)
+        df.rename(columns={'Count': lib_name}, inplace=True)
+        lib_counts.append(df)
+    columns = lib_names
+    if all_counts is not None:
+        # replaced libraries keep their column
+        columns = list(all_counts.columns) + [lib_name for lib_name in lib_names if lib_name not in all_counts]
+        lib_counts.insert(0, all_counts.drop(columns=[lib_name for lib_name in lib_names if lib_name in all_counts]))
+    all_counts = pd.concat(lib_counts, axis=1)[columns]
+    all_counts.to_csv(all_counts_filepath)
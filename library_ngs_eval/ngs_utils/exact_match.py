@@ -0,0 +1,156 @@
+import pysam
+from .fastq_batch import read_record_blocks, read_single_blocks, fastq_line_offsets
+from .reference_store import open_reference_store
+from .threaded_io import open_reader, open_writer
+
+# Exact match fast path of stage 3: most read pairs are identical to the windows of their reference
+# (read 1: the start of the reference, read 2: the reverse complement of its end). These pairs are assigned by
+# a hash lookup and written as alignments directly, only the other pairs go to bwa and the stage 4 filter.
+# Merged reads (see mate_merge.py) match if they are identical to a whole reference.
+# The alignments of the fast path carry this tag, stage 4 takes them as valid without realigning them.
+exact_match_tag = 'ZE'
+complement_table = bytes.maketrans(b"ACGTN", b"TGCAN")
+
+def exact_match_index(reference_store):
+    """Maps the read 1 window of each reference to the ids of the references with this window."""
+    index = {}
+    for reference_id, window in enumerate(reference_store['forward_windows']):
+        index.setdefault(bytes(window), []).append(reference_id)
+    return index
+
+def exact_match_sequence_index(reference_store):
+    """Maps each reference sequence that occurs only once to its id (for merged reads)."""
+    index = {}
+    for reference_id, sequence in enumerate(reference_store['sequences']):
+        index[bytes(sequence)] = -1 if bytes(sequence) in index else reference_id
+    return index
+
+def exact_match_reference(index, reverse_windows, seq1, seq2):
+    """Returns the id of the only reference that both reads match exactly, or -1."""
+    candidates = index.get(seq1)
+    if candidates is None:
+        return -1
+    # read 2 is the reverse complement of the end of the reference, the reverse window is only reversed
+    window2 = seq2.translate(complement_table)
+    matches = [reference_id for reference_id in candidates if reverse_windows[reference_id] == window2]
+    return matches[0] if len(matches) == 1 else -1
+
+def exact_match_alignments(header, query_name, reference_id, reference_length, seq1, qual1, seq2, qual2):
+    """The alignment records of a read pair that matches its reference exactly (like bwa would write them)."""
+    start2 = reference_length - len(seq2)
+    alignments = []
+    for mate, sequence, qualities in ((1, seq1, qual1), (2, seq2, qual2)):
+        alignment = pysam.AlignedSegment(header)
+        alignment.query_name = query_name
+        alignment.reference_id = reference_id
+        alignment.next_reference_id = reference_id
+        alignment.mapping_quality = 60
+        if mate == 1:
+            alignment.flag = 1 | 2 | 32 | 64
+            alignment.reference_start = 0
+            alignment.next_reference_start = start2
+            alignment.template_length = reference_length
+        else:
+            # read 2 is on the reverse strand, BAM stores it in reference orientation
+            alignment.flag = 1 | 2 | 16 | 128
+            alignment.reference_start = start2
+            alignment.next_reference_start = 0
+            alignment.template_length = -reference_length
+            sequence, qualities = sequence.translate(complement_table)[::-1], qualities[::-1]
+        alignment.cigarstring = f'{len(sequence)}M'
+        alignment.query_sequence = sequence.decode()
+        alignment.query_qualities = pysam.qualitystring_to_array(qualities.decode())
+        alignment.set_tags([('NM', 0), ('MD', str(len(sequence))), ('AS', len(sequence)), (exact_match_tag, 1)])
+        alignments.append(alignment)
+    return alignments
+
+def exact_match_single_end_alignment(header, query_name, reference_id, sequence, qualities):
+    """The alignment record of a merged read that is identical to its reference."""
+    alignment = pysam.AlignedSegment(header)
+    alignment.query_name = query_name
+    alignment.flag = 0
+    alignment.reference_id = reference_id
+    alignment.reference_start = 0
+    alignment.mapping_quality = 60
+    alignment.cigarstring = f'{len(sequence)}M'
+    alignment.query_sequence = sequence.decode()
+    alignment.query_qualities = pysam.qualitystring_to_array(qualities.decode())
+    alignment.set_tags([('NM', 0), ('MD', str(len(sequence))), ('AS', len(sequence)), (exact_match_tag, 1)])
+    return alignment
+
+def store_header(reference_store):
+    """A BAM header with the references of the store (in the order of the bwa index)."""
+    return {'HD': {'VN': '1.6', 'SO': 'unsorted'},
+            'SQ': [{'SN': str(name), 'LN': len(sequence)} for name, sequence in zip(reference_store['names'],
+                                                                                   reference_store['sequences'])]}
+
+def split_exact_matches(fastq1_filepath, fastq2_filepath, reference_store_dir, bam_filepath,
+                        miss_fastq1_filepath, miss_fastq2_filepath, batch_size=100000, compression_threads=2,
+                        compresslevel=1):
+    """Writes the read pairs of two gzipped FASTQ files that match a reference exactly to a BAM file
+    and the other pairs to two gzipped FASTQ files (for bwa, see threaded_io.open_writer for compression_threads
+    and compresslevel; None: uncompressed, e.g. to the FIFOs that bwa reads in stage 3).
+    Returns the number of read pairs and the number of exact matches."""
+    reference_store = open_reference_store(reference_store_dir)
+    index = exact_match_index(reference_store)
+    reverse_windows = [bytes(window) for window in reference_store['reverse_windows']]
+    reference_lengths = [len(sequence) for sequence in reference_store['sequences']]
+    header = store_header(reference_store)
+    n_pairs = 0
+    n_exact_matches = 0
+    with open_reader(fastq1_filepath) as fastq1, open_reader(fastq2_filepath) as fastq2, \
+            open_writer(miss_fastq1_filepath, compresslevel, compression_threads) as miss_fastq1, \
+            open_writer(miss_fastq2_filepath, compresslevel, compression_threads) as miss_fastq2, \
+            pysam.AlignmentFile(bam_filepath, 'wb', header=header) as bam_out:
+        for block1, block2 in read_record_blocks(fastq1, fastq2, batch_size):
+            starts1, ends1 = fastq_line_offsets(block1)
+            starts2, ends2 = fastq_line_offsets(block2)
+            misses1, misses2 = [], []
+            for s1, e1, s2, e2 in zip(starts1.tolist(), ends1.tolist(), starts2.tolist(), ends2.tolist()):
+                seq1, seq2 = block1[s1[1]:e1[1]], block2[s2[1]:e2[1]]
+                reference_id = exact_match_reference(index, reverse_windows, seq1, seq2)
+                if reference_id == -1:
+                    misses1.append(block1[s1[0]:e1[3]])
+                    misses2.append(block2[s2[0]:e2[3]])
+                    continue
+                # bwa also takes the first word of the title as query name
+                query_name = block1[s1[0] + 1:e1[0]].split()[0].decode()
+                for alignment in exact_match_alignments(bam_out.header, query_name, reference_id,
+                                                        reference_lengths[reference_id], seq1,
+                                                        block1[s1[3]:e1[3]], seq2, block2[s2[3]:e2[3]]):
+                    bam_out.write(alignment)
+                n_exact_matches += 1
+            n_pairs += len(starts1)
+            if misses1:
+                miss_fastq1.write(b"\n".join(misses1) + b"\n")
+                miss_fastq2.write(b"\n".join(misses2) + b"\n")
+    return n_pairs, n_exact_matches
+
+def split_exact_matches_single_end(fastq_filepath, reference_store_dir, bam_filepath, miss_fastq_filepath,
+                                   batch_size=100000, compression_threads=2, compresslevel=1):
+    """Like split_exact_matches for merged reads (a single gzipped FASTQ file).
+    Returns the number of reads and the number of exact matches."""
+    reference_store = open_reference_store(reference_store_dir)
+    index = exact_match_sequence_index(reference_store)
+    n_reads = 0
+    n_exact_matches = 0
+    with open_reader(fastq_filepath) as fastq, \
+            open_writer(miss_fastq_filepath, compresslevel, compression_threads) as miss_fastq, \
+            pysam.AlignmentFile(bam_filepath, 'wb', header=store_header(reference_store)) as bam_out:
+        for block in read_single_blocks(fastq, batch_size):
+            starts, ends = fastq_line_offsets(block)
+            misses = []
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                sequence = block[start[1]:end[1]]
+                reference_id = index.get(sequence, -1)
+                if reference_id == -1:
+                    misses.append(block[start[0]:end[3]])
+                    continue
+                query_name = block[start[0] + 1:end[0]].split()[0].decode()
+                bam_out.write(exact_match_single_end_alignment(bam_out.header, query_name, reference_id, sequence,
+                                                               block[start[3]:end[3]]))
+                n_exact_matches += 1
+            n_reads += len(starts)
+            if misses:
+                miss_fastq.write(b"\n".join(misses) + b"\n")
+    return n_reads, n_exact_matches
@@ -0,0 +1,88 @@
+import numpy as np
+
+def _split_records(buffer, n_records):
+    """Splits a buffer after its first n_records four-line records.
+    Returns the block with the complete records and the remaining buffer."""
+    newlines = np.flatnonzero(np.frombuffer(buffer, dtype=np.uint8) == ord("\n"))
+    n_lines = min(len(newlines), 4 * n_records) // 4 * 4
+    if n_lines == 0:
+        return b"", buffer
+    end = newlines[n_lines - 1] + 1
+    return buffer[:end], buffer[end:]
+
+def _take_records(handle, buffer, n_records, chunk_size):
+    """Reads from a binary handle until buffer holds n_records four-line records (or the file ends).
+    Returns the block with the complete records and the remaining buffer."""
+    while buffer.count(b"\n") < 4 * n_records:
+        chunk = handle.read(chunk_size)
+        if not chunk:
+            # make sure that the last line is terminated
+            if buffer and not buffer.endswith(b"\n"):
+                buffer += b"\n"
+            break
+        buffer += chunk
+    return _split_records(buffer, n_records)
+
+def read_record_blocks(handle1, handle2, batch_size, bytes_per_record=400):
+    """Yields pairs of raw FASTQ byte blocks with batch_size read pairs each from two binary handles.
+    Like zip over two FASTQ iterators, this stops as soon as one of the mates runs out of reads."""
+    buffer1, buffer2 = b"", b""
+    chunk_size = batch_size * bytes_per_record
+    while True:
+        block1, buffer1 = _take_records(handle1, buffer1, batch_size, chunk_size)
+        n_records = block1.count(b"\n") // 4
+        block2, buffer2 = _take_records(handle2, buffer2, n_records, chunk_size)
+        n_pairs = block2.count(b"\n") // 4
+        if n_pairs == 0:
+            return
+        if n_pairs < n_records:
+            # read 2 ran out first, drop the unpaired read 1 records
+            block1, _ = _split_records(block1, n_pairs)
+        yield block1, block2
+        if n_pairs < batch_size:
+            return
+
+def read_single_blocks(handle, batch_size, bytes_per_record=400):
+    """Yields raw FASTQ byte blocks with batch_size records each from a binary handle (single-end reads)."""
+    buffer = b""
+    chunk_size = batch_size * bytes_per_record
+    while True:
+        block, buffer = _take_records(handle, buffer, batch_size, chunk_size)
+        n_records = block.count(b"\n") // 4
+        if n_records == 0:
+            return
+        yield block
+        if n_records < batch_size:
+            return
+
+def fastq_line_offsets(block):
+    """Returns the start and end (exclusive, without newline) of every line in a block of four-line FASTQ records
+    as arrays of shape (n_records, 4)."""
+    ends = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord("\n"))
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    # strip trailing whitespace like FastqGeneralIterator does
+    data = np.frombuffer(block, dtype=np.uint8)
+    whitespace = np.array([ord(" "), ord("\t"), ord("\r")], dtype=np.uint8)
+    stripped = (ends > starts) & np.isin(data[np.maximum(ends - 1, 0)], whitespace)
+    while stripped.any():
+        ends[stripped] -= 1
+        stripped = (ends > starts) & np.isin(data[np.maximum(ends - 1, 0)], whitespace)
+    return starts.reshape(-1, 4), ends.reshape(-1, 4)
+
+def sequence_matrix(block, starts, ends, line=1):
+    """Views one line type of a FASTQ block (1: sequence, 3: quality) as a 2-D uint8 array of shape (n_records, read_length).
+    Returns None if the lines do not all have the same length."""
+    lengths = ends[:, line] - starts[:, line]
+    if len(lengths) == 0 or (lengths != lengths[0]).any():
+        return None
+    data = np.frombuffer(block, dtype=np.uint8)
+    return data[starts[:, line, None] + np.arange(lengths[0])]
+
+def gather_ranges(block, starts, ends):
+    """Concatenates the byte ranges [starts, ends) of a block."""
+    data = np.frombuffer(block, dtype=np.uint8)
+    lengths = ends - starts
+    offsets = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+    return data[offsets + np.arange(lengths.sum())].tobytes()
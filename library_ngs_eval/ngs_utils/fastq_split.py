@@ -0,0 +1,193 @@
+import collections
+import itertools
+import numpy as np
+from .fastq_batch import fastq_line_offsets, sequence_matrix, gather_ranges
+from .index_demux import assign_sample, assign_samples_batch
+
+def read_batches(handle1, handle2, batch_size):
+    """Yields batches of raw FASTQ lines (four lines per read) from two paired handles.
+    Like zip over two FASTQ iterators, this stops as soon as one of the mates runs out of reads."""
+    while True:
+        lines1 = list(itertools.islice(handle1, 4 * batch_size))
+        lines2 = list(itertools.islice(handle2, 4 * batch_size))
+        n_lines = min(len(lines1), len(lines2)) // 4 * 4
+        if n_lines == 0:
+            return
+        yield lines1[:n_lines], lines2[:n_lines]
+        if n_lines < 4 * batch_size:
+            return
+
+def _remove_umi(seq, qual, umi_pos, umi_len):
+    if umi_pos == -1:
+        seqlen = len(seq)
+        return seq[:seqlen-umi_len], qual[:seqlen-umi_len]
+    return seq[:umi_pos] + seq[umi_pos+umi_len:], qual[:umi_pos] + qual[umi_pos+umi_len:]
+
+def split_batch(batch, internal_index_start, internal_index_end, index_neighbourhood, n_samples,
+                umi_len, umi_pos_r2, umi_pos_r1=None):
+    """Takes a batch of raw FASTQ lines from read_batches, moves the UMI of read 2 into the titles
+    and assigns the reads to a sample by the internal index of read 2 (see index_demux.build_index_neighbourhood).
+    Returns the FASTQ text of both mates per sample, the number of reads per sample and the number of unassigned reads."""
+    lines1, lines2 = batch
+    output1 = [[] for _ in range(n_samples)]
+    output2 = [[] for _ in range(n_samples)]
+    no_reads_samples = [0] * n_samples
+    no_reads_neither = 0
+
+    for i in range(0, len(lines1), 4):
+        # same parsing as FastqGeneralIterator for four-line records
+        title1, seq1, qual1 = lines1[i][1:].rstrip(), lines1[i + 1].rstrip(), lines1[i + 3].rstrip()
+        title2, seq2, qual2 = lines2[i][1:].rstrip(), lines2[i + 1].rstrip(), lines2[i + 3].rstrip()
+        title1 = title1.split()
+        title2 = title2.split()
+        # Sanity check: titles must match
+        assert(title1[0] == title2[0])
+        # get the index on read2
+        index = seq2[internal_index_start:internal_index_end]
+
+        # ------------ umi processing ----------------------
+        # get the UMI and remove it from the sequence
+        umi = seq2[umi_pos_r2:umi_pos_r2+umi_len]
+        seq2 = seq2[:umi_pos_r2] + seq2[umi_pos_r2+umi_len:]
+        qual2 = qual2[:umi_pos_r2] + qual2[umi_pos_r2+umi_len:]
+
+        # check if the read1 umi is not None
+        if umi_pos_r1 is not None:
+            seq1, qual1 = _remove_umi(seq1, qual1, umi_pos_r1, umi_len)
+
+        # ------------ index processing ----------------------
+        # look up the sample of the index
+        sample_id = assign_sample(index, index_neighbourhood)
+        if sample_id != -1:
+            # add the UMI to the first portion of the title
+            output1[sample_id].append(f"@{title1[0]}_{umi} {title1[1]}\n{seq1}\n+\n{qual1}\n")
+            output2[sample_id].append(f"@{title2[0]}_{umi} {title2[1]}\n{seq2}\n+\n{qual2}\n")
+            no_reads_samples[sample_id] += 1
+        else:
+            no_reads_neither += 1
+
+    return ["".join(output) for output in output1], ["".join(output) for output in output2], \
+        no_reads_samples, no_reads_neither
+
+def _record_layout(block, starts, ends):
+    """Returns the position of the space between the name and the comment of every title line, or None if the
+    records of a block are not all of the form '@name comment', sequence, '+...', quality as long as the sequence."""
+    data = np.frombuffer(block, dtype=np.uint8)
+    # all whitespace (and control characters) of the block, sequences and qualities have none
+    whitespace = np.flatnonzero(data <= ord(" "))
+    if len(whitespace) == 0:
+        return None
+    first = np.searchsorted(whitespace, starts[:, 0] + 1)
+    n_whitespace = np.searchsorted(whitespace, ends[:, 0]) - first
+    spaces = whitespace[np.minimum(first, len(whitespace) - 1)]
+    if not ((n_whitespace == 1) & (data[spaces] == ord(" ")) & (spaces > starts[:, 0] + 1)
+            & (spaces < ends[:, 0] - 1)).all():
+        return None
+    if (data[starts[:, 0]] != ord("@")).any() or (data[starts[:, 2]] != ord("+")).any():
+        return None
+    if ((ends[:, 1] - starts[:, 1]) != (ends[:, 3] - starts[:, 3])).any():
+        return None
+    return spaces
+
+def _umi_lengths(lengths, umi_pos, umi_len):
+    """Lengths of the parts of lines before, in and after the UMI (same slicing as _remove_umi,
+    umi_pos None: no UMI)."""
+    zeros = np.zeros_like(lengths)
+    if umi_pos is None:
+        return lengths, zeros, zeros
+    if umi_pos == -1:
+        # seq[:seqlen-umi_len] counts from the end again for reads shorter than the UMI
+        kept = np.where(lengths >= umi_len, lengths - umi_len, np.maximum(2 * lengths - umi_len, 0))
+        return kept, lengths - kept, zeros
+    before, after = np.minimum(umi_pos, lengths), np.minimum(umi_pos + umi_len, lengths)
+    return before, after - before, lengths - after
+
+def _assemble_records(block, starts, ends, spaces, umis, sample_ids, n_samples, umi_pos, umi_len):
+    """Assembles the output records of the assigned reads of one mate ('@{name}_{umi} {comment}', sequence and
+    quality without the UMI, '+' line without title) from the block and the UMIs (uint8 array, a row per record).
+    The bytes that are kept are selected by one mask over the block and '_{umi}' is spliced in after each name,
+    both masks are run-length encoded per record. Returns the FASTQ bytes per sample (records in input order)."""
+    data = np.frombuffer(block, dtype=np.uint8)
+    assigned = sample_ids != -1
+    record_ends = np.append(starts[1:, 0], len(block))
+    seq_before, seq_umi, seq_after = _umi_lengths(ends[:, 1] - starts[:, 1], umi_pos, umi_len)
+    qual_before, qual_umi, qual_after = _umi_lengths(ends[:, 3] - starts[:, 3], umi_pos, umi_len)
+    # runs of kept and skipped bytes of each record: title, stripped whitespace, newline and sequence before the
+    # UMI, UMI, sequence after the UMI, whitespace, newline and '+', rest of the '+' line, newline and quality
+    # before the UMI, UMI, quality after the UMI, whitespace, newline
+    runs = np.column_stack([
+        ends[:, 0] - starts[:, 0], starts[:, 1] - 1 - ends[:, 0], 1 + seq_before, seq_umi, seq_after,
+        starts[:, 2] - 1 - ends[:, 1], np.full(len(starts), 2), starts[:, 3] - 2 - starts[:, 2], 1 + qual_before,
+        qual_umi, qual_after, record_ends - 1 - ends[:, 3], np.ones(len(starts), dtype=np.int64),
+        np.zeros(len(starts), dtype=np.int64)])
+    runs[~assigned] = 0
+    runs[~assigned, 1] = (record_ends - starts[:, 0])[~assigned]
+    keep = np.zeros(runs.shape, dtype=bool)
+    keep[:, ::2] = True
+    kept = data[np.repeat(keep.ravel(), runs.ravel())]
+
+    # runs of kept bytes and inserted bytes of each record: '@' and name, '_' and UMI, the rest
+    name_lengths = np.where(assigned, spaces - starts[:, 0], 0)
+    output_lengths = runs[:, ::2].sum(axis=1)
+    from_block = np.ones((len(starts), 3), dtype=bool)
+    from_block[:, 1] = False
+    from_block = np.repeat(from_block.ravel(), np.column_stack([
+        name_lengths, np.where(assigned, umi_len + 1, 0), output_lengths - name_lengths]).ravel())
+    records = np.empty(len(from_block), dtype=np.uint8)
+    records[from_block] = kept
+    records[~from_block] = np.column_stack([np.full(assigned.sum(), ord("_"), dtype=np.uint8),
+                                            umis[assigned]]).ravel()
+    sample_counts = np.bincount(sample_ids[assigned], minlength=n_samples)
+    if (sample_counts == sample_counts.sum()).any():
+        # all records belong to one sample
+        return [records.tobytes() if count else b"" for count in sample_counts]
+    record_lengths = np.where(assigned, output_lengths + umi_len + 1, 0)
+    return [records[np.repeat(sample_ids == sample_id, record_lengths)].tobytes() for sample_id in range(n_samples)]
+
+def split_block(batch, internal_index_start, internal_index_end, index_neighbourhood, index_table, n_samples,
+                umi_len, umi_pos_r2, umi_pos_r1=None):
+    """Same as split_batch, but takes a pair of raw FASTQ byte blocks from fastq_batch.read_record_blocks.
+    The index lookup (index_demux.neighbourhood_table) and UMI extraction run vectorized on the fixed-length
+    read 2 sequences, and the output records are assembled with byte masks over the blocks (see _assemble_records).
+    Returns the FASTQ bytes of both mates per sample, the number of reads per sample and the number of unassigned reads."""
+    block1, block2 = batch
+    offsets1 = fastq_line_offsets(block1)
+    offsets2 = fastq_line_offsets(block2)
+    seqs2 = sequence_matrix(block2, *offsets2)
+    spaces1 = _record_layout(block1, *offsets1)
+    spaces2 = _record_layout(block2, *offsets2)
+    if seqs2 is None or seqs2.shape[1] < max(internal_index_end, umi_pos_r2 + umi_len) \
+            or spaces1 is None or spaces2 is None:
+        # reads of varying length (e.g. trimmed data) and other titles go through the per-read implementation
+        output1, output2, no_reads_samples, no_reads_neither = split_batch(
+            (block1.decode().splitlines(True), block2.decode().splitlines(True)), internal_index_start,
+            internal_index_end, index_neighbourhood, n_samples, umi_len, umi_pos_r2, umi_pos_r1)
+        return [output.encode() for output in output1], [output.encode() for output in output2], \
+            no_reads_samples, no_reads_neither
+
+    # Sanity check: titles must match (the names end at the spaces found by _record_layout)
+    name_starts1, name_starts2 = offsets1[0][:, 0] + 1, offsets2[0][:, 0] + 1
+    assert((spaces1 - name_starts1 == spaces2 - name_starts2).all()
+           and gather_ranges(block1, name_starts1, spaces1) == gather_ranges(block2, name_starts2, spaces2))
+
+    # ------------ index processing ----------------------
+    sample_ids = assign_samples_batch(seqs2[:, internal_index_start:internal_index_end], index_table)
+    no_reads_samples = np.bincount(sample_ids[sample_ids != -1], minlength=n_samples).tolist()
+    no_reads_neither = int((sample_ids == -1).sum())
+
+    # ------------ umi processing ----------------------
+    umis = seqs2[:, umi_pos_r2:umi_pos_r2+umi_len]
+    output1 = _assemble_records(block1, *offsets1, spaces1, umis, sample_ids, n_samples, umi_pos_r1, umi_len)
+    output2 = _assemble_records(block2, *offsets2, spaces2, umis, sample_ids, n_samples, umi_pos_r2, umi_len)
+    return output1, output2, no_reads_samples, no_reads_neither
+
+def ordered_parallel_map(executor, func, iterable, max_pending):
+    """Like executor.map, but only keeps max_pending tasks in flight so that the input
+    is not read into memory all at once. Results are yielded in input order."""
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
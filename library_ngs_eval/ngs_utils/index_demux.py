@@ -0,0 +1,95 @@
+import itertools
+import numpy as np
+
+index_alphabet = "ACGTN"
+# any other character is treated like an N, i.e. as a mismatch to every index base
+index_translation = {i: "N" for i in range(256) if chr(i) not in index_alphabet}
+
+def hamming_neighbours(sequence, n_mismatches, alphabet=index_alphabet):
+    """Returns all sequences with exactly n_mismatches substitutions relative to sequence."""
+    neighbours = set()
+    for positions in itertools.combinations(range(len(sequence)), n_mismatches):
+        choices = [[c for c in alphabet if c != sequence[pos]] for pos in positions]
+        for substitutions in itertools.product(*choices):
+            neighbour = list(sequence)
+            for pos, c in zip(positions, substitutions):
+                neighbour[pos] = c
+            neighbours.add("".join(neighbour))
+    return neighbours
+
+def _neighbourhood(sequences, max_mismatches):
+    """Maps every sequence within max_mismatches of one of sequences to its position, or to the positions of all
+    sequences at the same (smallest) distance if there are several (the second dictionary)."""
+    neighbourhood = {}
+    collisions = {}
+    for n_mismatches in range(max_mismatches + 1):
+        # neighbours at this distance, unless an index is closer
+        candidates = {}
+        for sample_id, sequence in enumerate(sequences):
+            for neighbour in hamming_neighbours(sequence, n_mismatches):
+                if neighbour not in neighbourhood and neighbour not in collisions:
+                    candidates.setdefault(neighbour, []).append(sample_id)
+        for neighbour, sample_ids in candidates.items():
+            if len(sample_ids) == 1:
+                neighbourhood[neighbour] = sample_ids[0]
+            else:
+                collisions[neighbour] = sample_ids
+    return neighbourhood, collisions
+
+def build_index_neighbourhood(indices, max_mismatches=1):
+    """Takes a dictionary of sample names and index sequences and precomputes every sequence
+    within max_mismatches of an index.
+
+    Returns a dictionary that maps each such sequence to the position of its sample in indices.
+    A sequence that is closer to one index than to all others is assigned to that index.
+    Sequences with the same distance to several indices are reported and left unassigned.
+    The index of a read that is shorter than the index end is truncated; it is compared to the same
+    number of leading bases of the indices (like zip), so the dictionary also holds the neighbourhoods of the
+    shorter prefixes of the indices."""
+    names = list(indices.keys())
+    sequences = [indices[name].upper() for name in names]
+    if len(set(len(sequence) for sequence in sequences)) > 1:
+        raise ValueError("All internal indices must have the same length.")
+    if len(set(sequences)) < len(sequences):
+        raise ValueError("Two samples share the same internal index.")
+
+    neighbourhood, collisions = _neighbourhood(sequences, max_mismatches)
+    if collisions:
+        colliding_samples = sorted(set(tuple(names[sample_id] for sample_id in sample_ids)
+                                       for sample_ids in collisions.values()))
+        print(f"Warning: {len(collisions)} index sequences are within {max_mismatches} mismatches of several samples "
+              f"and will not be assigned. Colliding samples: {colliding_samples}")
+
+    # truncated indices (prefixes shared by several samples are not assigned)
+    for length in range(len(sequences[0]) if sequences else 0):
+        neighbourhood.update(_neighbourhood([sequence[:length] for sequence in sequences], max_mismatches)[0])
+    return neighbourhood
+
+def neighbourhood_table(neighbourhood, index_length):
+    """Converts an index neighbourhood to a dense lookup table over all base-5 encoded index sequences.
+    Entries without a sample are -1. The neighbourhoods of truncated indices are left out."""
+    table = np.full(len(index_alphabet) ** index_length, -1, dtype=np.int32)
+    for sequence, sample_id in neighbourhood.items():
+        if len(sequence) != index_length:
+            continue
+        table[encode_index_sequences(np.frombuffer(sequence.encode(), dtype=np.uint8)[None, :])[0]] = sample_id
+    return table
+
+def encode_index_sequences(regions):
+    """Encodes the index regions of a batch of reads (uint8 array of shape (n_records, index_length))
+    as base-5 integers. Characters other than ACGT are encoded like N."""
+    codes = np.full(256, index_alphabet.index("N"), dtype=np.int64)
+    for code, c in enumerate(index_alphabet):
+        codes[ord(c)] = code
+    encoded = np.zeros(len(regions), dtype=np.int64)
+    for column in range(regions.shape[1]):
+        encoded = encoded * len(index_alphabet) + codes[regions[:, column]]
+    return encoded
+
+def assign_sample(index, neighbourhood):
+    """Returns the position of the sample whose index matches the index sequence of a single read, or -1."""
+    return neighbourhood.get(index.translate(index_translation), -1)
+
+def assign_samples_batch(regions, table):
+    """Returns the sample position for the index regions of a batch of reads (-1: no sample)."""
+    return table[encode_index_sequences(regions)]
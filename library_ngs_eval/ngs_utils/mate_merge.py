@@ -0,0 +1,137 @@
+import numpy as np
+from .fastq_batch import read_record_blocks, fastq_line_offsets
+from .metrics import optional_phase
+from .threaded_io import open_reader, open_writer
+
+# Mate merging: read 1 covers the start of the template (the reference) and read 2 the reverse complement of its end,
+# so with templates shorter than both reads together the mates overlap by read 1 + read 2 - template length bases.
+# The overlap is tried for the lengths of the references and a few bases around them (indels), the length with the
+# fewest high quality mismatches in the overlap is taken. The merged read covers the whole template in reference
+# orientation and keeps the title of read 1 (with the UMI of the split stage).
+# Pairs that can not be merged (e.g. with an indel in the overlap) are kept as pairs.
+min_quality = 20
+# template lengths up to this many bases shorter or longer than a reference are tried
+max_length_shift = 2
+# mates need at least this many overlapping bases
+min_overlap = 20
+# pairs with more high quality mismatches in the overlap are not merged
+# (each of them is an edit of one of the mates, so such pairs would not pass the edit distance filter of stage 4)
+max_overlap_mismatches = 4
+
+complement_lut = np.arange(256, dtype=np.uint8)
+complement_lut[np.frombuffer(b"ACGTN", dtype=np.uint8)] = np.frombuffer(b"TGCAN", dtype=np.uint8)
+
+def template_lengths(reference_lengths, read1_length, read2_length):
+    """The template lengths that are tried for mates of the given lengths, the reference lengths first."""
+    lengths = sorted(set(reference_lengths))
+    lengths += sorted({length + shift for length in lengths for shift in range(-max_length_shift, max_length_shift + 1)}
+                      - set(lengths))
+    return [length for length in lengths
+            if max(read1_length, read2_length) <= length <= read1_length + read2_length - min_overlap]
+
+def merge_matrices(seq1, qual1, seq2, qual2, lengths):
+    """Merges mates given as uint8 matrices (one row per pair, as in the FASTQ files).
+    Returns the index of the template length of each pair (-1: not merged) and, for each template length,
+    the rows merged with it and their consensus sequences and qualities (ASCII, phred + 33)."""
+    n_pairs, read1_length = seq1.shape
+    read2_length = seq2.shape[1]
+    seq2 = complement_lut[seq2[:, ::-1]]
+    qual2 = qual2[:, ::-1]
+    high1 = (qual1 > 33 + min_quality) & (seq1 != ord("N"))
+    high2 = (qual2 > 33 + min_quality) & (seq2 != ord("N"))
+
+    best_mismatches = np.full(n_pairs, max_overlap_mismatches + 1, dtype=np.int64)
+    best_length = np.full(n_pairs, -1, dtype=np.int64)
+    for i, length in enumerate(lengths):
+        # read 2 starts at this position of the template, the overlap is the rest of read 1
+        start = length - read2_length
+        overlap = read1_length - start
+        mismatches = ((seq1[:, start:] != seq2[:, :overlap]) & high1[:, start:] & high2[:, :overlap]).sum(axis=1)
+        # ties keep the earlier length (the reference lengths come first)
+        better = mismatches < best_mismatches
+        best_mismatches[better] = mismatches[better]
+        best_length[better] = i
+
+    merged = []
+    for i, length in enumerate(lengths):
+        rows = np.flatnonzero(best_length == i)
+        if len(rows) == 0:
+            continue
+        start = length - read2_length
+        seq = np.empty((len(rows), length), dtype=np.uint8)
+        qual = np.empty((len(rows), length), dtype=np.uint8)
+        seq[:, :start], qual[:, :start] = seq1[rows, :start], qual1[rows, :start]
+        seq[:, read1_length:] = seq2[rows, read1_length - start:]
+        qual[:, read1_length:] = qual2[rows, read1_length - start:]
+        # the overlap takes the base with the higher quality, disagreeing bases lose the quality of the other base
+        base1, base_qual1 = seq1[rows, start:], qual1[rows, start:].astype(np.int16)
+        base2, base_qual2 = seq2[rows, :read1_length - start], qual2[rows, :read1_length - start].astype(np.int16)
+        seq[:, start:read1_length] = np.where(base_qual2 > base_qual1, base2, base1)
+        qual[:, start:read1_length] = np.where(base1 == base2, np.maximum(base_qual1, base_qual2),
+                                               33 + np.abs(base_qual1 - base_qual2))
+        merged.append((rows, seq, qual))
+    return best_length, merged
+
+def merge_block(block1, block2, reference_lengths):
+    """Merges the read pairs of two FASTQ blocks. Returns the merged FASTQ records, the read 1 and read 2 records
+    of the pairs that are not merged (in input order) and the number of merged pairs."""
+    starts1, ends1 = fastq_line_offsets(block1)
+    starts2, ends2 = fastq_line_offsets(block2)
+    data1 = np.frombuffer(block1, dtype=np.uint8)
+    data2 = np.frombuffer(block2, dtype=np.uint8)
+    lengths1 = ends1[:, 1] - starts1[:, 1]
+    lengths2 = ends2[:, 1] - starts2[:, 1]
+
+    records = [None] * len(starts1)
+    # the pairs are merged in groups of equal read lengths (usually a single group)
+    for read1_length, read2_length in set(zip(lengths1.tolist(), lengths2.tolist())):
+        group = np.flatnonzero((lengths1 == read1_length) & (lengths2 == read2_length))
+        lengths = template_lengths(reference_lengths, read1_length, read2_length)
+        if not lengths:
+            continue
+        seq1 = data1[starts1[group, 1, None] + np.arange(read1_length)]
+        qual1 = data1[starts1[group, 3, None] + np.arange(read1_length)]
+        seq2 = data2[starts2[group, 1, None] + np.arange(read2_length)]
+        qual2 = data2[starts2[group, 3, None] + np.arange(read2_length)]
+        _, merged = merge_matrices(seq1, qual1, seq2, qual2, lengths)
+        for rows, seq, qual in merged:
+            for row, seq_bytes, qual_bytes in zip(group[rows].tolist(), seq, qual):
+                records[row] = b"".join((block1[starts1[row, 0]:ends1[row, 0]], b"\n", seq_bytes.tobytes(), b"\n+\n",
+                                         qual_bytes.tobytes(), b"\n"))
+    merged_records = [record for record in records if record is not None]
+    unmerged = [row for row, record in enumerate(records) if record is None]
+    unmerged1 = b"".join(block1[starts1[row, 0]:ends1[row, 3]] + b"\n" for row in unmerged)
+    unmerged2 = b"".join(block2[starts2[row, 0]:ends2[row, 3]] + b"\n" for row in unmerged)
+    return b"".join(merged_records), unmerged1, unmerged2, len(merged_records)
+
+def merge_fastq_files(fastq1_filepath, fastq2_filepath, output_filepath, unmerged1_filepath, unmerged2_filepath,
+                      reference_lengths, batch_size=100000, metrics=None, compresslevel=5, compression_threads=2):
+    """Merges the read pairs of two gzipped FASTQ files of the split stage into one gzipped FASTQ file.
+    Pairs that do not overlap for any template length are written to two other gzipped FASTQ files.
+    The outputs are compressed as in threaded_io.open_writer.
+    The phases and read counts are recorded in metrics (a StageMetrics object) if given.
+    Returns the number of read pairs and the number of merged reads."""
+    n_pairs = 0
+    n_merged = 0
+    with open_reader(fastq1_filepath) as fastq1, open_reader(fastq2_filepath) as fastq2, \
+            open_writer(output_filepath, compresslevel, compression_threads) as output, \
+            open_writer(unmerged1_filepath, compresslevel, compression_threads) as unmerged1, \
+            open_writer(unmerged2_filepath, compresslevel, compression_threads) as unmerged2:
+        blocks = read_record_blocks(fastq1, fastq2, batch_size)
+        if metrics is not None:
+            blocks = metrics.timed_iter(blocks, 'read')
+        for block1, block2 in blocks:
+            with optional_phase(metrics, 'merge'):
+                records, unmerged_records1, unmerged_records2, n_block_merged = merge_block(block1, block2,
+                                                                                            reference_lengths)
+            with optional_phase(metrics, 'write'):
+                output.write(records)
+                unmerged1.write(unmerged_records1)
+                unmerged2.write(unmerged_records2)
+            n_pairs += block1.count(b"\n") // 4
+            n_merged += n_block_merged
+    if metrics is not None:
+        metrics.count('reads_in', n_pairs)
+        metrics.count('merged', n_merged)
+        metrics.count('reads_out', n_pairs)
+    return n_pairs, n_merged
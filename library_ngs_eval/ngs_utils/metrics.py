@@ -0,0 +1,165 @@
+import collections
+import contextlib
+import csv
+import datetime
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+# Throughput and resource metrics of the stages. Each stage run of a library collects the wall and CPU time
+# of its phases, read counters and cache hit rates in a StageMetrics object and writes them to
+# metrics_dir/{lib_name}_{stage}.json. Every run also appends its phases to metrics_dir/metrics.csv,
+# so runs can be compared to find regressions.
+metrics_dir = 'metrics'
+history_filename = 'metrics.csv'
+history_columns = ['timestamp', 'stage', 'lib_name', 'phase', 'calls', 'wall_s', 'cpu_s', 'reads_in', 'reads_out',
+                   'reads_per_s', 'peak_rss_mb', 'peak_rss_children_mb']
+
+# Set NGS_PROFILE_INTERVAL (seconds, e.g. 0.01) to sample the stack of the main thread during a stage.
+# The samples are written to metrics_dir/{lib_name}_{stage}_profile.txt as collapsed stacks
+# (one 'frame;frame;... count' line per stack, the input format of flame graph tools).
+profile_interval = float(os.environ.get('NGS_PROFILE_INTERVAL', 0))
+
+def cpu_time():
+    """CPU time of this process and its finished child processes (e.g. pool workers, bwa)."""
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return self_usage.ru_utime + self_usage.ru_stime + children_usage.ru_utime + children_usage.ru_stime
+
+def peak_rss_mb():
+    """Peak resident memory (MB) of this process and of its largest finished child process."""
+    # ru_maxrss is in kB on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+
+class SamplingProfiler:
+    """Samples the stack of a thread every interval seconds in a background thread."""
+    def __init__(self, interval, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.main_thread().ident
+        self.stack_counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.stack_counts[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, filepath):
+        with open(filepath, 'w') as f:
+            for stack, count in self.stack_counts.most_common():
+                f.write(f"{stack} {count}\n")
+
+class StageMetrics:
+    """Metrics of one stage run of a library. Phases may be nested, their times include the nested phases.
+    The 'total' phase runs from creation to write."""
+    def __init__(self, stage, lib_name):
+        self.stage = stage
+        self.lib_name = lib_name
+        self.timestamp = datetime.datetime.now().isoformat(sep=' ', timespec='seconds')
+        self.phases = {}
+        self.counters = collections.Counter()
+        self.caches = {}
+        self._start_wall = time.perf_counter()
+        self._start_cpu = cpu_time()
+        self.profiler = SamplingProfiler(profile_interval) if profile_interval > 0 else None
+        if self.profiler is not None:
+            self.profiler.start()
+
+    def add_time(self, phase, wall, cpu=None, calls=1):
+        """Adds time to a phase, e.g. time measured in worker processes (cpu None: not measured)."""
+        times = self.phases.setdefault(phase, {'calls': 0, 'wall_s': 0.0, 'cpu_s': None})
+        times['calls'] += calls
+        times['wall_s'] += wall
+        if cpu is not None:
+            times['cpu_s'] = (times['cpu_s'] or 0.0) + cpu
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Times the code of a with block as phase name."""
+        start_wall, start_cpu = time.perf_counter(), cpu_time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start_wall, cpu_time() - start_cpu)
+
+    def timed(self, func, phase):
+        """Wraps a function so that its calls are timed as phase."""
+        def timed_func(*args, **kwargs):
+            with self.phase(phase):
+                return func(*args, **kwargs)
+        return timed_func
+
+    def timed_iter(self, iterable, phase):
+        """Times the production of each item of an iterable (e.g. reading and decompressing a batch) as phase."""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(phase):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name, n=1):
+        """Adds n to a counter, e.g. reads_in and reads_out."""
+        self.counters[name] += n
+
+    def cache(self, name, hits, lookups):
+        self.caches[name] = {'hits': hits, 'lookups': lookups, 'hit_rate': hits / lookups if lookups else 0}
+
+    def summary(self):
+        """Returns the metrics as a dictionary (the 'total' phase up to now)."""
+        phases = {name: dict(times) for name, times in self.phases.items()}
+        phases['total'] = {'calls': 1, 'wall_s': time.perf_counter() - self._start_wall,
+                           'cpu_s': cpu_time() - self._start_cpu}
+        # throughput in input reads (output reads if the stage does not count its input, e.g. counting from the index)
+        n_reads = self.counters['reads_in'] or self.counters['reads_out']
+        for times in phases.values():
+            times['reads_per_s'] = n_reads / times['wall_s'] if times['wall_s'] else 0
+        peak_rss, peak_rss_children = peak_rss_mb()
+        return {'stage': self.stage, 'lib_name': self.lib_name, 'timestamp': self.timestamp,
+                'counters': dict(self.counters), 'caches': self.caches, 'phases': phases,
+                'peak_rss_mb': peak_rss, 'peak_rss_children_mb': peak_rss_children}
+
+    def write(self, output_dir=metrics_dir):
+        """Writes the metrics to output_dir/{lib_name}_{stage}.json and appends the phases to metrics.csv."""
+        os.makedirs(output_dir, exist_ok=True)
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler.write(os.path.join(output_dir, f"{self.lib_name}_{self.stage}_profile.txt"))
+        summary = self.summary()
+        with open(os.path.join(output_dir, f"{self.lib_name}_{self.stage}.json"), 'w') as f:
+            json.dump(summary, f, indent=1)
+
+        history_filepath = os.path.join(output_dir, history_filename)
+        write_header = not os.path.exists(history_filepath)
+        with open(history_filepath, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if write_header:
+                writer.writerow(history_columns)
+            for phase, times in summary['phases'].items():
+                writer.writerow([summary['timestamp'], self.stage, self.lib_name, phase, times['calls'],
+                                 f"{times['wall_s']:.3f}", f"{times['cpu_s']:.3f}" if times['cpu_s'] is not None else '', self.counters['reads_in'],
+                                 self.counters['reads_out'], f"{times['reads_per_s']:.1f}",
+                                 f"{summary['peak_rss_mb']:.1f}", f"{summary['peak_rss_children_mb']:.1f}"])
+        return summary
+
+def optional_phase(metrics, name):
+    """metrics.phase(name), or a context that does nothing if metrics is None."""
+    return metrics.phase(name) if metrics is not None else contextlib.nullcontext()
@@ -0,0 +1,201 @@
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+
+# Runs the stage scripts as a graph of (library, stage) tasks. A task starts once the tasks it depends on are done
+# and its CPUs and memory fit into the budget. A task is skipped if its stamp shows that it already ran with the same
+# script, ngs_utils modules, settings and inputs (by content hash) and its outputs are still there. After a failure,
+# only the failed tasks and the tasks that depend on them are run again.
+
+# environment variables that change the outputs of the stages (e.g. NGS_MERGED_READS of stage 3)
+output_environment = ('NGS_MERGED_READS',)
+# local imports of a stage script (from ngs_utils.x import ...) and of the ngs_utils modules (from .x import ...)
+script_import_pattern = re.compile(r'^\s*(?:from|import)\s+ngs_utils\.(\w+)', re.MULTILINE)
+module_import_pattern = re.compile(r'^\s*from\s+\.(\w+)\s+import', re.MULTILINE)
+
+def file_hash(filepath, hash_cache, lock):
+    """SHA-256 of a file. The hashes are cached by path, size and modification time."""
+    stat = os.stat(filepath)
+    with lock:
+        cached = hash_cache.get(filepath)
+    if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+        return cached[2]
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    with lock:
+        hash_cache[filepath] = [stat.st_size, stat.st_mtime_ns, sha256.hexdigest()]
+    return sha256.hexdigest()
+
+class Task:
+    """A stage run for one library. inputs and outputs are file paths, dependencies other tasks."""
+    def __init__(self, stage, lib_name, script, args, inputs, outputs, cpus=1, memory_gb=1, dependencies=(),
+                 exclusive_group=None):
+        self.stage = stage
+        self.lib_name = lib_name
+        self.script = script
+        self.args = list(args)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.cpus = cpus
+        self.memory_gb = memory_gb
+        self.dependencies = list(dependencies)
+        # tasks of the same exclusive group (e.g. stages that update a shared file) do not run at the same time
+        self.exclusive_group = exclusive_group
+
+    @property
+    def name(self):
+        return f"{self.stage}_{self.lib_name}"
+
+def local_dependencies(script):
+    """The ngs_utils modules a stage script imports, directly or through other ngs_utils modules (sorted paths).
+    Their parameters (e.g. dist_threshold of alignment_filter.py) change the outputs like those of the script."""
+    package_dir = os.path.join(os.path.dirname(script), 'ngs_utils')
+    with open(script) as f:
+        pending = script_import_pattern.findall(f.read())
+    dependencies = set()
+    while pending:
+        filepath = os.path.join(package_dir, f"{pending.pop()}.py")
+        if filepath in dependencies or not os.path.exists(filepath):
+            continue
+        dependencies.add(filepath)
+        with open(filepath) as f:
+            pending += module_import_pattern.findall(f.read())
+    return sorted(dependencies)
+
+def task_key(task, hash_cache, lock):
+    """Hash of everything a task result depends on: the stage script and the ngs_utils modules it uses
+    (code and parameters), its arguments, the environment variables of output_environment and the contents of
+    its inputs."""
+    sha256 = hashlib.sha256()
+    for filepath in [task.script] + local_dependencies(task.script) + task.inputs:
+        sha256.update(filepath.encode())
+        sha256.update(file_hash(filepath, hash_cache, lock).encode())
+    sha256.update(json.dumps(task.args).encode())
+    sha256.update(json.dumps({name: os.environ.get(name) for name in output_environment}).encode())
+    return sha256.hexdigest()
+
+def is_up_to_date(task, key, stamp_filepath):
+    """Checks the stamp of a task: same key and all outputs unchanged since the task ran."""
+    if not os.path.exists(stamp_filepath):
+        return False
+    with open(stamp_filepath) as f:
+        stamp = json.load(f)
+    if stamp['key'] != key:
+        return False
+    for filepath in task.outputs:
+        if not os.path.exists(filepath):
+            return False
+        stat = os.stat(filepath)
+        if stamp['outputs'].get(filepath) != [stat.st_size, stat.st_mtime_ns]:
+            return False
+    return True
+
+def run_task(task, cpus, stamp_dir, log_dir, hash_cache, lock, force=False):
+    """Runs the script of a task (unless it is up to date) with cpus threads and writes its stamp.
+    Returns 'skipped', 'done' or 'failed'."""
+    stamp_filepath = os.path.join(stamp_dir, f"{task.name}.json")
+    missing_inputs = [filepath for filepath in task.inputs if not os.path.exists(filepath)]
+    if missing_inputs:
+        print(f"[{task.name}] missing inputs: {missing_inputs}")
+        return 'failed'
+    key = task_key(task, hash_cache, lock)
+    if not force and is_up_to_date(task, key, stamp_filepath):
+        return 'skipped'
+    if os.path.exists(stamp_filepath):
+        os.remove(stamp_filepath)
+
+    print(f"[{datetime.datetime.now()}] Starting {task.name}")
+    with open(os.path.join(log_dir, f"{task.name}.txt"), 'w') as log:
+        # PIPELINE_CPUS tells the script how many threads it may use (e.g. bwa in stage 3)
+        env = dict(os.environ, PIPELINE_CPUS=str(cpus))
+        proc = subprocess.run([sys.executable, '-u', task.script] + task.args, stdout=log, stderr=subprocess.STDOUT,
+                              env=env)
+    missing_outputs = [filepath for filepath in task.outputs if not os.path.exists(filepath)]
+    if proc.returncode != 0 or missing_outputs:
+        print(f"[{datetime.datetime.now()}] Failed {task.name} (exit code {proc.returncode}, "
+              f"missing outputs: {missing_outputs})")
+        return 'failed'
+
+    # the output hashes are cached now, the next tasks use them as input hashes
+    for filepath in task.outputs:
+        file_hash(filepath, hash_cache, lock)
+    outputs = {}
+    for filepath in task.outputs:
+        stat = os.stat(filepath)
+        outputs[filepath] = [stat.st_size, stat.st_mtime_ns]
+    with open(stamp_filepath, 'w') as f:
+        json.dump({'key': key, 'outputs': outputs}, f, indent=1)
+    print(f"[{datetime.datetime.now()}] Finished {task.name}")
+    return 'done'
+
+def run_pipeline(tasks, cpu_budget, memory_budget_gb, stamp_dir='pipeline_stamps', log_dir='log', force_stages=()):
+    """Runs the tasks in dependency order, as many at a time as the CPU and memory budgets allow.
+    Tasks that need more than the budget run alone. Tasks of force_stages are run even if up to date.
+    Returns the status of each task ('skipped', 'done', 'failed' or 'blocked' by a failed dependency)."""
+    os.makedirs(stamp_dir, exist_ok=True)
+    os.makedirs(log_dir, exist_ok=True)
+    hash_cache_filepath = os.path.join(stamp_dir, 'file_hashes.json')
+    hash_cache = {}
+    if os.path.exists(hash_cache_filepath):
+        with open(hash_cache_filepath) as f:
+            hash_cache = json.load(f)
+    lock = threading.Lock()
+
+    status = {}
+    pending = list(tasks)
+    running = {}
+    free_cpus, free_memory = cpu_budget, memory_budget_gb
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(tasks), 1)) as executor:
+        while pending or running:
+            # tasks behind a failed task can not run
+            for task in list(pending):
+                if any(status.get(dependency.name) in ('failed', 'blocked') for dependency in task.dependencies):
+                    status[task.name] = 'blocked'
+                    pending.remove(task)
+
+            busy_groups = {task.exclusive_group for task in running.values() if task.exclusive_group is not None}
+            for task in list(pending):
+                if not all(status.get(dependency.name) in ('skipped', 'done') for dependency in task.dependencies):
+                    continue
+                if task.exclusive_group is not None and task.exclusive_group in busy_groups:
+                    continue
+                cpus, memory = min(task.cpus, cpu_budget), min(task.memory_gb, memory_budget_gb)
+                if cpus > free_cpus or memory > free_memory:
+                    continue
+                free_cpus -= cpus
+                free_memory -= memory
+                if task.exclusive_group is not None:
+                    busy_groups.add(task.exclusive_group)
+                pending.remove(task)
+                future = executor.submit(run_task, task, cpus, stamp_dir, log_dir, hash_cache, lock,
+                                         task.stage in force_stages)
+                running[future] = task
+
+            if not running:
+                # nothing can start (only possible with blocked tasks)
+                break
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                free_cpus += min(task.cpus, cpu_budget)
+                free_memory += min(task.memory_gb, memory_budget_gb)
+                try:
+                    status[task.name] = future.result()
+                except Exception as e:
+                    print(f"[{task.name}] An error occurred: {e}")
+                    status[task.name] = 'failed'
+            with lock, open(hash_cache_filepath, 'w') as f:
+                json.dump(hash_cache, f)
+
+    for task in pending:
+        status.setdefault(task.name, 'blocked')
+    return status
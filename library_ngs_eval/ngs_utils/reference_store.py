@@ -0,0 +1,128 @@
+import functools
+import hashlib
+import json
+import os
+import numpy as np
+import pysam
+
+# Reference store: the reference sequences and the windows that the mates are compared to, saved as
+# fixed-width byte arrays (one row per reference in FASTA order, i.e. by BAM reference id).
+# Workers memory-map the arrays, so the pages are shared between processes instead of copied.
+store_arrays = ['names', 'sequences', 'forward_windows', 'reverse_windows',
+                'difference_groups', 'difference_offsets', 'difference_positions']
+
+# Difference index: near-identical references (e.g. the single nucleotide variants of a design) form a group,
+# the store holds the positions where the references of each group differ. References of the same length are
+# near-identical if they are equal outside one of difference_segments segments (so single nucleotide variants
+# always are). The groups are the connected components of this relation.
+difference_segments = 16
+
+def fasta_hash(fasta_filepath):
+    """SHA-256 of the contents of a FASTA file."""
+    sha256 = hashlib.sha256()
+    with open(fasta_filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def build_reference_store(fasta_filepath, store_dir, forward_window, reverse_window):
+    """Builds the reference store of a FASTA file in store_dir, unless the store was built from the same FASTA
+    contents with the same windows (see metadata.json of the store).
+    The forward window holds the first forward_window bases of each reference (read 1), the reverse window
+    the last reverse_window bases in reverse order (read 2)."""
+    metadata = {'fasta_sha256': fasta_hash(fasta_filepath), 'forward_window': forward_window,
+                'reverse_window': reverse_window, 'difference_segments': difference_segments}
+    metadata_filepath = os.path.join(store_dir, 'metadata.json')
+    if os.path.exists(metadata_filepath) \
+            and all(os.path.exists(os.path.join(store_dir, f'{name}.npy')) for name in store_arrays):
+        with open(metadata_filepath) as f:
+            if json.load(f) == metadata:
+                return
+    os.makedirs(store_dir, exist_ok=True)
+
+    with pysam.FastaFile(fasta_filepath) as fasta:
+        names = list(fasta.references)
+        sequences = [fasta.fetch(name) for name in names]
+
+    difference_groups, difference_offsets, difference_positions = difference_index(sequences)
+    arrays = {
+        'difference_groups': difference_groups,
+        'difference_offsets': difference_offsets,
+        'difference_positions': difference_positions,
+        'sequences': np.array([sequence.encode() for sequence in sequences], dtype=bytes),
+        'forward_windows': np.array([sequence[:forward_window].encode() for sequence in sequences], dtype=bytes),
+        'reverse_windows': np.array([sequence[-reverse_window:][::-1].encode() for sequence in sequences], dtype=bytes),
+        'names': np.array(names, dtype=str),
+    }
+    # each file is written to a temporary file and renamed, so processes that build the store at the same time
+    # (e.g. stage 4 of several libraries started by run_pipeline.py) never read a partly written file
+    for name, array in arrays.items():
+        tmp_filepath = os.path.join(store_dir, f'{name}.{os.getpid()}.tmp.npy')
+        np.save(tmp_filepath, array)
+        os.replace(tmp_filepath, os.path.join(store_dir, f'{name}.npy'))
+    # written last, it marks a complete store
+    tmp_filepath = os.path.join(store_dir, f'metadata.{os.getpid()}.tmp.json')
+    with open(tmp_filepath, 'w') as f:
+        json.dump(metadata, f, indent=1)
+    os.replace(tmp_filepath, metadata_filepath)
+
+def difference_index(sequences):
+    """Groups near-identical sequences (see difference_segments).
+    Returns the group of each sequence (-1: no near-identical sequence), and the positions where the sequences
+    of group i differ as difference_positions[difference_offsets[i]:difference_offsets[i + 1]]."""
+    # union-find over the sequences that are equal after masking the same segment
+    parents = list(range(len(sequences)))
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+    for segment in range(difference_segments):
+        masked_ids = {}
+        for i, sequence in enumerate(sequences):
+            start = len(sequence) * segment // difference_segments
+            end = len(sequence) * (segment + 1) // difference_segments
+            key = (len(sequence), sequence[:start], sequence[end:])
+            first = masked_ids.setdefault(key, i)
+            if first != i:
+                parents[find(i)] = find(first)
+
+    members = {}
+    for i in range(len(sequences)):
+        members.setdefault(find(i), []).append(i)
+    difference_groups = np.full(len(sequences), -1, dtype=np.int32)
+    difference_offsets = [0]
+    difference_positions = []
+    for group in (ids for ids in members.values() if len(ids) > 1):
+        difference_groups[group] = len(difference_offsets) - 1
+        matrix = np.array([np.frombuffer(sequences[i].encode(), dtype=np.uint8) for i in group])
+        positions = np.flatnonzero((matrix != matrix[0]).any(axis=0))
+        difference_positions.append(positions)
+        difference_offsets.append(difference_offsets[-1] + len(positions))
+    difference_positions = np.concatenate(difference_positions) if difference_positions else np.zeros(0)
+    return difference_groups, np.array(difference_offsets, dtype=np.int64), difference_positions.astype(np.int32)
+
+@functools.lru_cache(maxsize=None)
+def open_reference_store(store_dir):
+    """Memory-maps the arrays of a reference store (once per process).
+    Returns a dictionary with the arrays of store_arrays."""
+    return {name: np.load(os.path.join(store_dir, f'{name}.npy'), mmap_mode='r') for name in store_arrays}
+
+def check_reference_store(reference_store, bam_references):
+    """Raises a ValueError if the references of a BAM header are not those of the store, in the same order."""
+    if list(reference_store['names']) != list(bam_references):
+        raise ValueError("The references of the BAM file do not match the reference store.")
+
+def forward_window(reference_store, reference_id):
+    return reference_store['forward_windows'][reference_id].decode()
+
+def reverse_window(reference_store, reference_id):
+    return reference_store['reverse_windows'][reference_id].decode()
+
+def reference_sequence(reference_store, reference_id):
+    return reference_store['sequences'][reference_id].decode()
+
+def difference_positions(reference_store, group):
+    """The positions where the references of a difference group differ."""
+    offsets = reference_store['difference_offsets']
+    return reference_store['difference_positions'][offsets[group]:offsets[group + 1]]
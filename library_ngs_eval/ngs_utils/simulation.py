@@ -0,0 +1,303 @@
+import gzip
+import re
+import numpy as np
+import pysam
+from .alignment_filter import dist_threshold, insertion_threshold, deletion_threshold
+
+# Synthetic read pairs with known origin, for benchmarks and regression tests.
+# The pairs have the layout of the raw sequencing data: read 1 is the start of a reference, read 2 starts with
+# the UMI, followed by the reverse complement of the end of the reference (which carries the internal index).
+# Bases are handled as codes 0-3 (ACGT), 4 is N.
+base_letters = np.frombuffer(b"ACGTN", dtype=np.uint8)
+base_codes = np.full(256, 4, dtype=np.uint8)
+for code, letter in enumerate(b"ACGT"):
+    base_codes[letter] = code
+    base_codes[ord(chr(letter).lower())] = code
+high_quality = ord('F')
+low_quality = ord('#')
+# indels per read are capped, the reference windows are this much longer than the reads
+max_indels = 3
+# fraction of the bases of a low quality tail that are sequencing errors
+tail_error_rate = 0.75
+
+truth_columns = ['read_id', 'reference_id', 'umi_code', 'index_mismatches', 'mismatches_1', 'mismatches_2',
+                 'insertions_1', 'deletions_1', 'insertions_2', 'deletions_2', 'cigar_1', 'cigar_2', 'expected_pass']
+
+def read_fasta(filepath):
+    """Returns the sequences of a FASTA file as a dictionary (name: sequence), in file order."""
+    with pysam.FastxFile(filepath) as fasta:
+        return {record.name: record.sequence.upper() for record in fasta}
+
+def write_fasta(references, filepath):
+    with open(filepath, 'w') as f:
+        for name, sequence in references.items():
+            f.write(f">{name}\n{sequence}\n")
+
+def reverse_complement(sequence):
+    return sequence.translate(str.maketrans("ACGTN", "TGCAN"))[::-1]
+
+def random_references(n_references, length, rng, index=None, index_offset=16):
+    """Random reference sequences. With index, the reverse complement of each reference carries the index
+    at index_offset (where read 2 reads it after the UMI)."""
+    references = {}
+    for i in range(n_references):
+        sequence = base_letters[rng.integers(4, size=length)].tobytes().decode()
+        if index is not None:
+            reverse = reverse_complement(sequence)
+            sequence = reverse_complement(reverse[:index_offset] + index + reverse[index_offset + len(index):])
+        references[f'sim_{i}'] = sequence
+    return references
+
+def add_variant_references(references, variant_fraction, read_1_length, rng):
+    """Adds a copy with one substitution in the read 1 window ({name}_variant) for variant_fraction
+    of the references. Reads of these references align to both copies (multi-mapping)."""
+    references = dict(references)
+    names = list(references)
+    for name in rng.choice(names, size=int(len(names) * variant_fraction), replace=False):
+        sequence = references[name]
+        position = int(rng.integers(min(read_1_length, len(sequence))))
+        substitute = "ACGT"[(base_codes[ord(sequence[position])] + rng.integers(1, 4)) % 4]
+        references[f'{name}_variant'] = sequence[:position] + substitute + sequence[position + 1:]
+    return references
+
+def reference_windows(references, read_1_length, read_2_length):
+    """Code matrices of the bases read 1 and read 2 (after the UMI) can come from, padded with N.
+    The read 2 window is reverse complemented, i.e. in the orientation of the read."""
+    windows_1 = np.full((len(references), read_1_length + max_indels), 4, dtype=np.uint8)
+    windows_2 = np.full((len(references), read_2_length + max_indels), 4, dtype=np.uint8)
+    for i, sequence in enumerate(references.values()):
+        window_1 = base_codes[np.frombuffer(sequence[:windows_1.shape[1]].encode(), dtype=np.uint8)]
+        window_2 = base_codes[np.frombuffer(reverse_complement(sequence)[:windows_2.shape[1]].encode(),
+                                            dtype=np.uint8)]
+        windows_1[i, :len(window_1)] = window_1
+        windows_2[i, :len(window_2)] = window_2
+    return windows_1, windows_2
+
+def apply_indels(window, length, n_insertions, n_deletions, rng):
+    """Reads length bases from a window with single-base insertions and deletions at random inner positions.
+    Returns the read codes and the CIGAR operations ([op, length] lists, in read orientation)."""
+    ops = ['I'] * n_insertions + ['D'] * n_deletions
+    rng.shuffle(ops)
+    positions = sorted(rng.choice(np.arange(1, length - 1), size=len(ops), replace=False).tolist())
+    parts = []
+    cigar = []
+    read_pos = reference_pos = 0
+    for position, op in zip(positions, ops):
+        # matching bases up to the read position of the indel
+        if position > read_pos:
+            parts.append(window[reference_pos:reference_pos + position - read_pos])
+            cigar.append(['M', position - read_pos])
+            reference_pos += position - read_pos
+            read_pos = position
+        if op == 'I':
+            parts.append(rng.integers(4, size=1, dtype=np.uint8))
+            read_pos += 1
+        else:
+            reference_pos += 1
+        cigar.append([op, 1])
+    parts.append(window[reference_pos:reference_pos + length - read_pos])
+    cigar.append(['M', length - read_pos])
+    return np.concatenate(parts), cigar
+
+def cigar_string(cigar):
+    return ''.join(f'{length}{op}' for op, length in cigar)
+
+def mutate_reads(reads, window_rows, rng, substitution_rate, insertion_rate, deletion_rate,
+                 low_quality_tail_fraction, max_tail_length):
+    """Takes the error-free reads (rows of a window matrix) and adds indels, substitutions and low quality tails.
+    Returns the read codes, the quality mask (True: high quality), the numbers of mismatching high quality bases,
+    insertions and deletions per read and the CIGAR strings."""
+    n_reads, length = reads.shape
+    n_insertions = np.minimum(rng.binomial(length, insertion_rate, size=n_reads), max_indels)
+    n_deletions = np.minimum(rng.binomial(length, deletion_rate, size=n_reads), max_indels - n_insertions)
+    cigars = np.full(n_reads, f'{length}M', dtype=object)
+    for i in np.flatnonzero(n_insertions + n_deletions):
+        reads[i], cigar = apply_indels(window_rows[i], length, n_insertions[i], n_deletions[i], rng)
+        cigars[i] = cigar_string(cigar)
+    original = reads.copy()
+
+    # random positions are drawn per read instead of a random number per base
+    n_substitutions = rng.binomial(length, substitution_rate, size=n_reads)
+    rows = np.repeat(np.arange(n_reads), n_substitutions)
+    columns = rng.integers(length, size=len(rows))
+    reads[rows, columns] = (reads[rows, columns] + rng.integers(1, 4, size=len(rows))) % 4
+
+    tail_lengths = np.where(rng.random(n_reads) < low_quality_tail_fraction,
+                            rng.integers(1, max_tail_length + 1, size=n_reads), 0)
+    quality_mask = np.arange(length) < (length - tail_lengths)[:, None]
+    tail_rows = np.flatnonzero(tail_lengths)
+    tail_errors = ~quality_mask[tail_rows] & (rng.random((len(tail_rows), length)) < tail_error_rate)
+    tail_reads = reads[tail_rows]
+    tail_reads[tail_errors] = rng.integers(4, size=tail_errors.sum())
+    reads[tail_rows] = tail_reads
+
+    mismatches = ((reads != original) & quality_mask).sum(axis=1)
+    return reads, quality_mask, mismatches, n_insertions, n_deletions, cigars
+
+def fastq_records(read_ids, mate, reads, quality_mask):
+    """FASTQ text of reads with fixed length (code matrix) as bytes."""
+    titles = np.frombuffer(b''.join(b'@SIM:%010d %d:N:0:1\n' % (read_id, mate) for read_id in read_ids.tolist()),
+                           dtype=np.uint8).reshape(len(reads), -1)
+    separator = np.frombuffer(b'\n+\n', dtype=np.uint8)
+    newline = np.frombuffer(b'\n', dtype=np.uint8)
+    qualities = np.where(quality_mask, high_quality, low_quality).astype(np.uint8)
+    return np.hstack([titles, base_letters[reads], np.broadcast_to(separator, (len(reads), 3)), qualities,
+                      np.broadcast_to(newline, (len(reads), 1))]).tobytes()
+
+def simulate_reads(references, fastq1_filepath, fastq2_filepath, truth_filepath, n_pairs, seed=0,
+                   read_1_length=150, read_2_length=140, umi_length=10, molecules_per_reference=100,
+                   abundance_sigma=1.0, index_start=26, index_length=6, max_index_mismatches=1, index_error_rate=0.0,
+                   substitution_rate=0.001, insertion_rate=0.0001, deletion_rate=0.0001,
+                   low_quality_tail_fraction=0.1, max_tail_length=30, batch_size=1000000):
+    """Writes n_pairs synthetic read pairs of the references (name: sequence) to two gzipped FASTQ files
+    and the origin of each pair to a parquet file (truth_columns, needs pyarrow).
+
+    The references are drawn with log-normal abundances (abundance_sigma), each has molecules_per_reference
+    molecules with random UMIs. Reads get substitutions, single-base indels and low quality tails at the given
+    rates; the index region of read 2 gets additional substitutions at index_error_rate.
+    expected_pass marks the pairs that should pass stage 1 (index) and stage 4 (edit distance and indels)."""
+    import pyarrow
+    import pyarrow.parquet
+    rng = np.random.default_rng(seed)
+    windows_1, windows_2 = reference_windows(references, read_1_length, read_2_length)
+    n_references = len(references)
+    abundances = rng.lognormal(0, abundance_sigma, size=n_references)
+    abundances /= abundances.sum()
+    umi_table = rng.integers(4 ** umi_length, size=(n_references, molecules_per_reference))
+    umi_shifts = 2 * np.arange(umi_length - 1, -1, -1)
+    # the index region of read 2 after the UMI, in the reference
+    index_region = slice(index_start - umi_length, index_start - umi_length + index_length)
+
+    with gzip.open(fastq1_filepath, 'wb', compresslevel=1) as fastq1, \
+            gzip.open(fastq2_filepath, 'wb', compresslevel=1) as fastq2, \
+            pyarrow.parquet.ParquetWriter(truth_filepath, pyarrow.schema([
+                ('read_id', pyarrow.int64()), ('reference_id', pyarrow.int32()), ('umi_code', pyarrow.int64()),
+                ('index_mismatches', pyarrow.int8()), ('mismatches_1', pyarrow.int16()),
+                ('mismatches_2', pyarrow.int16()), ('insertions_1', pyarrow.int8()), ('deletions_1', pyarrow.int8()),
+                ('insertions_2', pyarrow.int8()), ('deletions_2', pyarrow.int8()), ('cigar_1', pyarrow.string()),
+                ('cigar_2', pyarrow.string()), ('expected_pass', pyarrow.bool_())])) as truth:
+        for first_read_id in range(0, n_pairs, batch_size):
+            n_batch = min(batch_size, n_pairs - first_read_id)
+            read_ids = np.arange(first_read_id, first_read_id + n_batch)
+            reference_ids = rng.choice(n_references, size=n_batch, p=abundances)
+            umi_codes = umi_table[reference_ids, rng.integers(molecules_per_reference, size=n_batch)]
+
+            rows_1, rows_2 = windows_1[reference_ids], windows_2[reference_ids]
+            reads_1, mask_1, mismatches_1, insertions_1, deletions_1, cigars_1 = mutate_reads(
+                rows_1[:, :read_1_length].copy(), rows_1, rng, substitution_rate, insertion_rate, deletion_rate,
+                low_quality_tail_fraction, max_tail_length)
+            reads_2, mask_2, mismatches_2, insertions_2, deletions_2, cigars_2 = mutate_reads(
+                rows_2[:, :read_2_length].copy(), rows_2, rng, substitution_rate, insertion_rate, deletion_rate,
+                low_quality_tail_fraction, max_tail_length)
+            index_errors = rng.random((n_batch, index_length)) < index_error_rate
+            index_bases = reads_2[:, index_region]
+            index_bases[index_errors] = (index_bases[index_errors] + rng.integers(1, 4, size=index_errors.sum())) % 4
+            reads_2[:, index_region] = index_bases
+            mismatches_2 += (index_errors & mask_2[:, index_region]).sum(axis=1)
+            index_mismatches = (reads_2[:, index_region] != rows_2[:, index_region]).sum(axis=1)
+
+            # read 2 starts with the UMI (always high quality)
+            umi_bases = ((umi_codes[:, None] >> umi_shifts) & 3).astype(np.uint8)
+            raw_reads_2 = np.hstack([umi_bases, reads_2])
+            raw_mask_2 = np.hstack([np.ones((n_batch, umi_length), dtype=bool), mask_2])
+
+            insertions = insertions_1 + insertions_2
+            deletions = deletions_1 + deletions_2
+            expected_pass = (index_mismatches <= max_index_mismatches) \
+                & (mismatches_1 + mismatches_2 + insertions + deletions < dist_threshold) \
+                & (insertions < insertion_threshold) & (deletions < deletion_threshold)
+
+            fastq1.write(fastq_records(read_ids, 1, reads_1, mask_1))
+            fastq2.write(fastq_records(read_ids, 2, raw_reads_2, raw_mask_2))
+            truth.write_table(pyarrow.table({
+                'read_id': read_ids, 'reference_id': reference_ids.astype(np.int32), 'umi_code': umi_codes,
+                'index_mismatches': index_mismatches.astype(np.int8), 'mismatches_1': mismatches_1.astype(np.int16),
+                'mismatches_2': mismatches_2.astype(np.int16), 'insertions_1': insertions_1.astype(np.int8),
+                'deletions_1': deletions_1.astype(np.int8), 'insertions_2': insertions_2.astype(np.int8),
+                'deletions_2': deletions_2.astype(np.int8), 'cigar_1': cigars_1.tolist(),
+                'cigar_2': cigars_2.tolist(), 'expected_pass': expected_pass}, schema=truth.schema))
+
+def expected_counts(truth_filepath, n_references, umi_length=10):
+    """Counts the molecules (reference, UMI) with at least one pair that is expected to pass, per reference."""
+    import pyarrow.parquet
+    keys = []
+    for batch in pyarrow.parquet.ParquetFile(truth_filepath).iter_batches(
+            columns=['reference_id', 'umi_code', 'expected_pass']):
+        passed = batch.column('expected_pass').to_numpy(zero_copy_only=False)
+        reference_ids = batch.column('reference_id').to_numpy()[passed].astype(np.int64)
+        keys.append(np.unique(reference_ids * 4 ** umi_length + batch.column('umi_code').to_numpy()[passed]))
+    molecules = np.unique(np.concatenate(keys)) if keys else np.zeros(0, dtype=np.int64)
+    return np.bincount(molecules // 4 ** umi_length, minlength=n_references)
+
+def alignment_score(n_bases, mismatches, insertions, deletions):
+    # bwa mem scoring: match 1, mismatch -4, gap open -6 and extension -1 (single-base indels)
+    return n_bases - insertions - 5 * mismatches - 7 * (insertions + deletions)
+
+def write_truth_alignments(fastq1_filepath, fastq2_filepath, truth_filepath, references, bam_filepath):
+    """Writes a name-grouped BAM file like bwa mem -a would for the split reads of stage 1, using the known
+    origin of each pair instead of aligning (for benchmarks without bwa). Pairs of references with a variant
+    (add_variant_references) get a secondary alignment to the other copy, with the score lowered by the
+    differences between the copies in the read."""
+    import pyarrow.parquet
+    names = list(references)
+    name_ids = {name: i for i, name in enumerate(names)}
+    # copies of the same design, with the positions where they differ
+    siblings = {i: [] for i in range(len(names))}
+    for name, sequence in references.items():
+        if name.endswith('_variant') and name[:-len('_variant')] in name_ids:
+            original = name[:-len('_variant')]
+            positions = [i for i, (a, b) in enumerate(zip(references[original], sequence)) if a != b]
+            siblings[name_ids[original]].append((name_ids[name], positions))
+            siblings[name_ids[name]].append((name_ids[original], positions))
+    header = {'HD': {'VN': '1.6', 'SO': 'unsorted'},
+              'SQ': [{'SN': name, 'LN': len(sequence)} for name, sequence in references.items()]}
+
+    truth_batches = pyarrow.parquet.ParquetFile(truth_filepath).iter_batches(
+        columns=['read_id', 'reference_id', 'mismatches_1', 'mismatches_2', 'insertions_1', 'deletions_1',
+                 'insertions_2', 'deletions_2', 'cigar_1', 'cigar_2'])
+    truth_rows = (row for batch in truth_batches for row in batch.to_pylist())
+    with pysam.FastxFile(fastq1_filepath) as fastq1, pysam.FastxFile(fastq2_filepath) as fastq2, \
+            pysam.AlignmentFile(bam_filepath, 'wb', header=header) as bam_out:
+        for record1, record2 in zip(fastq1, fastq2):
+            # stage 1 keeps the order of the reads and appends the UMI to the name (SIM:{read id}_{UMI})
+            read_id = int(record1.name.split(':')[1].split('_')[0])
+            row = next(truth_rows)
+            while row['read_id'] != read_id:
+                row = next(truth_rows)
+            reference_id = row['reference_id']
+            reference_length = len(references[names[reference_id]])
+            for mate, record in ((1, record1), (2, record2)):
+                cigar = row[f'cigar_{mate}']
+                n_bases = len(record.sequence)
+                score = alignment_score(n_bases, row[f'mismatches_{mate}'], row[f'insertions_{mate}'],
+                                        row[f'deletions_{mate}'])
+                hits = [(reference_id, score)]
+                for sibling_id, positions in siblings[reference_id]:
+                    if mate == 1:
+                        differences = sum(position < n_bases for position in positions)
+                    else:
+                        differences = sum(position >= reference_length - n_bases for position in positions)
+                    hits.append((sibling_id, score - 5 * differences))
+                for hit_index, (hit_id, hit_score) in enumerate(hits):
+                    alignment = pysam.AlignedSegment(bam_out.header)
+                    alignment.query_name = record.name
+                    alignment.reference_id = hit_id
+                    if mate == 1:
+                        alignment.flag = 1 | 32 | 64
+                        alignment.reference_start = 0
+                        alignment.cigarstring = cigar
+                        sequence, qualities = record.sequence, record.quality
+                    else:
+                        # read 2 is on the reverse strand, BAM stores it in reference orientation
+                        alignment.flag = 1 | 16 | 128
+                        n_reference_bases = len(record.sequence) - row['insertions_2'] + row['deletions_2']
+                        alignment.reference_start = max(len(references[names[hit_id]]) - n_reference_bases, 0)
+                        alignment.cigarstring = ''.join(reversed(re.findall(r'\d+[MID]', cigar)))
+                        sequence, qualities = reverse_complement(record.sequence), record.quality[::-1]
+                    if hit_index == 0:
+                        alignment.query_sequence = sequence
+                        alignment.query_qualities = pysam.qualitystring_to_array(qualities)
+                    else:
+                        alignment.flag |= 256
+                    alignment.set_tag('AS', hit_score)
+                    bam_out.write(alignment)
@@ -0,0 +1,242 @@
+import collections
+import concurrent.futures
+import contextlib
+import gzip
+import os
+import queue
+import struct
+import threading
+import zlib
+
+# Threaded I/O for gzipped FASTQ files, drop-ins for gzip.open(filepath, 'rb') and gzip.open(filepath, 'wb').
+# zlib releases the GIL, so decompressing in a background thread and compressing in a thread pool
+# runs in parallel to the parsing in the main thread.
+# The output is block-gzip (BGZF, like bgzip and BAM files): independent gzip members of up to 64 kB,
+# which gzip, bwa and samtools read like any gzip file.
+read_chunk_size = 1024 * 1024
+# decompressed chunks that the reader thread may read ahead
+read_ahead_chunks = 16
+# uncompressed bytes per BGZF block (the BGZF limit is 65536 including the header)
+bgzf_block_size = 65280
+# blocks compressed per task of the thread pool
+bgzf_blocks_per_task = 64
+bgzf_header = struct.Struct("<4sIBBH2sHH")
+bgzf_eof = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+class ReadAheadReader:
+    """Reads a gzipped file in a background thread, with up to read_ahead_chunks decompressed chunks in a queue."""
+    def __init__(self, filepath, chunk_size=read_chunk_size, max_chunks=read_ahead_chunks):
+        self._handle = gzip.open(filepath, 'rb')
+        self._chunks = queue.Queue(maxsize=max_chunks)
+        self._chunk_size = chunk_size
+        self._buffer = b""
+        self._eof = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        # gives up if the reader is closed before the file is read to the end
+        while not self._stop.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        try:
+            while True:
+                chunk = self._handle.read(self._chunk_size)
+                if not self._put(chunk) or not chunk:
+                    return
+        except Exception as e:
+            # raised in the thread that reads
+            self._put(e)
+
+    def _next_chunk(self):
+        chunk = self._chunks.get()
+        if isinstance(chunk, Exception):
+            raise chunk
+        if not chunk:
+            self._eof = True
+        return chunk
+
+    def read(self, size=-1):
+        """Returns up to size bytes (all remaining bytes if size is negative), b"" at the end of the file."""
+        if size is None or size < 0:
+            chunks = [self._buffer]
+            while not self._eof:
+                chunks.append(self._next_chunk())
+            self._buffer = b""
+            return b"".join(chunks)
+        # like gzip, returns size bytes unless the file ends (callers read batches of records)
+        chunks, n_bytes = [self._buffer], len(self._buffer)
+        while n_bytes < size and not self._eof:
+            chunk = self._next_chunk()
+            chunks.append(chunk)
+            n_bytes += len(chunk)
+        data = b"".join(chunks)
+        data, self._buffer = data[:size], data[size:]
+        return data
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def bgzf_compress(data, compresslevel):
+    """Compresses data to BGZF blocks."""
+    blocks = []
+    for start in range(0, len(data), bgzf_block_size):
+        block = data[start:start + bgzf_block_size]
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+        compressed = compressor.compress(block) + compressor.flush()
+        # 18 bytes header, 8 bytes CRC32 and size; the BSIZE field holds the block size - 1
+        blocks.append(bgzf_header.pack(b"\x1f\x8b\x08\x04", 0, 0, 255, 6, b"BC", 2, len(compressed) + 25))
+        blocks.append(compressed)
+        blocks.append(struct.pack("<II", zlib.crc32(block), len(block)))
+    return b"".join(blocks)
+
+class BgzfWriter:
+    """Writes a BGZF file, the blocks are compressed by a pool of threads and written in order."""
+    def __init__(self, filepath, compresslevel=5, threads=4):
+        self._handle = open(filepath, 'wb')
+        self._compresslevel = compresslevel
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self._pending = collections.deque()
+        self._max_pending = 2 * threads
+        self._buffer = []
+        self._buffer_size = 0
+        self._task_size = bgzf_block_size * bgzf_blocks_per_task
+
+    def _submit(self, data):
+        self._pending.append(self._executor.submit(bgzf_compress, data, self._compresslevel))
+        while len(self._pending) > self._max_pending:
+            self._handle.write(self._pending.popleft().result())
+
+    def write(self, data):
+        n_bytes = len(data)
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        if self._buffer_size >= self._task_size:
+            data = b"".join(self._buffer)
+            n_full = len(data) // self._task_size * self._task_size
+            self._submit(data[:n_full])
+            self._buffer = [data[n_full:]]
+            self._buffer_size = len(data) - n_full
+        return n_bytes
+
+    def close(self):
+        if self._handle.closed:
+            return
+        if self._buffer_size:
+            self._submit(b"".join(self._buffer))
+        self._buffer, self._buffer_size = [], 0
+        while self._pending:
+            self._handle.write(self._pending.popleft().result())
+        self._executor.shutdown()
+        self._handle.write(bgzf_eof)
+        self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class PipeWriter:
+    """Writes uncompressed data to a file (e.g. a FIFO) in a background thread, with up to max_chunks pending writes.
+    A reader that reads several FIFOs in turn (like bwa the two reads of a pair) gets the data of each FIFO
+    while a write to another one blocks."""
+    def __init__(self, filepath, max_chunks=read_ahead_chunks):
+        self._filepath = filepath
+        self._chunks = queue.Queue(maxsize=max_chunks)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            with open(self._filepath, 'wb') as handle:
+                while True:
+                    chunk = self._chunks.get()
+                    if chunk is None:
+                        return
+                    handle.write(chunk)
+        except Exception as e:
+            # raised in the thread that writes
+            self._error = e
+
+    def _put(self, item):
+        # gives up if the thread stopped, e.g. because the reader of the FIFO exited
+        while self._thread.is_alive():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        if self._error is not None:
+            raise self._error
+        raise BrokenPipeError(f"{self._filepath} is closed")
+
+    def write(self, data):
+        self._put(data)
+        return len(data)
+
+    def close(self):
+        if self._thread.is_alive():
+            self._put(None)
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def open_reader(filepath, threaded=True):
+    """Opens a gzipped file for binary reading, with read-ahead in a background thread if threaded."""
+    return ReadAheadReader(filepath) if threaded else gzip.open(filepath, 'rb')
+
+def open_writer(filepath, compresslevel=5, threads=4):
+    """Opens a file for writing gzipped data: BGZF compressed by threads threads (0: single-threaded gzip).
+    compresslevel None: the data is written uncompressed by a background thread (e.g. to a FIFO, see PipeWriter)."""
+    if compresslevel is None:
+        return PipeWriter(filepath)
+    return BgzfWriter(filepath, compresslevel, threads) if threads > 0 else gzip.open(filepath, 'wb',
+                                                                                      compresslevel=compresslevel)
+
+@contextlib.contextmanager
+def fifo_writer(fifo_filepaths, func, *args, **kwargs):
+    """Creates FIFOs at fifo_filepaths and runs func(*args, **kwargs), which writes to them, in a thread while the
+    with block runs the reader of the FIFOs (e.g. a subprocess). Yields the future of the result of func.
+    If the reader stops before the end (or never opens a FIFO), func gets a BrokenPipeError instead of blocking.
+    The FIFOs are removed at the end of the with block."""
+    for filepath in fifo_filepaths:
+        # FIFOs of an interrupted run
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        os.mkfifo(filepath)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    try:
+        future = executor.submit(func, *args, **kwargs)
+        yield future
+    finally:
+        # opening a FIFO blocks until the other end is opened, a reader that opens and closes releases the writer
+        while not future.done():
+            for filepath in fifo_filepaths:
+                os.close(os.open(filepath, os.O_RDONLY | os.O_NONBLOCK))
+            concurrent.futures.wait([future], timeout=0.1)
+        executor.shutdown()
+        for filepath in fifo_filepaths:
+            os.remove(filepath)
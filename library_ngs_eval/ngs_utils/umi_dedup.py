@@ -0,0 +1,302 @@
+import array
+import concurrent.futures
+import numpy as np
+import pandas as pd
+import pysam
+from .metrics import optional_phase
+
+# UMIs are packed into integers with 2 bits per base (A=0, C=1, G=2, T=3)
+umi_digits = str.maketrans("ACGT", "0123")
+# the UMI codes of a reference are collected in a buffer, which is merged into the sorted unique codes of the
+# reference when it holds umi_buffer_size codes (see UmiCounts)
+umi_buffer_size = 1 << 16
+
+def umi_from_query_name(query_name):
+    # the split stage appends the UMI to the read name (the default separator of umi_tools)
+    return query_name.rsplit('_', 1)[-1]
+
+def encode_umi(umi, other_umis):
+    """Packs a UMI into an integer. UMIs with other characters (e.g. N) can not be packed; they get the codes
+    from 4**len(umi) upwards in order of appearance, other_umis maps them to their code."""
+    try:
+        return int(umi.translate(umi_digits), 4)
+    except ValueError:
+        return other_umis.setdefault(umi, 4 ** len(umi) + len(other_umis))
+
+def umi_matrix(codes, umi_length, other_umis):
+    """Decodes an array of UMI codes to a uint8 array of shape (n_umis, umi_length) with the UMI characters."""
+    shifts = 2 * np.arange(umi_length - 1, -1, -1)
+    matrix = np.frombuffer(b"ACGT", dtype=np.uint8)[(codes[:, None] >> shifts) & 3]
+    if other_umis:
+        umis_by_code = {code: umi for umi, code in other_umis.items()}
+        for i in np.flatnonzero(codes >= 4 ** umi_length):
+            matrix[i] = np.frombuffer(umis_by_code[codes[i]].encode(), dtype=np.uint8)
+    return matrix
+
+class UmiCounts:
+    """Read counts per reference and UMI code, packed per reference: a buffer with the codes and read indices of the
+    latest reads (uint32 arrays) and the sorted unique codes of the reads before, with their number of reads and the
+    index of their first read (numpy arrays). UMIs of up to 15 nt are packed into uint32 (longer ones into uint64)."""
+    def __init__(self, umi_length):
+        self.typecode = 'I' if umi_length <= 15 else 'Q'
+        self.n_reads = 0
+        self._buffers = {}
+        self._merged = {}
+
+    def add(self, reference_id, code):
+        """Counts a read and returns its index."""
+        buffer = self._buffers.get(reference_id)
+        if buffer is None:
+            buffer = self._buffers[reference_id] = (array.array(self.typecode), array.array('I'))
+        buffer[0].append(code)
+        buffer[1].append(self.n_reads)
+        if len(buffer[0]) >= umi_buffer_size:
+            self._merge(reference_id)
+        self.n_reads += 1
+        return self.n_reads - 1
+
+    def _merge(self, reference_id):
+        codes, reads = (np.array(values) for values in self._buffers.pop(reference_id))
+        counts = np.ones(len(codes), dtype=np.int64)
+        if reference_id in self._merged:
+            merged_codes, merged_counts, merged_reads = self._merged[reference_id]
+            codes = np.concatenate([merged_codes, codes])
+            counts = np.concatenate([merged_counts, counts])
+            reads = np.concatenate([merged_reads, reads])
+        # the reads are in order, so the first occurrence of a code (stable sort) is its first read
+        codes, first, inverse = np.unique(codes, return_index=True, return_inverse=True)
+        self._merged[reference_id] = (codes, np.bincount(inverse.ravel(), weights=counts).astype(np.int64),
+                                      reads[first])
+
+    def arrays(self):
+        """Returns arrays of reference ids, UMI codes, reads and the index of the first read, sorted by reference id
+        and UMI (all int64)."""
+        for reference_id in list(self._buffers):
+            self._merge(reference_id)
+        reference_ids = sorted(self._merged)
+        merged = [self._merged[reference_id] for reference_id in reference_ids]
+        if not merged:
+            return tuple(np.zeros(0, dtype=np.int64) for _ in range(4))
+        return (np.repeat(np.array(reference_ids, dtype=np.int64), [len(codes) for codes, _, _ in merged]),
+                *(np.concatenate([arrays[i] for arrays in merged]).astype(np.int64) for i in range(3)))
+
+def count_umis(bam_in, umi_counts, other_umis):
+    """Counts the read 1 alignments (and merged reads) per reference id and UMI code in umi_counts (a UmiCounts).
+    The reads are numbered in file order (see write_first_reads).
+    The file may be name-grouped, coordinate-sorted or unsorted."""
+    add = umi_counts.add
+    for read in bam_in:
+        # read 2 is not counted (samtools view -F 128 in stage 5), merged reads are single-end
+        if read.is_read2 or read.is_unmapped:
+            continue
+        add(read.reference_id, encode_umi(umi_from_query_name(read.query_name), other_umis))
+
+def umi_keys(reference_ids, codes, umi_length):
+    """Packs reference ids and UMI codes into one sortable int64 key. The codes take 2 * umi_length + 1 bits
+    (the packed UMIs and the codes of other UMIs from 4**umi_length upwards), the reference ids the bits above."""
+    umi_bits = 2 * umi_length + 1
+    reference_bits = int(reference_ids.max()).bit_length() if len(reference_ids) else 0
+    assert(reference_bits + umi_bits <= 63)
+    return (reference_ids << umi_bits) | codes
+
+def average_umi_distances(bundles, umis, n_bundles):
+    """Average Hamming distance between all pairs of distinct UMIs within each bundle (-1 for bundles with a single UMI).
+    umis is the character matrix of umi_matrix, bundles the bundle index of each row.
+    The pairs are not compared one by one: per position, the number of differing pairs is the number of all pairs
+    minus the pairs with the same base."""
+    n_umis = np.bincount(bundles, minlength=n_bundles)
+    n_pairs = n_umis * (n_umis - 1) // 2
+    n_differences = np.zeros(n_bundles, dtype=np.int64)
+    for position in range(umis.shape[1]):
+        keys, n_same_base = np.unique(bundles * 256 + umis[:, position], return_counts=True)
+        same_base_pairs = np.bincount(keys // 256, weights=n_same_base * (n_same_base - 1) // 2, minlength=n_bundles)
+        n_differences += n_pairs - same_base_pairs.astype(np.int64)
+    distances = np.full(n_bundles, -1.0)
+    has_pairs = n_pairs > 0
+    distances[has_pairs] = n_differences[has_pairs] / n_pairs[has_pairs]
+    return distances
+
+def bundle_indices(reference_ids):
+    """Numbers the bundles (references) of sorted UMI count arrays from 0. Returns the indices and the number of bundles."""
+    bundles = np.unique(reference_ids, return_inverse=True)[1].ravel()
+    return bundles, (bundles.max() + 1 if len(bundles) else 0)
+
+def write_dedup_stats(stats_prefix, method, umi_counts_pre, umi_counts_post, other_umis, umi_length, seed=0):
+    """Writes the statistics files of umi_tools dedup --output-stats (per_umi_per_position.tsv, per_umi.tsv
+    and edit_distance.tsv). The UMI counts before and after deduplication are tuples of arrays as returned by
+    UmiCounts.arrays (without the first reads); after deduplication, each UMI holds the reads of its cluster.
+    A bundle is a reference, as all reads start at its first position."""
+    reference_ids_pre, codes_pre, counts_pre = umi_counts_pre
+    reference_ids_post, codes_post, counts_post = umi_counts_post
+    umis_pre = umi_matrix(codes_pre, umi_length, other_umis)
+    umis_post = umi_matrix(codes_post, umi_length, other_umis)
+
+    # histogram of reads per UMI and bundle
+    instances_pre = np.bincount(counts_pre)
+    instances_post = np.bincount(counts_post)
+    n_counts = max(len(instances_pre), len(instances_post))
+    instances_pre = np.pad(instances_pre, (0, n_counts - len(instances_pre)))
+    instances_post = np.pad(instances_post, (0, n_counts - len(instances_post)))
+    observed = np.flatnonzero(instances_pre + instances_post)
+    pd.DataFrame({'instances_pre': instances_pre[observed], 'instances_post': instances_post[observed]},
+                 index=pd.Index(observed, name='counts')).to_csv(stats_prefix + "_per_umi_per_position.tsv", sep="\t")
+
+    # reads per UMI over all bundles
+    def aggregate_umis(umis, counts):
+        umi_names = umis.view(f"S{umi_length}").ravel().astype(str)
+        aggregated = pd.DataFrame({'UMI': umi_names, 'counts': counts}).groupby('UMI')['counts'].agg(['median', 'size', 'sum'])
+        aggregated.columns = ['median_counts', 'times_observed', 'total_counts']
+        return aggregated
+    per_umi = pd.merge(aggregate_umis(umis_pre, counts_pre), aggregate_umis(umis_post, counts_post), how='left',
+                       left_index=True, right_index=True, sort=True, suffixes=["_pre", "_post"])
+    per_umi.fillna(0).astype(int).to_csv(stats_prefix + "_per_umi.tsv", sep="\t")
+
+    # average distance between the UMIs of a bundle, before and after deduplication and for
+    # the same number of UMIs drawn at random from all reads
+    rng = np.random.default_rng(seed)
+    def null_distances(bundles, n_bundles):
+        random_umis = umis_pre[rng.choice(len(umis_pre), size=len(bundles), p=counts_pre / counts_pre.sum())] \
+            if len(bundles) else umis_pre[:0]
+        return average_umi_distances(bundles, random_umis, n_bundles)
+    bundles_pre, n_bundles_pre = bundle_indices(reference_ids_pre)
+    bundles_post, n_bundles_post = bundle_indices(reference_ids_post)
+    distances = {
+        'unique': average_umi_distances(bundles_pre, umis_pre, n_bundles_pre),
+        'unique_null': null_distances(bundles_pre, n_bundles_pre),
+        method: average_umi_distances(bundles_post, umis_post, n_bundles_post),
+        f'{method}_null': null_distances(bundles_post, n_bundles_post),
+    }
+    max_distance = int(max((d.max() for d in distances.values() if len(d)), default=0))
+    bins = list(range(-1, max_distance + 2))
+    edit_distance = pd.DataFrame({name: np.bincount(np.digitize(d, bins, right=True), minlength=len(bins))[:len(bins)]
+                                  for name, d in distances.items()})
+    edit_distance['edit_distance'] = ["Single_UMI"] + bins[1:]
+    edit_distance.to_csv(stats_prefix + "_edit_distance.tsv", index=False, sep="\t")
+
+def substitution_masks(umi_length):
+    """XOR masks that turn a packed UMI into each of its 3 * umi_length single-substitution neighbours."""
+    return np.array([substitution << (2 * position) for position in range(umi_length) for substitution in (1, 2, 3)],
+                    dtype=np.int64)
+
+def directional_clusters(codes, counts, umi_length):
+    """Clusters the UMIs of one bundle like umi_tools --method directional (threshold 1).
+
+    A UMI a is connected to a UMI b one substitution away if counts(a) >= 2 * counts(b) - 1. Starting with the
+    UMI with the most reads, each cluster takes all UMIs reachable from it that are not in a cluster yet.
+    The neighbours are found by probing the 3 * umi_length substitutions of each UMI in the sorted codes
+    instead of comparing all pairs. UMIs with other characters than ACGT form their own clusters.
+    codes must be sorted. Returns the index of the representative UMI (the one with the most reads,
+    the first on ties) of the cluster of each UMI."""
+    n_umis = len(codes)
+    # directed edges to all neighbours with few enough reads
+    neighbours = codes[:, None] ^ substitution_masks(umi_length)
+    positions = np.minimum(np.searchsorted(codes, neighbours), max(n_umis - 1, 0))
+    is_edge = (codes[positions] == neighbours) & (codes[:, None] < 4 ** umi_length) \
+        & (counts[:, None] >= 2 * counts[positions] - 1)
+    sources, targets = np.nonzero(is_edge)
+    targets = positions[sources, targets]
+    edge_starts = np.searchsorted(sources, np.arange(n_umis + 1)).tolist()
+    targets = targets.tolist()
+
+    representatives = [-1] * n_umis
+    # UMIs with more reads first, on ties in UMI order
+    for start in np.lexsort((codes, -counts)).tolist():
+        if representatives[start] != -1:
+            continue
+        # UMIs that are reached from a clustered UMI belong to its cluster already, so the search stops there
+        representatives[start] = start
+        queue = [start]
+        while queue:
+            node = queue.pop()
+            for target in targets[edge_starts[node]:edge_starts[node + 1]]:
+                if representatives[target] == -1:
+                    representatives[target] = start
+                    queue.append(target)
+    return np.array(representatives, dtype=np.int64)
+
+def cluster_reference_umis(codes, counts, umi_length):
+    """Clusters the UMIs of several bundles given as lists of (codes, counts) arrays.
+    Returns the representative index of each UMI per bundle (see directional_clusters)."""
+    return [directional_clusters(bundle_codes, bundle_counts, umi_length)
+            for bundle_codes, bundle_counts in zip(codes, counts)]
+
+def cluster_umis(umi_counts_pre, umi_length, n_workers=1, bundles_per_task=1000):
+    """Clusters the UMIs of all references with directional_clusters, in a process pool if n_workers > 1.
+    Returns the UMI counts after deduplication (one entry with the reads of the cluster per representative UMI)
+    as a tuple of arrays like UmiCounts.arrays (without the first reads)."""
+    reference_ids, codes, counts = umi_counts_pre
+    bundle_starts = np.flatnonzero(np.diff(reference_ids, prepend=-2)).tolist() + [len(reference_ids)]
+    bundles = [(start, end) for start, end in zip(bundle_starts[:-1], bundle_starts[1:])]
+    tasks = [bundles[i:i + bundles_per_task] for i in range(0, len(bundles), bundles_per_task)]
+    task_args = [([codes[start:end] for start, end in task], [counts[start:end] for start, end in task], umi_length)
+                 for task in tasks]
+    if n_workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(cluster_reference_umis, *zip(*task_args)))
+    else:
+        results = [cluster_reference_umis(*args) for args in task_args]
+
+    # index of the representative of each UMI in the arrays of all references
+    representatives = np.concatenate([bundle_representatives + start for task, result in zip(tasks, results)
+                                      for (start, _), bundle_representatives in zip(task, result)]) \
+        if bundles else np.zeros(0, dtype=np.int64)
+    cluster_counts = np.bincount(representatives, weights=counts, minlength=len(counts)).astype(np.int64)
+    is_representative = representatives == np.arange(len(representatives))
+    return reference_ids[is_representative], codes[is_representative], cluster_counts[is_representative]
+
+def write_first_reads(input_filepath, output_filepath, read_indices):
+    """Writes the read 1 alignments with the given indices (sorted, numbered like count_umis) to output_filepath."""
+    read_indices = read_indices.tolist()
+    with pysam.AlignmentFile(input_filepath, "rb") as bam_in, \
+            pysam.AlignmentFile(output_filepath, "wb", template=bam_in) as bam_out:
+        n_reads, next_index = 0, 0
+        for read in bam_in:
+            if next_index == len(read_indices):
+                break
+            if read.is_read2 or read.is_unmapped:
+                continue
+            if n_reads == read_indices[next_index]:
+                bam_out.write(read)
+                next_index += 1
+            n_reads += 1
+
+def deduplicate_bam(input_filepath, output_filepath, stats_prefix, umi_length, method='unique', n_workers=1,
+                    metrics=None):
+    """Deduplicates the read 1 alignments of a BAM file by reference and UMI (without sorting or index)
+    and writes umi_tools-like statistics to stats_prefix.
+    method 'unique' keeps every UMI, 'directional' merges UMIs with sequencing errors (see directional_clusters)
+    using n_workers processes. The first read of each remaining UMI is written to output_filepath.
+    The phases and read counts are recorded in metrics (a StageMetrics object) if given.
+    Returns the number of deduplicated reads per reference."""
+    if method not in ('unique', 'directional'):
+        raise ValueError(f"Unknown deduplication method: {method}")
+    umi_counts = UmiCounts(umi_length)
+    other_umis = {}
+    with optional_phase(metrics, 'count_umis'), pysam.AlignmentFile(input_filepath, "rb") as bam_in:
+        references = bam_in.references
+        count_umis(bam_in, umi_counts, other_umis)
+
+    reference_ids_pre, codes_pre, counts_pre, first_reads = umi_counts.arrays()
+    umi_counts_pre = (reference_ids_pre, codes_pre, counts_pre)
+    if method == 'unique':
+        umi_counts_post = umi_counts_pre
+        kept_first_reads = first_reads
+    else:
+        with optional_phase(metrics, 'cluster'):
+            umi_counts_post = cluster_umis(umi_counts_pre, umi_length, n_workers)
+        # the representatives are a subset of the UMIs before clustering, in the same order
+        kept_first_reads = first_reads[np.searchsorted(umi_keys(reference_ids_pre, codes_pre, umi_length),
+                                                        umi_keys(*umi_counts_post[:2], umi_length))]
+    with optional_phase(metrics, 'write'):
+        write_first_reads(input_filepath, output_filepath, np.sort(kept_first_reads))
+    with optional_phase(metrics, 'stats'):
+        write_dedup_stats(stats_prefix, method, umi_counts_pre, umi_counts_post, other_umis, umi_length)
+
+    reference_ids = umi_counts_post[0]
+    print(f"Input reads: {umi_counts_pre[2].sum()}, output reads: {len(reference_ids)}, "
+          f"UMIs with other characters than ACGT: {len(other_umis)}")
+    reads_per_reference = np.bincount(reference_ids, minlength=len(references))
+    if metrics is not None:
+        metrics.count('reads_in', int(umi_counts_pre[2].sum()))
+        metrics.count('reads_out', len(reference_ids))
+    return dict(zip(references, reads_per_reference.tolist()))
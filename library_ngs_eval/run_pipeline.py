@@ -0,0 +1,110 @@
+import multiprocessing
+import os
+import sys
+from ngs_utils.pipeline import Task, run_pipeline
+
+# Runs stages 1 to 7 for each library as a graph of tasks (replaces script_1_to_7.sh).
+# Libraries go through the stages independently, so e.g. one library is filtered while the next one is aligned.
+# Finished tasks are skipped when the pipeline is run again with the same scripts and inputs,
+# after a failure only the failed tasks and the ones after them are run.
+# Stage 5 is not needed, stage 6 reads the filtered BAM files directly (do not use use_umi_tools in stage 6).
+
+# the raw libraries of stage 1 and the libraries they are split into ({cell line}_{sample name}_{replicate})
+libraries = {
+    'HEK293T_r1': ['HEK293T_3UTR_r1'],
+}
+fixed_suffix = "CKDL240004006-1A_22GVGLLT3_L2"
+
+# files the merge, alignment and filter stages read besides the reads: the reference FASTA and its bwa index
+# (prefix ref_filepath of 3_align_to_references.py), a change reruns these stages
+reference_fasta = '2_references/references/references.fasta'
+bwa_index_prefix = '2_references/references/'
+reference_inputs = [reference_fasta] + [bwa_index_prefix + extension
+                                        for extension in ('.amb', '.ann', '.bwt', '.pac', '.sa')]
+
+# True: filter, deduplicate and count in a single pass with 4_7_filter_deduplicate_count.py
+fused_filter_count = False
+# True: merge the mates with 2_merge_mates.py and align the merged reads (sets merged_reads of stage 3)
+merge_mates = False
+
+# budgets of all tasks running at the same time
+cpu_budget = multiprocessing.cpu_count()
+memory_budget_gb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3
+
+# CPUs and memory (GB) per task of a stage, bwa uses the CPUs of the stage as threads
+stage_resources = {
+    '1_split': dict(cpus=1, memory_gb=1),
+    '2_merge': dict(cpus=1, memory_gb=1),
+    '3_align': dict(cpus=max(cpu_budget * 3 // 4, 1), memory_gb=8),
+    '4_filter': dict(cpus=1, memory_gb=2),
+    '4_7_filter_count': dict(cpus=1, memory_gb=2),
+    '6_deduplicate': dict(cpus=1, memory_gb=4),
+    '7_count': dict(cpus=1, memory_gb=1),
+}
+
+# stages that are run again even if they are up to date
+force_stages = []
+
+stamp_dir = 'pipeline_stamps'
+log_dir = 'log'
+
+def build_tasks():
+    tasks = []
+    for raw_lib_name, lib_names in libraries.items():
+        split = Task('1_split', raw_lib_name, '1_split_UTR_rem_umis.py', [raw_lib_name],
+                     inputs=[f'1_fastq/{raw_lib_name}/{raw_lib_name}_{fixed_suffix}_{read}.fq.gz' for read in (1, 2)],
+                     outputs=[f'2_fastq_split_rem_umi/{lib_name}_Read{read}.fq.gz'
+                              for lib_name in lib_names for read in (1, 2)],
+                     # all libraries write to the same stats.csv
+                     exclusive_group='split_stats', **stage_resources['1_split'])
+        tasks.append(split)
+
+        for lib_name in lib_names:
+            split_reads = [f'2_fastq_split_rem_umi/{lib_name}_Read{read}.fq.gz' for read in (1, 2)]
+            if merge_mates:
+                merged_reads = [f'2_fastq_split_rem_umi/{lib_name}_Merged.fq.gz'] + \
+                               [f'2_fastq_split_rem_umi/{lib_name}_Unmerged_Read{read}.fq.gz' for read in (1, 2)]
+                merge = Task('2_merge', lib_name, '2_merge_mates.py', [lib_name], inputs=split_reads + reference_inputs,
+                             outputs=merged_reads, dependencies=[split], **stage_resources['2_merge'])
+                tasks.append(merge)
+                align_inputs, align_dependencies = merged_reads, [merge]
+            else:
+                align_inputs, align_dependencies = split_reads, [split]
+            align = Task('3_align', lib_name, '3_align_to_references.py', [lib_name],
+                         inputs=align_inputs + reference_inputs,
+                         outputs=[f'3_alignments/{lib_name}.bam'], dependencies=align_dependencies,
+                         **stage_resources['3_align'])
+            tasks.append(align)
+
+            if fused_filter_count:
+                tasks.append(Task('4_7_filter_count', lib_name, '4_7_filter_deduplicate_count.py', [lib_name],
+                                  inputs=[f'3_alignments/{lib_name}.bam'] + reference_inputs,
+                                  outputs=[f'6_counts/{lib_name}.csv'], dependencies=[align],
+                                  # all libraries write to the same all_counts.csv
+                                  exclusive_group='all_counts', **stage_resources['4_7_filter_count']))
+                continue
+
+            filter_task = Task('4_filter', lib_name, '4_filter_alignments.py', [lib_name],
+                               inputs=[f'3_alignments/{lib_name}.bam'] + reference_inputs,
+                               outputs=[f'4_filtered_alignments/{lib_name}_filter.bam'], dependencies=[align],
+                               **stage_resources['4_filter'])
+            deduplicate = Task('6_deduplicate', lib_name, '6_deduplicate_umis.py', [lib_name],
+                               inputs=[f'4_filtered_alignments/{lib_name}_filter.bam'],
+                               outputs=[f'5_deduplicated/{lib_name}_deduplicated.bam'], dependencies=[filter_task],
+                               **stage_resources['6_deduplicate'])
+            count = Task('7_count', lib_name, '7_count_alignments.py', [lib_name],
+                         inputs=[f'5_deduplicated/{lib_name}_deduplicated.bam'],
+                         outputs=[f'6_counts/{lib_name}.csv'], dependencies=[deduplicate],
+                         exclusive_group='all_counts', **stage_resources['7_count'])
+            tasks += [filter_task, deduplicate, count]
+    return tasks
+
+if __name__ == "__main__":
+    if merge_mates:
+        # read by 3_align_to_references.py in the task processes
+        os.environ['NGS_MERGED_READS'] = '1'
+    status = run_pipeline(build_tasks(), cpu_budget, memory_budget_gb, stamp_dir, log_dir, force_stages)
+    for task_name, task_status in status.items():
+        print(f"{task_name}: {task_status}")
+    if any(task_status in ('failed', 'blocked') for task_status in status.values()):
+        sys.exit(1)